@@ -1,14 +1,90 @@
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Boolean, DateTime
+from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Boolean, DateTime, Index, and_, bindparam, event, insert, select, text, tuple_, union_all, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, aliased
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from collections import OrderedDict, deque
 from sqlalchemy.sql import func
 from getpass import getpass
-import sys, os, bcrypt
-from tabulate import tabulate
+import sys, os, io, re, json, time, atexit, functools, random, platform, tempfile, threading, unicodedata
+import sqlite3, sqlalchemy
+import urllib.parse
 from datetime import datetime, timedelta
 
-# Tworzymy instancję silnika bazy danych SQLite
-engine = create_engine('sqlite:///library.db', echo=False)
+# tabulate, bcrypt, klient HTTP i moduły potrzebne tylko poleceniom (API, pomiary, kopie zapasowe) ładują się dopiero
+# przy pierwszym użyciu - samo menu (np. w kiosku) ich nie potrzebuje, a import tabulate to kilkadziesiąt milisekund startu.
+# Część z nich (asyncio, subprocess, csv, hashlib, concurrent.futures) i tak importuje SQLAlchemy, ale nie zależymy od tego.
+# Import powtórzony w funkcji to już tylko odczyt z sys.modules.
+def tabulate(*args, **kwargs):
+    from tabulate import tabulate as render_table
+    return render_table(*args, **kwargs)
+
+# Litery, których unicodedata nie rozkłada na literę bazową i znak diakrytyczny
+_FOLD_LETTERS = str.maketrans('łŁ', 'lL')
+
+# Sprowadza tekst do małych liter bez polskich znaków (Łódź -> lodz)
+def fold_text(value):
+    if value is None:
+        return ''
+    value = unicodedata.normalize('NFKD', str(value).translate(_FOLD_LETTERS))
+    return ''.join(char for char in value if not unicodedata.combining(char)).lower()
+
+# Konfiguracja każdego nowego połączenia z puli: funkcja pl_fold dla triggerów indeksu wyszukiwania,
+# WAL (czytający nie blokują piszącego), synchronous=NORMAL i czekanie na blokadę zamiast błędu "database is locked"
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    dbapi_connection.create_function('pl_fold', 1, fold_text, deterministic=True)
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+def create_library_engine(url):
+    engine = create_engine(
+        url,
+        echo=False,
+        connect_args={"check_same_thread": False},  # Połączenia z puli mogą trafiać do różnych wątków
+        pool_size=5,
+        max_overflow=10,
+    )
+    event.listen(engine, "connect", configure_sqlite_connection)
+    return engine
+
+# Adres bazy można nadpisać zmienną środowiskową, np. sqlite:////data/library.db
+DATABASE_URL = os.environ.get("LIBRARY_DATABASE_URL", "sqlite:///library.db")
+# Oddziały biblioteki, każdy z własną bazą: LIBRARY_BRANCHES="centrum=sqlite:///centrum.db,polnoc=sqlite:///polnoc.db".
+# Terminal pracuje w oddziale LIBRARY_BRANCH (domyślnie pierwszym z listy), którego baza zastępuje DATABASE_URL.
+# Bez LIBRARY_BRANCHES jest jedna baza i jeden oddział bez nazwy.
+BRANCHES = {name.strip(): url.strip() for name, url in (entry.split("=", 1) for entry in os.environ.get("LIBRARY_BRANCHES", "").split(",") if entry.strip())}
+BRANCH = os.environ.get("LIBRARY_BRANCH") or next(iter(BRANCHES), None)
+if BRANCHES:
+    if BRANCH not in BRANCHES:
+        sys.exit(f"Nieznany oddział {BRANCH}. Oddziały z LIBRARY_BRANCHES: {', '.join(BRANCHES)}.")
+    DATABASE_URL = BRANCHES[BRANCH]
+# Koszt bcrypt (log2 liczby rund) i liczba procesów haszujących; 0 procesów = jeden na rdzeń
+BCRYPT_ROUNDS = int(os.environ.get("LIBRARY_BCRYPT_ROUNDS", 12))
+PASSWORD_WORKERS = int(os.environ.get("LIBRARY_PASSWORD_WORKERS", 0))
+# Pamięć podręczna odczytów: liczba wpisów na pamięć i czas ważności wpisu w sekundach.
+# TTL ogranicza nieaktualność danych zmienionych przez inny proces (np. drugi terminal).
+CACHE_SIZE = int(os.environ.get("LIBRARY_CACHE_SIZE", 10000))
+CACHE_TTL = float(os.environ.get("LIBRARY_CACHE_TTL", 30))
+# Dziennik zdarzeń: co ile sekund i od ilu zdarzeń w buforze zapisywać paczkę do bazy
+AUDIT_FLUSH_INTERVAL = float(os.environ.get("LIBRARY_AUDIT_FLUSH_INTERVAL", 1))
+AUDIT_BATCH_SIZE = int(os.environ.get("LIBRARY_AUDIT_BATCH_SIZE", 500))
+# Po ilu dniach od zwrotu wypożyczenie przechodzi do archiwum (polecenie archive-transactions)
+ARCHIVE_AFTER_DAYS = int(os.environ.get("LIBRARY_ARCHIVE_AFTER_DAYS", 365))
+# Kopia zapasowa w trakcie pracy: stron bazy na krok, przerwa między krokami (ms) i rozmiar kawałka migawki przyrostowej (bajty)
+BACKUP_PAGES = int(os.environ.get("LIBRARY_BACKUP_PAGES", 1024))
+BACKUP_PAUSE_MS = float(os.environ.get("LIBRARY_BACKUP_PAUSE_MS", 5))
+BACKUP_CHUNK_SIZE = int(os.environ.get("LIBRARY_BACKUP_CHUNK_SIZE", 64 * 1024))
+# Profilowanie (domyślnie wyłączone): czasy funkcji, zapytań SQL i żądań API oraz liczniki akcji.
+# Raport trafia przy wyjściu do pliku JSON (LIBRARY_PROFILE_FILE) albo na ekran; zapytania dłuższe niż próg - do dziennika wolnych zapytań.
+PROFILE = os.environ.get("LIBRARY_PROFILE", "") not in ("", "0")
+PROFILE_FILE = os.environ.get("LIBRARY_PROFILE_FILE")
+SLOW_QUERY_MS = float(os.environ.get("LIBRARY_SLOW_QUERY_MS", 100))
+SLOW_QUERY_LOG = os.environ.get("LIBRARY_SLOW_QUERY_LOG", "slow-queries.log")
 
 # Deklarujemy bazę dla modeli
 Base = declarative_base()
@@ -26,7 +102,7 @@ class User(Base):
     activated = Column(Boolean, default=True)  # Pole activated
     blocked = Column(Boolean, default=False)   # Pole blocked
 
-    books = relationship("Book", back_populates="user")  # Dodaj ten wiersz
+    copies = relationship("Copy", back_populates="user")  # Wypożyczone egzemplarze
 
     def __repr__(self):
         return f"<User(username='{self.username}')>"
@@ -35,20 +111,40 @@ class Book(Base):
     __tablename__ = 'books'
 
     id = Column(Integer, primary_key=True)
-    title = Column(String)
-    author = Column(String)
-    year = Column(Integer)
-    user_id = Column(Integer, ForeignKey('users.id'))
-    user = relationship("User", back_populates="books")
+    title = Column(String, index=True)  # Indeksy tytułu i autora służą sortowaniu list stronicowanych
+    author = Column(String, index=True)
+    year = Column(Integer, index=True)
+    # Liczba egzemplarzy i wolnych egzemplarzy - utrzymywane przez triggery na copies (COPIES_DDL)
+    copies = Column(Integer, nullable=False, default=0)
+    available = Column(Integer, nullable=False, default=0)
 
     def __repr__(self):
         return f"<Book(title='{self.title}', author='{self.author}', year={self.year})>"
 
+# Fizyczny egzemplarz książki (tytułu). user_id wskazuje wypożyczającego, NULL - egzemplarz jest na półce.
+class Copy(Base):
+    __tablename__ = 'copies'
+
+    id = Column(Integer, primary_key=True)
+    book_id = Column(Integer, ForeignKey('books.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=True)
+
+    book = relationship("Book")
+    user = relationship("User", back_populates="copies")
+
+    __table_args__ = (
+        Index('ix_copies_book_id', book_id),
+        # Wolne egzemplarze tytułu - wypożyczenie bierze pierwszy z nich
+        Index('ix_copies_available', book_id, sqlite_where=user_id.is_(None)),
+        Index('ix_copies_borrowed', user_id, book_id, sqlite_where=user_id.isnot(None)),
+    )
+
 class Transaction(Base):
     __tablename__ = 'transactions'
 
     id = Column(Integer, primary_key=True)
-    book_id = Column(Integer, ForeignKey('books.id'))
+    book_id = Column(Integer, ForeignKey('books.id'))  # Tytuł
+    copy_id = Column(Integer, ForeignKey('copies.id'))  # Wypożyczony egzemplarz
     user_id = Column(Integer, ForeignKey('users.id'))
     borrowed_at = Column(DateTime, default=func.now())
     due_date = Column(DateTime)
@@ -57,324 +153,4516 @@ class Transaction(Base):
     book = relationship("Book")
     user = relationship("User")
 
-# Tworzymy tabelę w bazie danych
-Base.metadata.create_all(engine)
+    # Indeksy częściowe obejmują tylko otwarte wypożyczenia, więc rosną z liczbą wypożyczonych książek, a nie z historią
+    __table_args__ = (
+        # Co najwyżej jedno otwarte wypożyczenie danego egzemplarza - ostatnia linia obrony przed podwójnym wypożyczeniem
+        Index('ux_transactions_open_copy', copy_id, unique=True, sqlite_where=returned_at.is_(None)),
+        Index('ix_transactions_open_book', book_id, sqlite_where=returned_at.is_(None)),
+        Index('ix_transactions_open_user', user_id, sqlite_where=returned_at.is_(None)),
+        Index('ix_transactions_open_due_date', due_date, sqlite_where=returned_at.is_(None)),
+        Index('ix_transactions_user_id', user_id),
+    )
+
+# Archiwum zwróconych wypożyczeń, do którego archive_transactions przenosi stare wiersze z transactions.
+# Wiersze zachowują ID, więc historia to obie tabele razem, a transactions obejmuje tylko otwarte i niedawne wypożyczenia.
+class ArchivedTransaction(Base):
+    __tablename__ = 'transactions_archive'
+
+    id = Column(Integer, primary_key=True)  # ID z transactions
+    book_id = Column(Integer, ForeignKey('books.id'))
+    copy_id = Column(Integer, ForeignKey('copies.id'))
+    user_id = Column(Integer, ForeignKey('users.id'))
+    borrowed_at = Column(DateTime)
+    due_date = Column(DateTime)
+    returned_at = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_transactions_archive_user_id', user_id),
+    )
+
+# Postęp importu katalogu - pozwala wznowić przerwany import od ostatniej zatwierdzonej paczki
+class ImportProgress(Base):
+    __tablename__ = 'import_progress'
+
+    source = Column(String, primary_key=True)  # Bezwzględna ścieżka pliku
+    records_done = Column(Integer, default=0)  # Rekordy już przetworzone (zaimportowane lub odrzucone)
+    imported = Column(Integer, default=0)
+    rejected = Column(Integer, default=0)
+    started_at = Column(DateTime, default=datetime.now)
+    updated_at = Column(DateTime, default=datetime.now)
+    finished_at = Column(DateTime, nullable=True)
+
+# Kolejka powiadomień (outbox). Skaner zaległości tylko dopisuje wiersze, a wysyłką zajmuje się osobny krok,
+# więc do działania nie potrzeba serwera pocztowego.
+class Notification(Base):
+    __tablename__ = 'notifications'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    transaction_id = Column(Integer, ForeignKey('transactions.id'))
+    kind = Column(String)  # Rodzaj powiadomienia: 'overdue', 'hold_ready', 'hold_expired'
+    message = Column(String)
+    created_at = Column(DateTime, default=datetime.now)
+    sent_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # Jedno powiadomienie danego rodzaju na wypożyczenie - kolejne skany nie dublują wpisów
+        Index('ux_notifications_transaction_kind', transaction_id, kind, unique=True),
+        Index('ix_notifications_unsent', id, sqlite_where=sent_at.is_(None)),
+    )
+
+# Rezerwacja tytułu, którego wszystkie egzemplarze są wypożyczone. Kolejność w kolejce wyznacza ID (FIFO).
+# status: 'waiting' (w kolejce), 'fulfilled' (książka wypożyczona), 'cancelled', 'expired'
+class Hold(Base):
+    __tablename__ = 'holds'
+
+    id = Column(Integer, primary_key=True)
+    book_id = Column(Integer, ForeignKey('books.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    created_at = Column(DateTime, default=datetime.now)
+    expires_at = Column(DateTime, nullable=False)
+    status = Column(String, nullable=False, default='waiting')
+    closed_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # Kolejka tytułu: następny oczekujący to pierwszy wpis indeksu dla book_id, bez względu na długość kolejki
+        Index('ix_holds_queue', book_id, id, sqlite_where=status == 'waiting'),
+        Index('ux_holds_waiting_user_book', user_id, book_id, unique=True, sqlite_where=status == 'waiting'),
+        Index('ix_holds_waiting_expires_at', expires_at, sqlite_where=status == 'waiting'),
+    )
+
+# Prośba czytelnika o przedłużenie wypożyczenia, rozpatrywana przez administratora.
+# status: 'pending' (czeka), 'approved', 'rejected' (reason - powód odrzucenia), 'cancelled' (książkę zwrócono)
+class ExtensionRequest(Base):
+    __tablename__ = 'extension_requests'
+
+    id = Column(Integer, primary_key=True)
+    transaction_id = Column(Integer, ForeignKey('transactions.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    days = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.now)
+    status = Column(String, nullable=False, default='pending')
+    reason = Column(String, nullable=True)
+    decided_at = Column(DateTime, nullable=True)
+    decided_by = Column(Integer, ForeignKey('users.id'), nullable=True)
+
+    __table_args__ = (
+        # Kolejka administratora: oczekujące prośby po kolei, strona to odczyt kolejnych wpisów indeksu
+        Index('ix_extension_requests_pending', id, sqlite_where=status == 'pending'),
+        Index('ux_extension_requests_pending_transaction', transaction_id, unique=True, sqlite_where=status == 'pending'),
+        Index('ix_extension_requests_user', user_id, id),
+    )
+
+# Statystyki wypożyczeń utrzymywane przyrostowo przez triggery (STATISTICS_DDL),
+# więc odczyt nie wymaga agregacji po całej tabeli transactions
+class BookStats(Base):
+    __tablename__ = 'book_stats'
+
+    book_id = Column(Integer, primary_key=True)
+    loans = Column(Integer, nullable=False, default=0, index=True)
+    borrowed = Column(Integer, nullable=False, default=0)  # Liczba egzemplarzy wypożyczonych teraz (otwarte wypożyczenia)
+
+class UserStats(Base):
+    __tablename__ = 'user_stats'
+
+    user_id = Column(Integer, primary_key=True)
+    loans = Column(Integer, nullable=False, default=0, index=True)
+    borrowed = Column(Integer, nullable=False, default=0)
+
+class AuthorStats(Base):
+    __tablename__ = 'author_stats'
+
+    author = Column(String, primary_key=True)
+    loans = Column(Integer, nullable=False, default=0, index=True)
+
+# Liczniki dla całej biblioteki: 'loans' (wszystkie wypożyczenia) i 'borrowed' (obecnie wypożyczone)
+class CirculationStats(Base):
+    __tablename__ = 'circulation_stats'
+
+    name = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+# Indeks pełnotekstowy FTS5 (tytuł, autor) utrzymywany przez triggery na tabeli books.
+# Przechowuje tekst po pl_fold, więc wyszukiwanie nie zależy od polskich znaków.
+SEARCH_INDEX_DDL = [
+    "CREATE VIRTUAL TABLE books_fts USING fts5(title, author, tokenize='unicode61 remove_diacritics 2')",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+        INSERT INTO books_fts(rowid, title, author) VALUES (new.id, pl_fold(new.title), pl_fold(new.author));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author ON books BEGIN
+        UPDATE books_fts SET title = pl_fold(new.title), author = pl_fold(new.author) WHERE rowid = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+        DELETE FROM books_fts WHERE rowid = old.id;
+    END""",
+    "INSERT INTO books_fts(rowid, title, author) SELECT id, pl_fold(title), pl_fold(author) FROM books",
+]
+
+def create_search_index(connection):
+    exists = connection.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'books_fts'").first()
+    if exists is None:
+        for statement in SEARCH_INDEX_DDL:
+            connection.exec_driver_sql(statement)
+
+# Indeksy trigramów do wyszukiwania z literówkami: FTS5 z tokenizerem trigram nad tekstem po pl_fold,
+# utrzymywane przez triggery tak jak books_fts. Tabele są bez zawartości (content='') - tekst jest już w users/books,
+# a usunięcie wpisu podaje stare wartości, które trigger ma w old. Tabele *_vocab podają, w ilu wierszach jest dany trigram.
+TRIGRAM_INDEX_DDL = [
+    "CREATE VIRTUAL TABLE users_trigram USING fts5(username, name, surname, tokenize='trigram', content='')",
+    "CREATE VIRTUAL TABLE users_trigram_vocab USING fts5vocab(users_trigram, row)",
+    """CREATE TRIGGER IF NOT EXISTS users_trigram_insert AFTER INSERT ON users BEGIN
+        INSERT INTO users_trigram(rowid, username, name, surname) VALUES (new.id, pl_fold(new.username), pl_fold(new.name), pl_fold(new.surname));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_trigram_update AFTER UPDATE OF username, name, surname ON users BEGIN
+        INSERT INTO users_trigram(users_trigram, rowid, username, name, surname)
+            VALUES ('delete', old.id, pl_fold(old.username), pl_fold(old.name), pl_fold(old.surname));
+        INSERT INTO users_trigram(rowid, username, name, surname) VALUES (new.id, pl_fold(new.username), pl_fold(new.name), pl_fold(new.surname));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_trigram_delete AFTER DELETE ON users BEGIN
+        INSERT INTO users_trigram(users_trigram, rowid, username, name, surname)
+            VALUES ('delete', old.id, pl_fold(old.username), pl_fold(old.name), pl_fold(old.surname));
+    END""",
+    "INSERT INTO users_trigram(rowid, username, name, surname) SELECT id, pl_fold(username), pl_fold(name), pl_fold(surname) FROM users",
+    "CREATE VIRTUAL TABLE books_trigram USING fts5(title, author, tokenize='trigram', content='')",
+    "CREATE VIRTUAL TABLE books_trigram_vocab USING fts5vocab(books_trigram, row)",
+    """CREATE TRIGGER IF NOT EXISTS books_trigram_insert AFTER INSERT ON books BEGIN
+        INSERT INTO books_trigram(rowid, title, author) VALUES (new.id, pl_fold(new.title), pl_fold(new.author));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_trigram_update AFTER UPDATE OF title, author ON books BEGIN
+        INSERT INTO books_trigram(books_trigram, rowid, title, author) VALUES ('delete', old.id, pl_fold(old.title), pl_fold(old.author));
+        INSERT INTO books_trigram(rowid, title, author) VALUES (new.id, pl_fold(new.title), pl_fold(new.author));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_trigram_delete AFTER DELETE ON books BEGIN
+        INSERT INTO books_trigram(books_trigram, rowid, title, author) VALUES ('delete', old.id, pl_fold(old.title), pl_fold(old.author));
+    END""",
+    "INSERT INTO books_trigram(rowid, title, author) SELECT id, pl_fold(title), pl_fold(author) FROM books",
+]
+
+def create_trigram_index(connection):
+    exists = connection.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_trigram'").first()
+    if exists is None:
+        for statement in TRIGRAM_INDEX_DDL:
+            connection.exec_driver_sql(statement)
+
+# Triggery aktualizują statystyki w tej samej transakcji co zmiana w transactions/books.
+# Statystyki książek i autorów dotyczą tylko istniejących książek, więc usunięcie książki zdejmuje jej wypożyczenia z autora.
+# Usunięcie wypożyczenia przeniesionego już do archiwum (archive_transactions najpierw kopiuje, potem usuwa) nie zmienia statystyk.
+STATISTICS_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS stats_transaction_insert AFTER INSERT ON transactions BEGIN
+        INSERT INTO book_stats(book_id, loans, borrowed) SELECT new.book_id, 1, new.returned_at IS NULL FROM books WHERE id = new.book_id
+            ON CONFLICT(book_id) DO UPDATE SET loans = loans + 1, borrowed = borrowed + excluded.borrowed;
+        INSERT INTO user_stats(user_id, loans, borrowed) SELECT new.user_id, 1, new.returned_at IS NULL WHERE new.user_id IS NOT NULL
+            ON CONFLICT(user_id) DO UPDATE SET loans = loans + 1, borrowed = borrowed + excluded.borrowed;
+        INSERT INTO author_stats(author, loans) SELECT author, 1 FROM books WHERE id = new.book_id AND author IS NOT NULL
+            ON CONFLICT(author) DO UPDATE SET loans = loans + 1;
+        UPDATE circulation_stats SET value = value + CASE name WHEN 'loans' THEN 1 ELSE new.returned_at IS NULL END;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS stats_transaction_return AFTER UPDATE OF returned_at ON transactions
+    WHEN (old.returned_at IS NULL) != (new.returned_at IS NULL) BEGIN
+        UPDATE book_stats SET borrowed = borrowed + (new.returned_at IS NULL) - (old.returned_at IS NULL) WHERE book_id = new.book_id;
+        UPDATE user_stats SET borrowed = borrowed + (new.returned_at IS NULL) - (old.returned_at IS NULL) WHERE user_id = new.user_id;
+        UPDATE circulation_stats SET value = value + (new.returned_at IS NULL) - (old.returned_at IS NULL) WHERE name = 'borrowed';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS stats_transaction_delete AFTER DELETE ON transactions
+    WHEN NOT EXISTS (SELECT 1 FROM transactions_archive WHERE id = old.id) BEGIN
+        UPDATE book_stats SET loans = loans - 1, borrowed = borrowed - (old.returned_at IS NULL) WHERE book_id = old.book_id;
+        UPDATE user_stats SET loans = loans - 1, borrowed = borrowed - (old.returned_at IS NULL) WHERE user_id = old.user_id;
+        UPDATE author_stats SET loans = loans - 1 WHERE author = (SELECT author FROM books WHERE id = old.book_id);
+        UPDATE circulation_stats SET value = value - CASE name WHEN 'loans' THEN 1 ELSE old.returned_at IS NULL END;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS stats_book_author AFTER UPDATE OF author ON books WHEN old.author IS NOT new.author BEGIN
+        UPDATE author_stats SET loans = loans - coalesce((SELECT loans FROM book_stats WHERE book_id = new.id), 0) WHERE author = old.author;
+        INSERT INTO author_stats(author, loans) SELECT new.author, loans FROM book_stats WHERE book_id = new.id AND new.author IS NOT NULL
+            ON CONFLICT(author) DO UPDATE SET loans = loans + excluded.loans;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS stats_book_delete AFTER DELETE ON books BEGIN
+        UPDATE author_stats SET loans = loans - coalesce((SELECT loans FROM book_stats WHERE book_id = old.id), 0) WHERE author = old.author;
+        DELETE FROM book_stats WHERE book_id = old.id;
+    END""",
+]
+
+# Cała historia wypożyczeń: bieżąca tabela i archiwum (statystyki liczą też zarchiwizowane wypożyczenia)
+TRANSACTION_HISTORY = """(SELECT book_id, user_id, returned_at FROM transactions
+    UNION ALL SELECT book_id, user_id, returned_at FROM transactions_archive)"""
+
+# Zapytania liczące statystyki od zera - do przebudowy i do sprawdzania zgodności
+STATISTICS_QUERIES = {
+    "book_stats": f"""SELECT t.book_id, count(*), coalesce(sum(t.returned_at IS NULL), 0) FROM {TRANSACTION_HISTORY} t
+        JOIN books b ON b.id = t.book_id GROUP BY t.book_id""",
+    "user_stats": f"""SELECT user_id, count(*), coalesce(sum(returned_at IS NULL), 0) FROM {TRANSACTION_HISTORY}
+        WHERE user_id IS NOT NULL GROUP BY user_id""",
+    "author_stats": f"""SELECT b.author, count(*) FROM {TRANSACTION_HISTORY} t JOIN books b ON b.id = t.book_id
+        WHERE b.author IS NOT NULL GROUP BY b.author""",
+    "circulation_stats": f"""SELECT 'loans', count(*) FROM {TRANSACTION_HISTORY}
+        UNION ALL SELECT 'borrowed', count(*) FROM transactions WHERE returned_at IS NULL""",
+}
+
+def rebuild_statistics(connection):
+    for table, query in STATISTICS_QUERIES.items():
+        connection.exec_driver_sql(f"DELETE FROM {table}")
+        connection.exec_driver_sql(f"INSERT INTO {table} {query}")
+
+# Zwraca {tabela: liczba niezgodnych wierszy}; wiersze o zerowych licznikach nie są błędem
+def check_statistics(connection):
+    differences = {}
+    for table, query in STATISTICS_QUERIES.items():
+        stored = f"SELECT * FROM {table}" + ("" if table == "circulation_stats" else " WHERE loans != 0")
+        computed = f"SELECT * FROM ({query})"
+        missing = connection.exec_driver_sql(f"SELECT count(*) FROM ({computed} EXCEPT {stored})").scalar()
+        extra = connection.exec_driver_sql(f"SELECT count(*) FROM ({stored} EXCEPT {computed})").scalar()
+        differences[table] = missing + extra
+    return differences
+
+def create_statistics(connection):
+    for statement in STATISTICS_DDL:
+        connection.exec_driver_sql(statement)
+    rebuild_statistics(connection)
+
+# Baza z migracji 5 ma trigger usuwania bez warunku na archiwum - podmieniamy go na wersję z STATISTICS_DDL
+def recreate_transaction_delete_trigger(connection):
+    connection.exec_driver_sql("DROP TRIGGER IF EXISTS stats_transaction_delete")
+    connection.exec_driver_sql(next(ddl for ddl in STATISTICS_DDL if "stats_transaction_delete" in ddl))
+
+# create_all nie zmienia istniejących tabel, więc indeksy dodane do modeli później tworzymy osobno
+def create_indexes(connection, names):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in names:
+                index.create(connection, checkfirst=True)
+    analyze_tables(connection)
+
+# Statystyki dla planisty zapytań - bez nich SQLite często pomija indeksy częściowe.
+# Tylko tabele modeli: statystyki wewnętrznych tabel FTS5 zebrane przy małej bazie
+# psują plany zapytań modułu FTS i zapis do indeksu zwalnia wraz z liczbą książek.
+def analyze_tables(connection):
+    for table in Base.metadata.sorted_tables:
+        connection.exec_driver_sql(f'ANALYZE "{table.name}"')
+
+def create_hot_query_indexes(connection):
+    create_indexes(connection, (
+        "ix_books_year", "ix_books_user_id", "ix_transactions_open_user",
+        "ix_transactions_open_due_date", "ix_transactions_user_id",
+    ))
+
+# Zamyka nadmiarowe otwarte wypożyczenia (zostaje to zgodne z books.user_id, a przy braku - najnowsze)
+# i zakłada unikalny indeks na otwarte wypożyczenia książki. Zamknięte wypożyczenie nie znaczy, że książka wróciła,
+# więc każde trafia do dziennika zdarzeń (loan.force_close) ze stanem sprzed zmiany - do wyjaśnienia z czytelnikiem.
+def enforce_single_open_loan(connection):
+    # Nowa baza nie ma już kolumny books.user_id (egzemplarze są w copies), więc wtedy zostaje najnowsze
+    matches_book_user = "t.user_id = b.user_id DESC, " if column_exists(connection, "books", "user_id") else ""
+    extra_loans = connection.exec_driver_sql(f"""
+        SELECT id, book_id, user_id, borrowed_at, due_date FROM transactions
+        WHERE returned_at IS NULL
+          AND EXISTS (SELECT 1 FROM transactions other
+                      WHERE other.book_id = transactions.book_id AND other.returned_at IS NULL AND other.id <> transactions.id)
+          AND id <> (SELECT t.id FROM transactions t LEFT JOIN books b ON b.id = t.book_id
+                     WHERE t.book_id = transactions.book_id AND t.returned_at IS NULL
+                     ORDER BY {matches_book_user}t.id DESC LIMIT 1)
+        ORDER BY id
+    """).all()
+    if extra_loans:
+        now = datetime.now()
+        events = [audit_event("loan.force_close", "transaction", loan_id,
+                              before={"book_id": book_id, "user_id": user_id, "borrowed_at": borrowed_at, "due_date": due_date, "returned_at": None},
+                              after={"returned_at": now, "reason": "nadmiarowe otwarte wypożyczenie książki"})
+                  for loan_id, book_id, user_id, borrowed_at, due_date in extra_loans]
+        # Zapis wprost w transakcji migracji: zdarzenia są w dzienniku wtedy i tylko wtedy, gdy wypożyczenia zostały zamknięte
+        partition = audit_partition_name(now)
+        create_audit_partition(connection, partition)
+        connection.exec_driver_sql(
+            f'INSERT INTO "{partition}" ({", ".join(AUDIT_COLUMNS)}) VALUES ({", ".join("?" * len(AUDIT_COLUMNS))})',
+            [(event[0].isoformat(sep=" "), *event[1:]) for event in events]
+        )
+        connection.exec_driver_sql("UPDATE transactions SET returned_at = ? WHERE id = ?", [(now, loan[0]) for loan in extra_loans])
+        print(f"Zamknięto nadmiarowe otwarte wypożyczenia: {len(extra_loans)} (książki: {len({loan[1] for loan in extra_loans})}). "
+              f"Egzemplarze mogą nadal być u czytelników - lista w dzienniku zdarzeń: audit --action loan.force_close")
+    connection.exec_driver_sql("DROP INDEX IF EXISTS ix_transactions_open_book_user")
+    if column_exists(connection, "books", "user_id"):
+        connection.exec_driver_sql(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_transactions_open_book ON transactions (book_id) WHERE returned_at IS NULL"
+        )
+
+def column_exists(connection, table, column):
+    return any(row[1] == column for row in connection.exec_driver_sql(f"PRAGMA table_info({table})"))
+
+# Liczniki books.copies/books.available zmieniają się razem z egzemplarzami, w tej samej transakcji
+COPIES_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS copies_insert AFTER INSERT ON copies BEGIN
+        UPDATE books SET copies = copies + 1, available = available + (new.user_id IS NULL) WHERE id = new.book_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS copies_delete AFTER DELETE ON copies BEGIN
+        UPDATE books SET copies = copies - 1, available = available - (old.user_id IS NULL) WHERE id = old.book_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS copies_loan AFTER UPDATE OF user_id ON copies
+    WHEN (old.user_id IS NULL) != (new.user_id IS NULL) BEGIN
+        UPDATE books SET available = available + (new.user_id IS NULL) - (old.user_id IS NULL) WHERE id = new.book_id;
+    END""",
+]
+
+# Rozdziela książki na tytuły (books) i egzemplarze (copies). Każdy dotychczasowy wiersz books staje się
+# egzemplarzem o tym samym ID, a wiersze o tym samym tytule, autorze i roku łączą się w jeden tytuł
+# o najmniejszym ID. Transakcje dostają copy_id (stare ID książki) i book_id tytułu.
+def split_copies(connection):
+    for table, column in (
+        ("books", "copies INTEGER NOT NULL DEFAULT 0"),
+        ("books", "available INTEGER NOT NULL DEFAULT 0"),
+        ("transactions", "copy_id INTEGER REFERENCES copies (id)"),
+    ):
+        if not column_exists(connection, table, column.split()[0]):
+            connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column}")
+    # Kilka egzemplarzy tytułu może być wypożyczonych naraz, więc unikalność przechodzi na egzemplarz
+    connection.exec_driver_sql("DROP INDEX IF EXISTS ux_transactions_open_book")
+    connection.exec_driver_sql("DROP INDEX IF EXISTS ix_books_user_id")
+    if column_exists(connection, "books", "user_id"):
+        connection.exec_driver_sql("CREATE TEMP TABLE copy_map (copy_id INTEGER PRIMARY KEY, book_id INTEGER, user_id INTEGER)")
+        connection.exec_driver_sql(
+            "INSERT INTO copy_map SELECT id, min(id) OVER (PARTITION BY title, author, year), user_id FROM books"
+        )
+        connection.exec_driver_sql("INSERT INTO copies (id, book_id, user_id) SELECT copy_id, book_id, user_id FROM copy_map")
+        connection.exec_driver_sql("""
+            UPDATE transactions SET copy_id = book_id, book_id = (SELECT book_id FROM copy_map WHERE copy_id = transactions.book_id)
+            WHERE copy_id IS NULL AND book_id IN (SELECT copy_id FROM copy_map)
+        """)
+        connection.exec_driver_sql("DELETE FROM books WHERE id NOT IN (SELECT book_id FROM copy_map)")
+        # SQLite nie usuwa kolumny z kluczem obcym, więc books.user_id zostaje w starych bazach jako nieużywana
+        connection.exec_driver_sql("UPDATE books SET user_id = NULL")
+        connection.exec_driver_sql("DROP TABLE copy_map")
+    for statement in COPIES_DDL:
+        connection.exec_driver_sql(statement)
+    connection.exec_driver_sql("""
+        UPDATE books SET copies = (SELECT count(*) FROM copies WHERE book_id = books.id),
+                         available = (SELECT count(*) FROM copies WHERE book_id = books.id AND user_id IS NULL)
+    """)
+    create_indexes(connection, ("ux_transactions_open_copy", "ix_transactions_open_book"))
+    rebuild_statistics(connection)
+
+def reset_search_index_statistics(connection):
+    if connection.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'").first():
+        connection.exec_driver_sql("DELETE FROM sqlite_stat1 WHERE tbl LIKE 'books_fts%'")
+
+# Kolejne kroki migracji schematu. Każdy krok musi dać się bezpiecznie powtórzyć,
+# bo nowa baza dostaje tabele z create_all, a potem przechodzi przez wszystkie kroki.
+# Baza w ostatniej wersji nie przechodzi przy starcie przez create_all, więc nowa tabela lub indeks wymaga nowego kroku.
+MIGRATIONS = [
+    (1, "Indeks pełnotekstowy książek", create_search_index),
+    (2, "Indeksy złożone i częściowe dla books/transactions", create_hot_query_indexes),
+    (3, "Unikalne otwarte wypożyczenie książki", enforce_single_open_loan),
+    (4, "Usunięcie statystyk planisty dla tabel FTS", reset_search_index_statistics),
+    (5, "Statystyki wypożyczeń utrzymywane triggerami", create_statistics),
+    (6, "Indeksy sortowania list książek", lambda connection: create_indexes(connection, ("ix_books_title", "ix_books_author"))),
+    (7, "Podział książek na tytuły i egzemplarze", split_copies),
+    (8, "Tabele importu, powiadomień, rezerwacji i próśb o przedłużenie", lambda connection: Base.metadata.create_all(connection)),
+    (9, "Indeksy trigramów użytkowników i książek (wyszukiwanie z literówkami)", create_trigram_index),
+    (10, "Archiwum zwróconych wypożyczeń", lambda connection: Base.metadata.create_all(connection)),
+    (11, "Statystyki pomijają usunięcia wypożyczeń przeniesionych do archiwum", recreate_transaction_delete_trigger),
+]
+
+def get_schema_version(connection):
+    connection.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description TEXT, applied_at TEXT)"
+    )
+    return connection.exec_driver_sql("SELECT max(version) FROM schema_version").scalar() or 0
+
+# Wykonuje brakujące kroki migracji, każdy w osobnej transakcji
+def migrate_database(engine):
+    with engine.begin() as connection:
+        current_version = get_schema_version(connection)
+    applied = []
+    for version, description, step in MIGRATIONS:
+        if version <= current_version:
+            continue
+        with engine.begin() as connection:
+            step(connection)
+            connection.exec_driver_sql(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                (version, description, datetime.now().isoformat(sep=" ", timespec="seconds"))
+            )
+        applied.append((version, description))
+    return applied
+
+# Schemat tworzymy i migrujemy tylko wtedy, gdy baza jest starsza niż ostatnia migracja (albo pusta).
+# Aktualna baza kosztuje przy starcie jedno zapytanie zamiast create_all, który sprawdza każdą tabelę osobno.
+def initialize_database(engine):
+    with engine.connect() as connection:
+        try:
+            current_version = connection.exec_driver_sql("SELECT max(version) FROM schema_version").scalar() or 0
+        except OperationalError:  # Nowa baza - nie ma jeszcze tabeli schema_version
+            current_version = 0
+    if current_version >= MIGRATIONS[-1][0]:
+        return []
+    Base.metadata.create_all(engine)
+    return migrate_database(engine)
+
+# DZIENNIK ZDARZEŃ
+# Każda zmiana danych zostawia wpis: kto (current_actor), co (action), na czym (target_type, target_id), wartości przed i po.
+# Zdarzenia trafiają do bufora w pamięci dopiero po udanym commicie operacji, a wątek w tle zapisuje je paczkami,
+# więc operacja nie płaci za dodatkowy commit. Cena: awaria procesu gubi zdarzenia z ostatnich AUDIT_FLUSH_INTERVAL sekund.
+# Dziennik jest podzielony na tabele miesięczne audit_log_RRRR_MM. Triggery blokują UPDATE i DELETE,
+# a stare miesiące compact_audit_log przenosi w całości do plików .jsonl.gz.
+current_actor = ContextVar("current_actor", default=None)  # ID zalogowanego użytkownika; None - system lub wiersz poleceń
+
+AUDIT_COLUMNS = ("occurred_at", "actor_id", "action", "target_type", "target_id", "before", "after")
+
+def audit_partition_name(occurred_at):
+    return f"audit_log_{occurred_at:%Y_%m}"
+
+def create_audit_partition(connection, partition):
+    connection.exec_driver_sql(f"""
+        CREATE TABLE IF NOT EXISTS "{partition}" (
+            id INTEGER PRIMARY KEY, occurred_at TEXT NOT NULL, actor_id INTEGER, action TEXT NOT NULL,
+            target_type TEXT, target_id INTEGER, before TEXT, after TEXT
+        )""")
+    for name, columns in (("occurred_at", "occurred_at"), ("actor", "actor_id, occurred_at"),
+                          ("target", "target_type, target_id, occurred_at"), ("action", "action, occurred_at")):
+        connection.exec_driver_sql(f'CREATE INDEX IF NOT EXISTS "ix_{partition}_{name}" ON "{partition}" ({columns})')
+    for operation in ("UPDATE", "DELETE"):
+        connection.exec_driver_sql(f"""
+            CREATE TRIGGER IF NOT EXISTS "{partition}_no_{operation.lower()}" BEFORE {operation} ON "{partition}"
+            BEGIN SELECT RAISE(ABORT, 'dziennik zdarzeń można tylko uzupełniać'); END""")
+
+def audit_partitions(connection):
+    return connection.exec_driver_sql(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'audit_log_[0-9][0-9][0-9][0-9]_[0-9][0-9]' ORDER BY name"
+    ).scalars().all()
+
+class AuditLog:
+    def __init__(self, flush_interval=AUDIT_FLUSH_INTERVAL, batch_size=AUDIT_BATCH_SIZE):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.enabled = True
+        self.synchronous = False  # Zapis przy każdym zdarzeniu - tylko do porównania w bench-audit
+        self.reset()
+
+    # Też po fork: proces potomny zaczyna z pustym buforem, a zdarzenia rodzica zapisze rodzic
+    def reset(self):
+        self.buffer = []
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.thread = None
+        self.partitions = set()  # (oddział, tabela miesięczna), które na pewno istnieją
+        self.written = self.flushes = 0
+
+    # branch - oddział, w którego bazie zaszły zdarzenia (None - baza tego terminala)
+    def record(self, events, branch=None):
+        if not events or not self.enabled:
+            return
+        branch = None if branch == BRANCH else branch
+        with self.condition:
+            self.buffer.extend((branch, event) for event in events)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="audit-log", daemon=True)
+                self.thread.start()
+            if len(self.buffer) >= self.batch_size:
+                self.condition.notify()
+        if self.synchronous:
+            self.flush()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.buffer) >= self.batch_size, self.flush_interval)
+            try:
+                self.flush()
+            except Exception as error:
+                print(f"Nie udało się zapisać dziennika zdarzeń (ponowienie za {self.flush_interval} s): {error}", file=sys.stderr)
+
+    # Zapisuje cały bufor, jedną transakcją na bazę oddziału; przy błędzie zdarzenia wracają do bufora
+    def flush(self):
+        with self.write_lock:
+            with self.condition:
+                events, self.buffer = self.buffer, []
+            if not events:
+                return 0
+            by_branch = {}
+            for branch, event in events:
+                by_branch.setdefault(branch, {}).setdefault(audit_partition_name(event[0]), []).append(event)
+            written = set()
+            try:
+                for branch, by_partition in by_branch.items():
+                    with branch_engine(branch).begin() as connection:
+                        for partition, rows in by_partition.items():
+                            if (branch, partition) not in self.partitions:
+                                create_audit_partition(connection, partition)
+                            connection.exec_driver_sql(
+                                f'INSERT INTO "{partition}" ({", ".join(AUDIT_COLUMNS)}) VALUES ({", ".join("?" * len(AUDIT_COLUMNS))})',
+                                [(event[0].isoformat(sep=" "), *event[1:]) for event in rows]
+                            )
+                    self.partitions.update((branch, partition) for partition in by_partition)
+                    written.add(branch)
+            except Exception:
+                with self.condition:
+                    self.buffer[:0] = [(branch, event) for branch, event in events if branch not in written]
+                raise
+            self.written += len(events)
+            self.flushes += 1
+            return len(events)
+
+audit_log = AuditLog()
+os.register_at_fork(after_in_child=audit_log.reset)
+atexit.register(audit_log.flush)
+
+def audit_event(action, target_type=None, target_id=None, before=None, after=None):
+    encode = lambda values: json.dumps(values, ensure_ascii=False, default=str) if values is not None else None
+    return (datetime.now(), current_actor.get(), action, target_type, target_id, encode(before), encode(after))
+
+# Zdarzenie trafia do dziennika tylko wtedy, gdy transakcja sesji zostanie zatwierdzona
+def audit_after_commit(session, action, target_type=None, target_id=None, before=None, after=None):
+    session.info.setdefault("audit", []).append(audit_event(action, target_type, target_id, before, after))
+
+# PROFILOWANIE
+# Włączony profiler podmienia wybrane funkcje modułu (PROFILED_FUNCTIONS) na wersje mierzące czas
+# i nasłuchuje zdarzeń silnika. Wyłączony nie zostawia żadnych opakowań ani nasłuchów - zostaje tylko sprawdzenie flagi.
+# Czasy funkcji są łączne, razem z wywołaniami wewnętrznymi (borrow_book zawiera swoje zapytania SQL).
+SQL_STATEMENT_LENGTH = 300  # Długość tekstu zapytania w raporcie
+_SQL_PARAMETER_LISTS = re.compile(r"\?(?:, \?)+|\((?:\?, )*\?\)(?:, \((?:\?, )*\?\))+")
+
+class Profiler:
+    def __init__(self, slow_query_ms=SLOW_QUERY_MS, slow_query_log=SLOW_QUERY_LOG):
+        self.slow_query_ms = slow_query_ms
+        self.slow_query_log = slow_query_log
+        self.enabled = False
+        self.originals = {}  # nazwa -> (klasa albo None dla funkcji modułu, atrybut, oryginał)
+        self.engines = []
+        self.reset()
+
+    # Też po fork: proces potomny liczy od zera
+    def reset(self):
+        self.lock = threading.Lock()
+        self.timings = {"function": {}, "sql": {}, "api": {}}  # nazwa -> [wywołania, czas łączny, czas maksymalny]
+        self.counters = {}
+        self.slow_queries = deque(maxlen=50)
+        self.started_at = datetime.now()
+
+    def observe(self, kind, name, seconds):
+        with self.lock:
+            entry = self.timings[kind].get(name)
+            if entry is None:
+                self.timings[kind][name] = [1, seconds, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+                entry[2] = max(entry[2], seconds)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def timed(self, name, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.observe("function", name, time.perf_counter() - started)
+        return wrapper
+
+    # Nazwy "funkcja" albo "Klasa.metoda"; kod modułu wywołuje funkcje przez nazwy globalne, więc trafia na opakowania
+    def enable(self, names=None):
+        if self.enabled:
+            return
+        namespace = globals()
+        for name in names or PROFILED_FUNCTIONS:
+            owner_name, _, attribute = name.rpartition(".")
+            owner = namespace[owner_name] if owner_name else None
+            original = getattr(owner, attribute) if owner else namespace[attribute]
+            self.originals[name] = (owner, attribute, original)
+            if owner:
+                setattr(owner, attribute, self.timed(name, original))
+            else:
+                namespace[attribute] = self.timed(name, original)
+        # Także silniki oddziałów otwarte przed włączeniem; blokada, żeby branch_engine nie utworzył silnika w międzyczasie
+        with branch_engines_lock:
+            for listened in (engine, *branch_engines.values()):
+                self.listen(listened)
+            self.enabled = True
+
+    def disable(self):
+        if not self.enabled:
+            return
+        namespace = globals()
+        for owner, attribute, original in self.originals.values():
+            if owner:
+                setattr(owner, attribute, original)
+            else:
+                namespace[attribute] = original
+        self.originals.clear()
+        # self.engines to silnik aplikacji i wszystkie silniki oddziałów, które dostały nasłuch
+        with branch_engines_lock:
+            self.enabled = False
+            for listened in self.engines:
+                event.remove(listened, "before_cursor_execute", self.before_cursor_execute)
+                event.remove(listened, "after_cursor_execute", self.after_cursor_execute)
+            self.engines.clear()
+
+    def listen(self, listened):
+        event.listen(listened, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(listened, "after_cursor_execute", self.after_cursor_execute)
+        self.engines.append(listened)
+
+    # Początek zapisujemy w kontekście wykonania (osobnym dla każdego zapytania), a nie w stanie połączenia albo profilera,
+    # więc równoległe zapytania wątków fan_out się nie mieszają, a zapytanie zakończone błędem niczego nie zostawia
+    def before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        context._profile_start = time.perf_counter()
+
+    # Zapytania grupujemy po tekście; listy parametrów (IN, wiele wierszy VALUES) różnej długości liczą się jako jedno zapytanie
+    def after_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_profile_start", None)
+        if started is None:
+            return  # nasłuch dodany przez enable() w trakcie tego zapytania w innym wątku
+        seconds = time.perf_counter() - started
+        statement = _SQL_PARAMETER_LISTS.sub("...", " ".join(statement.split()))
+        self.observe("sql", statement[:SQL_STATEMENT_LENGTH], seconds)
+        if seconds * 1000 >= self.slow_query_ms:
+            self.log_slow_query(statement, seconds, executemany)
+
+    # Bez wartości parametrów - mogłyby zawierać hashe haseł
+    def log_slow_query(self, statement, seconds, executemany):
+        entry = (datetime.now().isoformat(sep=" ", timespec="seconds"), round(seconds * 1000, 1), statement + (" [executemany]" if executemany else ""))
+        with self.lock:
+            self.slow_queries.append(entry)
+            if self.slow_query_log:
+                with open(self.slow_query_log, "a", encoding="utf-8") as log:
+                    log.write(f"{entry[0]}\t{entry[1]} ms\t{entry[2]}\n")
+
+    def snapshot(self):
+        with self.lock:
+            timings = {
+                kind: {name: {"calls": calls, "total_ms": round(total * 1000, 3), "max_ms": round(longest * 1000, 3)}
+                       for name, (calls, total, longest) in entries.items()}
+                for kind, entries in self.timings.items()
+            }
+            return {
+                "started_at": self.started_at.isoformat(timespec="seconds"), "pid": os.getpid(), **timings,
+                "actions": dict(self.counters),
+                "slow_queries": [dict(zip(("at", "ms", "statement"), entry)) for entry in self.slow_queries],
+            }
+
+    # Zapis przez plik tymczasowy - odczytujący nigdy nie zobaczy połowy pliku
+    def write(self, path):
+        temporary = f"{path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as output:
+            json.dump(self.snapshot(), output, ensure_ascii=False, indent=1)
+        os.replace(temporary, path)
+
+    def dump(self):
+        if not self.enabled:
+            return
+        if PROFILE_FILE:
+            self.write(PROFILE_FILE)
+        else:
+            display_profile(self.snapshot())
+
+profiler = Profiler()
+os.register_at_fork(after_in_child=profiler.reset)
+atexit.register(profiler.dump)
+
+def display_profile(snapshot, limit=20):
+    sections = [("function", "Funkcje"), ("sql", "Zapytania SQL"), ("api", "Żądania API")]
+    print(f"Profil procesu {snapshot['pid']} od {snapshot['started_at']}")
+    for kind, title in sections:
+        entries = sorted(snapshot.get(kind, {}).items(), key=lambda item: item[1]["total_ms"], reverse=True)[:limit]
+        if not entries:
+            continue
+        rows = [[name, entry["calls"], f"{entry['total_ms']:.1f}", f"{entry['total_ms'] / entry['calls']:.3f}", f"{entry['max_ms']:.1f}"]
+                for name, entry in entries]
+        print(f"\n{title} (wg czasu łącznego):")
+        print(tabulate(rows, headers=["Nazwa", "Wywołania", "Łącznie [ms]", "Średnio [ms]", "Maks. [ms]"], tablefmt="grid", maxcolwidths=[80, None, None, None, None]))
+    if snapshot.get("actions"):
+        print("\nAkcje:")
+        print(tabulate(sorted(snapshot["actions"].items(), key=lambda item: item[1], reverse=True), headers=["Akcja", "Liczba"], tablefmt="grid"))
+    if snapshot.get("slow_queries"):
+        print("\nWolne zapytania (ostatnie):")
+        rows = [[entry["at"], entry["ms"], entry["statement"]] for entry in snapshot["slow_queries"][-limit:]]
+        print(tabulate(rows, headers=["Kiedy", "Czas [ms]", "Zapytanie"], tablefmt="grid", maxcolwidths=[None, None, 80]))
+
+# Tworzymy fabrykę sesji. expire_on_commit=False pozwala używać obiektów (np. zalogowanego użytkownika) po zamknięciu sesji
+Session = sessionmaker(expire_on_commit=False)
+
+# ODDZIAŁY
+# Każdy oddział ma własną bazę (shard) z pełnym schematem: konta czytelników, ich wypożyczenia i katalog oddziału.
+# current_branch wskazuje oddział bieżącej operacji - session_scope otwiera sesję w jego bazie. Po zalogowaniu to
+# oddział macierzysty konta, więc konto i wypożyczenia zawsze trafiają do jednej bazy, także z terminala innego oddziału.
+# Wyszukiwanie katalogu i dostępności idzie równolegle do wszystkich oddziałów (fan_out) i łączy wyniki.
+current_branch = ContextVar("current_branch", default=None)  # None - oddział tego terminala
+branch_engines = {}  # oddział -> silnik; bazę terminala obsługuje engine
+branch_engines_lock = threading.Lock()
+branch_executor = None
+
+def branch_engine(branch):
+    if branch is None or branch == BRANCH:
+        return engine
+    with branch_engines_lock:
+        if branch not in branch_engines:
+            if branch not in BRANCHES:
+                raise ValueError(f"Nieznany oddział: {branch}")
+            shard = create_library_engine(BRANCHES[branch])
+            if profiler.enabled:
+                profiler.listen(shard)
+            initialize_database(shard)
+            branch_engines[branch] = shard
+        return branch_engines[branch]
+
+def current_engine():
+    return branch_engine(current_branch.get())
+
+def active_branch():
+    return current_branch.get() or BRANCH
+
+def run_in_branch(branch, function, *args):
+    token = current_branch.set(branch)
+    try:
+        return function(*args)
+    finally:
+        current_branch.reset(token)
+
+# Wywołuje function(*args) w każdym z oddziałów (domyślnie we wszystkich) w osobnych wątkach - SQLite zwalnia GIL
+# na czas zapytania. Zwraca [(oddział, wynik, błąd)] w kolejności BRANCHES; niedostępny oddział nie psuje pozostałych wyników.
+# Błędów nie wypisuje - korzysta z niej też API; menu pokazuje je przez print_unavailable_branches.
+def fan_out(function, *args, branches=None):
+    from concurrent.futures import ThreadPoolExecutor
+    global branch_executor
+    branches = list(BRANCHES) if branches is None else branches
+    if branch_executor is None:
+        branch_executor = ThreadPoolExecutor(max_workers=max(4, 2 * len(BRANCHES)), thread_name_prefix="library-branch")
+    futures = [branch_executor.submit(copy_context().run, run_in_branch, branch, function, *args) for branch in branches]
+    results = []
+    for branch, future in zip(branches, futures):
+        try:
+            results.append((branch, future.result(), None))
+        except Exception as error:
+            results.append((branch, None, error))
+    return results
+
+# [(oddział, błąd)] z wyników fan_out
+def unavailable_branches(results):
+    return [(branch, error) for branch, _, error in results if error is not None]
+
+def print_unavailable_branches(unavailable):
+    for branch, error in unavailable:
+        print(f"Oddział {branch} jest niedostępny: {getattr(error, 'orig', None) or error}")
+
+# Po fork proces potomny otwiera własne połączenia i wątki
+def reset_branches():
+    global branch_executor
+    branch_engines.clear()
+    branch_executor = None
+
+os.register_at_fork(after_in_child=reset_branches)
+
+# Podłącza aplikację do bazy pod podanym adresem: silnik, sesje, tabele i migracje
+def configure_database(url):
+    global engine
+    audit_log.flush()  # Zdarzenia z poprzedniej bazy zapisujemy jeszcze do niej
+    audit_log.partitions.clear()
+    engine = create_library_engine(url)
+    if profiler.enabled:
+        profiler.listen(engine)
+    Session.configure(bind=engine)
+    initialize_database(engine)
+    return engine
+
+configure_database(DATABASE_URL)
+
+# Sesja na jedną operację: commit przy sukcesie, rollback przy błędzie, zawsze zwrot połączenia do puli
+@contextmanager
+def session_scope():
+    session = Session(bind=current_engine())
+    try:
+        yield session
+        session.commit()
+        # Unieważnianie po commicie - wcześniej inny wątek mógłby wczytać i zapamiętać stare dane
+        for cache, keys in session.info.pop("invalidate", ()):
+            cache.invalidate(*keys)
+        events = session.info.pop("audit", None)
+        audit_log.record(events, current_branch.get())
+        if profiler.enabled:
+            for entry in events or ():
+                profiler.count(entry[2])  # Akcje liczymy po zdarzeniach dziennika, więc tylko zatwierdzone
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+# PAMIĘĆ PODRĘCZNA
+# LRU z czasem ważności wpisów. Licznik generacji chroni przed zapisaniem wyniku zapytania,
+# które trwało w chwili unieważnienia (wynik mógł już być nieaktualny).
+class LruCache:
+    def __init__(self, name, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # klucz -> (wartość, ważne do)
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    # Zwraca wartość z pamięci albo wczytuje ją funkcją load; None (brak wyniku) nie jest zapamiętywane.
+    # Klucze są osobne dla każdego oddziału - ID z różnych baz się powtarzają.
+    def get(self, key, load):
+        key = (active_branch(), key)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self.generation
+        value = load()
+        with self.lock:
+            if value is not None and generation == self.generation:
+                self.entries[key] = (value, now + self.ttl)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    # Usuwa podane klucze, a bez kluczy czyści całą pamięć
+    def invalidate(self, *keys):
+        with self.lock:
+            self.generation += 1
+            self.invalidations += 1
+            if keys:
+                for key in keys:
+                    self.entries.pop((active_branch(), key), None)
+            else:
+                self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return [self.name, len(self.entries), self.maxsize, self.hits, self.misses,
+                    f"{self.hits / lookups:.1%}" if lookups else "-", self.evictions, self.invalidations]
+
+user_cache = LruCache("użytkownicy")  # klucze ("id", ID) i ("username", nazwa)
+book_cache = LruCache("książki")  # klucz: ID książki
+available_books_cache = LruCache("dostępne książki", maxsize=256)  # klucz: parametry strony listy
+
+# Zapisuje unieważnienie do wykonania po udanym commicie sesji (patrz session_scope)
+def invalidate_after_commit(session, cache, *keys):
+    session.info.setdefault("invalidate", []).append((cache, keys))
 
-# Tworzymy sesję
-Session = sessionmaker(bind=engine)
-session = Session()
+def invalidate_user_after_commit(session, user):
+    invalidate_after_commit(session, user_cache, ("id", user.id), ("username", user.username))
+
+def invalidate_book_after_commit(session, book_id):
+    invalidate_after_commit(session, book_cache, book_id)
+    invalidate_after_commit(session, available_books_cache)
+
+def display_cache_stats():
+    rows = [cache.stats() for cache in (user_cache, book_cache, available_books_cache)]
+    print(tabulate(rows, headers=["Pamięć", "Wpisy", "Limit", "Trafienia", "Chybienia", "Skuteczność", "Wyparte", "Unieważnienia"], tablefmt="grid"))
+
+# LISTY STRONICOWANE
+# Klucze sortowania list; każda lista sortuje dodatkowo po ID, więc (klucz, ID) jednoznacznie wyznacza miejsce na liście
+BOOK_SORT_KEYS = {"id": Book.id, "tytuł": Book.title, "autor": Book.author, "rok": Book.year}
+USER_SORT_KEYS = {"id": User.id, "nazwa": User.username}
+EXTENSION_SORT_KEYS = {"id": ExtensionRequest.id}  # Tylko kolejność zgłoszeń ma indeks częściowy
+
+# Stronicowanie po kluczu (keyset): kolejna strona zaczyna się za ostatnim wierszem poprzedniej,
+# więc każda strona to jedno zapytanie po indeksie z LIMIT, niezależnie od tego, jak daleko jesteśmy.
+# Pobierane są tylko wskazane kolumny (pierwsza musi być ID), bez obiektów ORM.
+# Tytuł, autor i rok mogą być NULL: SQLite (i indeks) stawia NULL przed wszystkimi wartościami, a porównanie (NULL, ID)
+# z kluczem nie jest ani prawdą, ani fałszem - dlatego wiersze z NULL czytamy osobnym zapytaniem (keyset_segments).
+class KeysetPager:
+    def __init__(self, columns, sort_keys, sort="id", conditions=(), page_size=20, descending=False, cache=None):
+        self.columns = columns
+        self.sort_keys = sort_keys
+        self.conditions = conditions
+        self.page_size = page_size
+        self.cache = cache
+        self.sort(sort, descending)
+
+    def sort(self, sort, descending=False):
+        if sort not in self.sort_keys:
+            raise ValueError(f"Nieznany klucz sortowania: {sort}. Dostępne: {', '.join(self.sort_keys)}.")
+        self.sort_name = sort
+        self.descending = descending
+        self.first_key = self.last_key = None
+        self.has_previous = self.has_next = False
+        self.page_number = 0
+
+    def fetch(self, after=None, before=None):
+        def load():
+            sort_column, id_column = self.sort_keys[self.sort_name], self.columns[0]
+            statement = select(*self.columns, sort_column).where(*self.conditions)
+            if after is not None:
+                segments = keyset_segments(sort_column, id_column, after, greater=not self.descending)
+            elif before is not None:
+                segments = keyset_segments(sort_column, id_column, before, greater=self.descending)
+            else:
+                segments = [None]
+            # Poprzednią stronę czytamy w odwrotnej kolejności od jej początku i potem odwracamy
+            backwards = before is not None
+            order = (sort_column.desc(), id_column.desc()) if self.descending != backwards else (sort_column, id_column)
+            rows = []
+            with session_scope() as session:
+                for condition in segments:
+                    if len(rows) > self.page_size:
+                        break
+                    segment = statement if condition is None else statement.where(condition)
+                    rows += [tuple(row) for row in session.execute(segment.order_by(*order).limit(self.page_size + 1 - len(rows)))]
+            has_more = len(rows) > self.page_size
+            rows = rows[:self.page_size]
+            if backwards:
+                rows.reverse()
+            return rows, has_more
+        if self.cache is None:
+            return load()
+        return self.cache.get((self.sort_name, self.descending, after, before, self.page_size), load)
+
+    # Każda metoda zwraca wiersze strony bez kolumny klucza sortowania
+    def first(self):
+        rows, self.has_next = self.fetch()
+        self.has_previous = False
+        self.page_number = 1
+        return self.remember(rows)
+
+    def next(self):
+        if not self.has_next:
+            return None
+        rows, self.has_next = self.fetch(after=self.last_key)
+        self.has_previous = True
+        self.page_number += 1
+        return self.remember(rows)
+
+    def previous(self):
+        if not self.has_previous:
+            return None
+        rows, self.has_previous = self.fetch(before=self.first_key)
+        self.has_next = True
+        self.page_number -= 1
+        return self.remember(rows)
+
+    def remember(self, rows):
+        if rows:
+            self.first_key = (rows[0][-1], rows[0][0])
+            self.last_key = (rows[-1][-1], rows[-1][0])
+        return [row[:-1] for row in rows]
+
+# Warunki na wiersze za kluczem (value, row_id) w kolejności rosnącej (greater) albo przed nim, z NULL mniejszym
+# od każdej wartości. Każdy warunek to zakres jednego indeksu (OR z IS NULL zmusza SQLite do przejrzenia całego indeksu),
+# a fetch czyta je po kolei, aż zapełni stronę - drugie zapytanie jest potrzebne tylko na styku NULL i wartości.
+def keyset_segments(sort_column, id_column, key, greater):
+    value, row_id = key
+    if value is None:
+        if greater:
+            return [and_(sort_column.is_(None), id_column > row_id), sort_column.is_not(None)]
+        return [and_(sort_column.is_(None), id_column < row_id)]
+    if greater:
+        return [tuple_(sort_column, id_column) > tuple_(value, row_id)]
+    return [tuple_(sort_column, id_column) < tuple_(value, row_id), sort_column.is_(None)]
+
+# Wyświetla listę strona po stronie. Formatowana jest tylko bieżąca strona.
+# Z pause=True użytkownik sam przechodzi między stronami i zmienia sortowanie, bez tego lista jest wypisywana do końca.
+def browse_pages(pager, headers, empty_message, format_row=list, pause=False):
+    rows = pager.first()
+    if not rows:
+        print(empty_message)
+        return
+    while True:
+        print(f"Strona {pager.page_number} (sortowanie: {pager.sort_name}{', malejąco' if pager.descending else ''})")
+        print(tabulate([format_row(row) for row in rows], headers=headers, tablefmt="grid"))
+        if not pause:
+            rows = pager.next()
+            if not rows:
+                return
+            continue
+        options = (["n - następna"] if pager.has_next else []) + (["p - poprzednia"] if pager.has_previous else [])
+        choice = input(f"{', '.join(options + ['s - sortowanie', 'Enter - koniec'])}: ").strip().lower()
+        if choice == "n" and pager.has_next:
+            rows = pager.next() or rows
+        elif choice == "p" and pager.has_previous:
+            rows = pager.previous() or rows
+        elif choice == "s":
+            sort = input(f"Sortuj według ({', '.join(pager.sort_keys)}), dodaj '-' dla malejącego, np. -rok: ").strip().lower()
+            try:
+                pager.sort(sort.lstrip("-") or "id", sort.startswith("-"))
+            except ValueError as error:
+                print(error)
+            rows = pager.first() or rows
+        elif choice in ("", "q", "esc"):
+            return
 
 #Czyszczenie terminala
 def clear_terminal():
     os.system('cls' if os.name == 'nt' else 'clear')
 
 
+#HASŁA
+# bcrypt to kilkaset milisekund czystego CPU na hasło, więc liczymy go w osobnych procesach.
+# Wątek wywołujący tylko czeka na wynik, a logowania z wielu wątków rozkładają się na rdzenie.
+password_pool = None
+
+def configure_password_hashing(rounds=None, workers=None):
+    global BCRYPT_ROUNDS, PASSWORD_WORKERS, password_pool
+    if rounds is not None:
+        if not 4 <= rounds <= 31:
+            raise ValueError("Koszt bcrypt musi być z zakresu 4-31.")
+        BCRYPT_ROUNDS = rounds
+    if workers is not None:
+        PASSWORD_WORKERS = workers
+        if password_pool is not None:
+            password_pool.shutdown()
+            password_pool = None
+
+# Procesy pula uruchamia dopiero przy pierwszym haśle, gdy działają już wątki (dziennik zdarzeń, API, oddziały),
+# a fork procesu z wątkami może skopiować blokadę trzymaną przez inny wątek. Dlatego procesy powstają przez forkserver
+# (czysty, jednowątkowy proces, z którego forkujemy), a w Windows przez spawn.
+# Procesy wykonują na nowo kod modułu głównego (jako __mp_main__, bez menu i poleceń spod if __name__ == "__main__")
+# i kończą się przez os._exit, więc nie uruchamiają procedur atexit, np. zapisu profilu. Do procesów trafiają wprost funkcje bcrypt.
+def get_password_pool():
+    global password_pool
+    if password_pool is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        password_pool = ProcessPoolExecutor(max_workers=PASSWORD_WORKERS or os.cpu_count(), mp_context=multiprocessing.get_context(method))
+    return password_pool
+
+def hash_password(password):
+    import bcrypt
+    return get_password_pool().submit(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS)).result()
+
+def check_password(password, password_hash):
+    import bcrypt
+    return get_password_pool().submit(bcrypt.checkpw, password.encode('utf-8'), as_bytes(password_hash)).result()
+
+def as_bytes(password_hash):
+    return password_hash.encode('ascii') if isinstance(password_hash, str) else password_hash
+
+# Hash ma postać $2b$<koszt>$<sól+skrót>; inny koszt niż bieżący oznacza, że trzeba go przeliczyć
+def password_needs_rehash(password_hash):
+    return int(as_bytes(password_hash).split(b"$")[2]) != BCRYPT_ROUNDS
+
+
 #FUNKCJE DOT. UZYTKOWNIKÓW
 # Prosta funkcja do rejestracji użytkownika
 def register_user(username, password, is_admin=False):
-    existing_user = session.query(User).filter_by(username=username).first()
-    if existing_user:
+    # Nazwa konta jest unikalna we wszystkich oddziałach - po niej logowanie znajduje oddział macierzysty
+    if BRANCHES and find_user_branch(username) is not None:
         print("Użytkownik o tej nazwie już istnieje.")
-        return
-    else:
-        password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())  # Haszujemy hasło
+        return False
+    with session_scope() as session:
+        existing_user = session.query(User).filter_by(username=username).first()
+        if existing_user:
+            print("Użytkownik o tej nazwie już istnieje.")
+            return False
+        password_hash = hash_password(password)  # Haszujemy hasło
         user = User(username=username, password_hash=password_hash, is_admin=is_admin)
         session.add(user)
-        session.commit()
+        session.flush()
+        audit_after_commit(session, "user.create", "user", user.id, after={"username": username, "is_admin": is_admin})
+    # Sprawdzenie i zapis są w różnych bazach, więc dwa terminale mogą w tej samej chwili założyć tę nazwę w dwóch oddziałach.
+    # Po zatwierdzeniu sprawdzamy pozostałe oddziały jeszcze raz i przy konflikcie usuwamy własne konto: to sprawdzenie,
+    # które nastąpi później, zawsze widzi oba konta. Najwyżej oba terminale wycofają rejestrację i trzeba ją powtórzyć.
+    # Niedostępny oddział uznajemy za wolny od konfliktu - unikalność jest wtedy tylko tak dobra, jak dostępność oddziałów.
+    others = [branch for branch in BRANCHES if branch != active_branch()]
+    if others and any(found is not None for _, found, _ in fan_out(get_user_by_username, username, branches=others)):
+        with session_scope() as session:
+            session.delete(session.get(User, user.id))
+            invalidate_user_after_commit(session, user)
+            audit_after_commit(session, "user.delete", "user", user.id, before={"username": username, "is_admin": is_admin},
+                               after={"reason": "nazwa zajęta w innym oddziale"})
+        print("Użytkownik o tej nazwie już istnieje.")
+        return False
+    return True
 
 # Prosta funkcja do logowania użytkownika
 def login_user(username, password):
-    user = session.query(User).filter_by(username=username).first()
-    if user and bcrypt.checkpw(password.encode('utf-8'), user.password_hash):
-        return user
+    user = get_user_by_username(username)
+    if not user or not check_password(password, user.password_hash):
+        return None
+    # Hash z nieaktualnym kosztem przeliczamy przy logowaniu, bo tylko wtedy znamy hasło.
+    # Warunek na stary hash chroni przed nadpisaniem hasła zmienionego w międzyczasie.
+    if password_needs_rehash(user.password_hash):
+        new_hash = hash_password(password)
+        with session_scope() as session:
+            session.execute(
+                update(User)
+                .where(User.id == user.id, User.password_hash == user.password_hash)
+                .values(password_hash=new_hash)
+                .execution_options(synchronize_session=False)
+            )
+            invalidate_user_after_commit(session, user)
+            audit_after_commit(session, "user.password_rehash", "user", user.id)
+    return user
+
+# Oddział macierzysty konta: najpierw oddział terminala, potem równolegle pozostałe. None - nie ma takiego konta
+# (albo jest tylko jedna baza; niedostępny oddział też nie ma kont). Logowanie ustawia ten oddział jako current_branch.
+def find_user_branch(username):
+    if not BRANCHES:
+        return None
+    if run_in_branch(BRANCH, get_user_by_username, username) is not None:
+        return BRANCH
+    for branch, user, _ in fan_out(get_user_by_username, username, branches=[branch for branch in BRANCHES if branch != BRANCH]):
+        if user is not None:
+            return branch
     return None
 
+# Pobiera użytkownika po ID (obiekt odłączony od sesji, tylko do odczytu - współdzielony przez pamięć podręczną)
+def get_user(user_id):
+    def load():
+        with session_scope() as session:
+            return session.query(User).filter_by(id=user_id).first()
+    return user_cache.get(("id", user_id), load)
+
+def get_user_by_username(username):
+    def load():
+        with session_scope() as session:
+            return session.query(User).filter_by(username=username).first()
+    return user_cache.get(("username", username), load)
 
-def display_all_users():
-    users = session.query(User).all()
-    if users:
-        user_data = []
-        for user in users:
-            user_data.append([user.id, user.username, user.name, user.surname, 'Tak' if user.is_admin else 'Nie', 'Tak' if user.activated else 'Nie', 'Tak' if user.blocked else 'Nie'])
-        headers = ["ID", "Nazwa użytkownika", "Imię", "Nazwisko", "Administrator", "Aktywowany", "Zablokowany"]
-        print(tabulate(user_data, headers=headers, tablefmt="grid"))
-    else:
-        print("Brak użytkowników w bazie danych.")
+
+def display_all_users(sort="id", descending=False, page_size=20, pause=False):
+    pager = KeysetPager(
+        [User.id, User.username, User.name, User.surname, User.is_admin, User.activated, User.blocked],
+        USER_SORT_KEYS, sort, page_size=page_size, descending=descending
+    )
+    headers = ["ID", "Nazwa użytkownika", "Imię", "Nazwisko", "Administrator", "Aktywowany", "Zablokowany"]
+    browse_pages(pager, headers, "Brak użytkowników w bazie danych.", pause=pause, format_row=lambda row: [
+        *row[:4], *('Tak' if flag else 'Nie' for flag in row[4:])
+    ])
 
 
 def delete_user(username):
-    user = session.query(User).filter_by(username=username).first()
-    if user:
-        session.delete(user)
-        session.commit()
-        print(f"Użytkownik {username} został pomyślnie usunięty.")
-    else:
-        print("Nie ma użytkownika o podanej nazwie.")
+    with session_scope() as session:
+        user = session.query(User).filter_by(username=username).first()
+        if user:
+            cancel_waiting_holds(session, Hold.user_id == user.id)
+            session.delete(user)
+            invalidate_user_after_commit(session, user)
+            audit_after_commit(session, "user.delete", "user", user.id, before={
+                "username": user.username, "name": user.name, "surname": user.surname,
+                "is_admin": user.is_admin, "activated": user.activated, "blocked": user.blocked,
+            })
+            print(f"Użytkownik {username} został pomyślnie usunięty.")
+            return True
+        else:
+            print("Nie ma użytkownika o podanej nazwie.")
+            return False
 
 def change_password_by_admin(user_id, new_password):
-    user = session.query(User).filter_by(id=user_id).first()
-    if user:
-        password_hash = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
-        user.password_hash = password_hash
-        session.commit()
-        print(f"Hasło dla użytkownika o ID {user_id} zostało pomyślnie zmienione.")
-    else:
-        print("Nie ma użytkownika o podanym ID.")
+    password_hash = hash_password(new_password)  # Poza sesją, żeby nie trzymać połączenia podczas haszowania
+    with session_scope() as session:
+        user = session.query(User).filter_by(id=user_id).first()
+        if user:
+            user.password_hash = password_hash
+            invalidate_user_after_commit(session, user)
+            audit_after_commit(session, "user.password_reset", "user", user.id)  # Bez skrótu hasła
+            print(f"Hasło dla użytkownika o ID {user_id} zostało pomyślnie zmienione.")
+            return True
+        else:
+            print("Nie ma użytkownika o podanym ID.")
+            return False
 
 # Funkcja do zmiany pola activated przez administratora
 def change_activated_status(user_id, activated):
-    user = session.query(User).filter_by(id=user_id).first()
-    if user:
-        user.activated = activated
-        session.commit()
-        print(f"Status aktywacji dla użytkownika o ID {user_id} został zmieniony.")
-    else:
-        print("Nie ma użytkownika o podanym ID.")
+    with session_scope() as session:
+        user = session.query(User).filter_by(id=user_id).first()
+        if user:
+            audit_after_commit(session, "user.activated", "user", user.id, {"activated": user.activated}, {"activated": activated})
+            user.activated = activated
+            invalidate_user_after_commit(session, user)
+            print(f"Status aktywacji dla użytkownika o ID {user_id} został zmieniony.")
+            return True
+        else:
+            print("Nie ma użytkownika o podanym ID.")
+            return False
 
 # Funkcja do zmiany pola blocked przez administratora
 def change_blocked_status(user_id, blocked):
-    user = session.query(User).filter_by(id=user_id).first()
-    if user:
-        user.blocked = blocked
-        session.commit()
-        print(f"Status blokady dla użytkownika o ID {user_id} został zmieniony.")
-    else:
-        print("Nie ma użytkownika o podanym ID.")
+    with session_scope() as session:
+        user = session.query(User).filter_by(id=user_id).first()
+        if user:
+            audit_after_commit(session, "user.blocked", "user", user.id, {"blocked": user.blocked}, {"blocked": blocked})
+            user.blocked = blocked
+            invalidate_user_after_commit(session, user)
+            print(f"Status blokady dla użytkownika o ID {user_id} został zmieniony.")
+            return True
+        else:
+            print("Nie ma użytkownika o podanym ID.")
+            return False
 
 
+# Zwraca zaktualizowanego użytkownika (nowy obiekt) albo None, gdy zmiana się nie udała. Przekazany obiekt może być
+# współdzielony przez pamięć podręczną, więc zmieniamy wiersz wczytany w sesji, a pamięć unieważniamy dopiero po commicie.
 def edit_user_data(user, name=None, surname=None, is_admin=None, username=None):
+    changes = {}
     if name is not None:
-        user.name = name
+        changes["name"] = name
     if surname is not None:
-        user.surname = surname
+        changes["surname"] = surname
     if is_admin is not None:
-        user.is_admin = is_admin
+        changes["is_admin"] = is_admin
     if username is not None:
-        user.username = username
-    session.commit()
+        changes["username"] = username
+    if not changes:
+        print("Dane użytkownika zostały pomyślnie zaktualizowane.")
+        return user
+    # Nazwa konta jest unikalna we wszystkich oddziałach (jak przy rejestracji)
+    if username is not None and username != user.username and BRANCHES and find_user_branch(username) is not None:
+        print("Użytkownik o tej nazwie już istnieje.")
+        return None
+    try:
+        with session_scope() as session:
+            edited = session.get(User, user.id)
+            if edited is None:
+                print("Nie ma użytkownika o podanym ID.")
+                return None
+            before = {field: getattr(edited, field) for field in changes}
+            for field, value in changes.items():
+                setattr(edited, field, value)
+            session.flush()
+            # Stara i nowa nazwa - pod nową mógł zostać wpis konta, które wcześniej ją nosiło
+            invalidate_after_commit(session, user_cache, ("id", edited.id), ("username", before.get("username", edited.username)), ("username", edited.username))
+            audit_after_commit(session, "user.edit", "user", edited.id, before, changes)
+    except IntegrityError:
+        print("Użytkownik o tej nazwie już istnieje.")
+        return None
     print("Dane użytkownika zostały pomyślnie zaktualizowane.")
+    return edited
+
+
+# Użytkownicy, w których nazwie, imieniu lub nazwisku występują wszystkie słowa frazy (bez względu na wielkość liter
+# i polskie znaki). Słowa od 3 znaków szuka indeks trigramów, krótsza fraza wymaga skanu LIKE. Liczba jest dokładnym ID.
+def find_users(search_term, limit=100):
+    search_term = search_term.strip()
+    words = re.findall(r'\w+', fold_text(search_term))
+    with session_scope() as session:
+        users = []
+        if search_term.isdigit():
+            user = session.get(User, int(search_term))
+            users = [user] if user else []
+        if words and all(len(word) >= 3 for word in words):
+            ids = session.execute(text(
+                "SELECT rowid FROM users_trigram WHERE users_trigram MATCH :query ORDER BY rowid LIMIT :limit"
+            ), {"query": " AND ".join(f'"{word}"' for word in words), "limit": limit}).scalars().all()
+            users += session.query(User).filter(User.id.in_(ids)).order_by(User.id).all() if ids else []
+        elif search_term:
+            search = f"%{search_term}%"
+            users += session.query(User).filter(
+                User.username.like(search) | User.name.like(search) | User.surname.like(search)
+            ).order_by(User.id).limit(limit).all()
+    return list({user.id: user for user in users}.values())[:limit]
+
+def format_user(user):
+    return [user.id, user.username, user.name, user.surname, 'Tak' if user.is_admin else 'Nie', 'Tak' if user.activated else 'Nie', 'Tak' if user.blocked else 'Nie']
 
+USER_HEADERS = ["ID", "Nazwa użytkownika", "Imię", "Nazwisko", "Administrator", "Aktywowany", "Zablokowany"]
 
-def search_user(search_term):
-    search = f"%{search_term}%"
-    users = session.query(User).filter(
-        (User.id.like(search)) |
-        (User.username.like(search)) |
-        (User.name.like(search)) |
-        (User.surname.like(search))
-    ).all()
+def search_user(search_term, limit=100):
+    users = find_users(search_term, limit)
     if users:
-        user_data = []
-        for user in users:
-            user_data.append([user.id, user.username, user.name, user.surname, 'Tak' if user.is_admin else 'Nie', 'Tak' if user.activated else 'Nie', 'Tak' if user.blocked else 'Nie'])
-        headers = ["ID", "Nazwa użytkownika", "Imię", "Nazwisko", "Administrator", "Aktywowany", "Zablokowany"]
-        print(tabulate(user_data, headers=headers, tablefmt="grid"))
+        print(tabulate([format_user(user) for user in users], headers=USER_HEADERS, tablefmt="grid"))
+        if len(users) == limit:
+            print(f"Wyświetlono pierwszych {limit} wyników, zawęź frazę.")
+        return
+    similar = find_similar_users(search_term)
+    if similar:
+        print("Nie znaleziono użytkownika pasującego do podanej frazy. Podobni użytkownicy:")
+        print(tabulate([format_user(user) + [f"{score:.0%}"] for user, score in similar], headers=USER_HEADERS + ["Podobieństwo"], tablefmt="grid"))
     else:
         print("Nie znaleziono użytkownika pasującego do podanej frazy.")
 
-def search_book(search_term):
-    search = f"%{search_term}%"
-    books = session.query(Book).filter(
-        (Book.id.like(search)) |
-        (Book.title.like(search)) |
-        (Book.year.like(search)) |
-        (Book.author.like(search))
-    ).all()
+# WYSZUKIWANIE PRZYBLIŻONE
+# Kandydatów wskazuje indeks trigramów (users_trigram, books_trigram): wiersze mające choć jeden trigram słów frazy,
+# najpierw te z rzadszymi i liczniejszymi trigramami (bm25). Kandydatów oceniamy dokładnie: podobieństwo to część
+# trigramów frazy obecnych w tekście (jak word_similarity w pg_trgm), a przy remisie wygrywa tekst bliższy długością.
+FUZZY_CANDIDATES = 100  # Kandydaci z indeksu oceniani dokładnie
+FUZZY_POSTINGS = 10000  # Limit wierszy z pasującymi trigramami - bardzo częste trigramy pomijamy
+FUZZY_MIN_SIMILARITY = 0.4
+
+# Trigramy słów z dopełnieniem spacjami, więc początek i koniec słowa też się liczą ("ala" -> "  a", " al", "ala", "la ")
+def word_trigrams(value):
+    result = set()
+    for word in re.findall(r'\w+', fold_text(value)):
+        padded = f"  {word} "
+        result.update(padded[index:index + 3] for index in range(len(padded) - 2))
+    return result
+
+def fuzzy_candidates(session, index, search_term, limit=FUZZY_CANDIDATES):
+    # Indeks zna tylko trigramy wewnątrz tekstu, bez dopełnienia
+    trigrams = {word[index:index + 3] for word in re.findall(r'\w+', fold_text(search_term)) for index in range(len(word) - 2)}
+    if not trigrams:
+        return []
+    frequencies = session.execute(text(f"SELECT term, doc FROM {index}_vocab WHERE term IN :terms").bindparams(
+        bindparam("terms", expanding=True)), {"terms": sorted(trigrams)}).all()
+    # Od najrzadszych: najlepiej odróżniają wiersze, a ich listy w indeksie są krótkie
+    selected, postings = [], 0
+    for term, documents in sorted(frequencies, key=lambda row: row[1]):
+        if selected and postings + documents > FUZZY_POSTINGS:
+            break
+        selected.append(term)
+        postings += documents
+    if not selected:
+        return []
+    return session.execute(text(f"SELECT rowid FROM {index} WHERE {index} MATCH :query ORDER BY rank LIMIT :limit"),
+                           {"query": " OR ".join(f'"{term}"' for term in selected), "limit": limit}).scalars().all()
+
+# Zwraca listę (podobieństwo, wiersz) od najbardziej podobnych; describe(wiersz) to tekst porównywany z frazą
+def rank_similar(search_term, rows, describe, limit):
+    query = word_trigrams(search_term)
+    scored = []
+    for row in rows:
+        found = word_trigrams(describe(row))
+        common = len(query & found)
+        if common / len(query) >= FUZZY_MIN_SIMILARITY:
+            scored.append((common / len(query), common / len(query | found), row))
+    scored.sort(key=lambda entry: (-entry[0], -entry[1]))
+    return [(row, similarity) for similarity, _, row in scored[:limit]]
+
+def find_similar_users(search_term, limit=20):
+    with session_scope() as session:
+        ids = fuzzy_candidates(session, "users_trigram", search_term)
+        users = session.query(User).filter(User.id.in_(ids)).all() if ids else []
+    return rank_similar(search_term, users, lambda user: f"{user.username} {user.name} {user.surname}", limit)
+
+# Wiersze jak w find_books: (id, tytuł, autor, rok, wolne, wszystkie)
+def find_similar_books(search_term, limit=20):
+    with session_scope() as session:
+        ids = fuzzy_candidates(session, "books_trigram", search_term)
+        books = session.execute(select(Book.id, Book.title, Book.author, Book.year, Book.available, Book.copies).where(Book.id.in_(ids))).all() if ids else []
+    return [(tuple(book), similarity) for book, similarity in rank_similar(search_term, books, lambda book: f"{book.title} {book.author}", limit)]
+
+# Zamienia frazę na zapytanie FTS5: każde słowo musi wystąpić, dopasowanie po prefiksie
+def build_fts_query(search_term):
+    words = re.findall(r'\w+', fold_text(search_term))
+    return ' '.join(f'"{word}"*' for word in words)
+
+# Zwraca listę (id, tytuł, autor, rok) posortowaną od najlepiej pasujących
+def find_books(search_term, limit=100):
+    search_term = search_term.strip()
+    results = []
+    with session_scope() as session:
+        if search_term.isdigit():
+            # ID i rok to dokładne dopasowania po kluczu/indeksie, a nie skan LIKE
+            number = int(search_term)
+            columns = session.query(Book.id, Book.title, Book.author, Book.year, Book.available, Book.copies)
+            book = get_book(number)
+            if book is not None:
+                results.append((book.id, book.title, book.author, book.year, book.available, book.copies))
+            results.extend(columns.filter(Book.year == number, Book.id != number).order_by(Book.id).limit(limit).all())
+        fts_query = build_fts_query(search_term)
+        if fts_query and len(results) < limit:
+            rows = session.execute(text(
+                "SELECT b.id, b.title, b.author, b.year, b.available, b.copies FROM books_fts "
+                "JOIN books b ON b.id = books_fts.rowid "
+                "WHERE books_fts MATCH :query "
+                "ORDER BY bm25(books_fts, 2.0, 1.0), b.id LIMIT :limit"
+            ), {"query": fts_query, "limit": limit}).all()
+            found = {row[0] for row in results}
+            results.extend(row for row in rows if row[0] not in found)
+    return [tuple(row) for row in results[:limit]]
+
+# Wyszukiwanie we wszystkich oddziałach: wiersze (oddział, id, tytuł, autor, rok, wolne, wszystkie).
+# Trafność bm25 zależy od statystyk indeksu danej bazy, więc wyniki oddziałów łączymy na przemian według miejsca
+# (pierwsze wyniki każdego oddziału, potem drugie...), a nie według ocen. Zwraca (wiersze, niedostępne oddziały).
+def find_books_in_branches(search_term, limit=100):
+    found = fan_out(find_books, search_term, limit)
+    results = [[(branch, *book) for book in books] for branch, books, _ in found if books]
+    merged = []
+    for rank in range(max(map(len, results), default=0)):
+        merged.extend(books[rank] for books in results if rank < len(books))
+    return merged[:limit], unavailable_branches(found)
+
+# Podobieństwo trigramów nie zależy od bazy, więc podobne tytuły z oddziałów łączymy według oceny
+def find_similar_books_in_branches(search_term, limit=20):
+    found = fan_out(find_similar_books, search_term, limit)
+    similar = [((branch, *book), similarity) for branch, books, _ in found for book, similarity in books or ()]
+    return sorted(similar, key=lambda entry: -entry[1])[:limit], unavailable_branches(found)
+
+# Wolne egzemplarze tytułu (ten sam tytuł i autor) w pozostałych oddziałach: [(oddział, wolne, wszystkie)]
+def find_book_in_other_branches(title, author):
+    def count_copies():
+        with session_scope() as session:
+            return session.execute(
+                select(func.coalesce(func.sum(Book.available), 0), func.coalesce(func.sum(Book.copies), 0))
+                .where(Book.title == title, Book.author == author)
+            ).one()
+    return [(branch, *counts) for branch, counts, _ in fan_out(count_copies, branches=[branch for branch in BRANCHES if branch != active_branch()])
+            if counts and counts[1]]
+
+def search_book(search_term, limit=100):
+    # Z oddziałami wyniki obejmują wszystkie oddziały, z dodatkową kolumną "Oddział"
+    branch_headers = ["Oddział"] if BRANCHES else []
+    books, unavailable = find_books_in_branches(search_term, limit) if BRANCHES else (find_books(search_term, limit), [])
+    print_unavailable_branches(unavailable)
     if books:
-        book_data = []
-        for book in books:
-            book_data.append([book.id, book.title, book.author, book.year])
-        headers = ["ID", "Tytuł", "Autor", "Rok"]
-        print(tabulate(book_data, headers=headers, tablefmt="grid"))
+        headers = branch_headers + ["ID", "Tytuł", "Autor", "Rok", "Dostępne"]
+        print(tabulate([format_availability(book) for book in books], headers=headers, tablefmt="grid"))
+        if len(books) == limit:
+            print(f"Wyświetlono {limit} najlepiej pasujących wyników, zawęź frazę.")
+        return
+    similar = find_similar_books_in_branches(search_term)[0] if BRANCHES else find_similar_books(search_term)  # Niedostępne już wypisane
+    if similar:
+        print("Nie znaleziono książki pasującej do podanej frazy. Czy chodziło o:")
+        rows = [format_availability(book) + [f"{similarity:.0%}"] for book, similarity in similar]
+        print(tabulate(rows, headers=branch_headers + ["ID", "Tytuł", "Autor", "Rok", "Dostępne", "Podobieństwo"], tablefmt="grid"))
     else:
         print("Nie znaleziono książki pasującej do podanej frazy.")
 
+# Wiersz (ID, tytuł, autor, rok, wolne, wszystkie) z dostępnością w postaci "N z M"
+def format_availability(row):
+    return [*row[:-2], f"{row[-2]} z {row[-1]}"]
+
+# Zwraca otwarte wypożyczenia użytkownika jednym zapytaniem: (id, tytuł, autor, rok, data wypożyczenia, termin zwrotu)
+def find_user_loans(user_id):
+    with session_scope() as session:
+        return session.query(
+            Book.id, Book.title, Book.author, Book.year, Transaction.borrowed_at, Transaction.due_date
+        ).join(Transaction, Transaction.book_id == Book.id).join(Copy, Copy.id == Transaction.copy_id).filter(
+            Transaction.user_id == user_id,
+            Transaction.returned_at.is_(None),
+            Copy.user_id == user_id
+        ).order_by(Transaction.due_date, Book.id).all()
+
 def display_user_books(user_id):
-    user = session.query(User).filter_by(id=user_id).first()
-    if user:
-        user_books = user.books
-        if user_books:
-            book_data = []
-            for book in user_books:
-                transaction = session.query(Transaction).filter_by(book_id=book.id, user_id=user.id, returned_at=None).first()
-                if transaction:
-                    borrowed_at = transaction.borrowed_at if isinstance(transaction.borrowed_at, datetime) else datetime.strptime(transaction.borrowed_at, "%Y-%m-%d %H:%M:%S.%f")
-                    due_date = transaction.due_date if isinstance(transaction.due_date, datetime) else datetime.strptime(transaction.due_date, "%Y-%m-%d %H:%M:%S.%f")
-                    days_left = (due_date - datetime.now()).days
-                    row = [book.id, book.title, book.author, book.year, borrowed_at.strftime("%Y-%m-%d"), due_date.strftime("%Y-%m-%d")]
-                    if days_left < 7:
-                        row = [f"\033[91m{col}\033[0m" for col in row]  # Kolorowanie na czerwono
-                        print("Dobiega koniec terminu wypożyczenia!")
-                    book_data.append(row)
-            headers = ["ID", "Tytuł", "Autor", "Rok", "Data wypożyczenia", "Termin zwrotu"]
-            print(tabulate(book_data, headers=headers, tablefmt="grid"))
-        else:
-            print("Nie masz wypożyczonych książek.")
+    loans = find_user_loans(user_id)
+    if loans:
+        now = datetime.now()
+        book_data = []
+        for book_id, title, author, year, borrowed_at, due_date in loans:
+            # Kolumny DateTime z zapytania zawsze wracają jako datetime
+            days_left = (due_date - now).days
+            row = [book_id, title, author, year, borrowed_at.strftime("%Y-%m-%d"), due_date.strftime("%Y-%m-%d")]
+            if days_left < 7:
+                row = [f"\033[91m{col}\033[0m" for col in row]  # Kolorowanie na czerwono
+                print("Dobiega koniec terminu wypożyczenia!")
+            book_data.append(row)
+        headers = ["ID", "Tytuł", "Autor", "Rok", "Data wypożyczenia", "Termin zwrotu"]
+        print(tabulate(book_data, headers=headers, tablefmt="grid"))
+    elif get_user(user_id):
+        print("Nie masz wypożyczonych książek.")
     else:
         print("Nie ma użytkownika o podanym ID.")
 
 
 def change_password(user_id, new_password):
-    user = session.query(User).filter_by(id=user_id).first()
-    if user:
-        password_hash = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
-        user.password_hash = password_hash
-        session.commit()
-        print("Hasło zostało pomyślnie zmienione.")
-    else:
-        print("Nie ma użytkownika o podanym ID.")
+    password_hash = hash_password(new_password)  # Poza sesją, żeby nie trzymać połączenia podczas haszowania
+    with session_scope() as session:
+        user = session.query(User).filter_by(id=user_id).first()
+        if user:
+            user.password_hash = password_hash
+            invalidate_user_after_commit(session, user)
+            audit_after_commit(session, "user.password_change", "user", user.id)
+            print("Hasło zostało pomyślnie zmienione.")
+            return True
+        else:
+            print("Nie ma użytkownika o podanym ID.")
+            return False
 
 
 def count_user_borrowed_books(user_id):
-    return session.query(func.count(Transaction.id)).filter_by(user_id=user_id, returned_at=None).scalar()
+    with session_scope() as session:
+        return session.query(UserStats.borrowed).filter_by(user_id=user_id).scalar() or 0
 
 
 
 
 # FUNKCJE DOT. KSIĄŻEK
+LOAN_DAYS = 5  # Okres wypożyczenia
+HOLD_DAYS = 30  # Czas oczekiwania rezerwacji w kolejce
+
+# Jedno zapytanie zajmuje pierwszy wolny egzemplarz, o ile czytelnik nie ma już egzemplarza tego tytułu.
+# SQLite wykonuje zapisy po kolei, więc dwa wypożyczenia nie dostaną tego samego egzemplarza.
+# Zwraca ID egzemplarza albo None.
+def claim_copy(session, book_id, user_id):
+    free_copy, own_copy = aliased(Copy), aliased(Copy)
+    return session.execute(
+        update(Copy).where(
+            Copy.id == select(free_copy.id).where(free_copy.book_id == book_id, free_copy.user_id.is_(None)).limit(1).scalar_subquery(),
+            Copy.user_id.is_(None),
+            ~select(own_copy.id).where(own_copy.book_id == book_id, own_copy.user_id == user_id).exists(),
+        ).values(user_id=user_id).returning(Copy.id),
+        execution_options={"synchronize_session": False}
+    ).scalar()
+
+def start_loan(session, book_id, copy_id, user_id):
+    due_date = (datetime.now() + timedelta(days=LOAN_DAYS)).replace(microsecond=0)
+    transaction = Transaction(book_id=book_id, copy_id=copy_id, user_id=user_id, due_date=due_date)
+    session.add(transaction)
+    return transaction
+
+# Wypożyczenie to jeden warunkowy UPDATE (tylko gdy książka jest wolna) i wpis transakcji w tej samej transakcji bazy.
+# Gdy dwa terminale wypożyczają ten sam egzemplarz, UPDATE zmieni wiersz tylko u jednego z nich.
+# Zwraca True, jeśli wypożyczenie się udało.
 def borrow_book(user, book_id):
     if user.blocked == True:
         print("Twoje konto jest zablokowane, nie możesz korzystać w pełni z biblioteki.")
+        return False
+    try:
+        book_id = int(book_id)
+    except ValueError:
+        print("Podano nieprawidłowe ID książki.")
+        return False
+    try:
+        with session_scope() as session:
+            copy_id = claim_copy(session, book_id, user.id)
+            if copy_id is not None:
+                invalidate_book_after_commit(session, book_id)
+                start_loan(session, book_id, copy_id, user.id)
+                audit_after_commit(session, "loan.borrow", "book", book_id, after={"copy_id": copy_id, "user_id": user.id})
+                # Rezerwacja tego tytułu przestaje być potrzebna
+                session.execute(
+                    update(Hold).where(Hold.user_id == user.id, Hold.book_id == book_id, Hold.status == 'waiting')
+                    .values(status='fulfilled', closed_at=datetime.now()),
+                    execution_options={"synchronize_session": False}
+                )
+                print("Wypożyczono książkę.")
+                return True
+            exists = session.query(Book.id).filter_by(id=book_id).first()
+            has_copy = session.query(Copy.id).filter_by(book_id=book_id, user_id=user.id).first()
+    except IntegrityError:
+        # Egzemplarz ma już otwarte wypożyczenie (ux_transactions_open_copy) - całość została wycofana
+        exists, has_copy = True, False
+    if has_copy:
+        print("Masz już wypożyczony egzemplarz tej książki.")
+    elif exists:
+        print("Wszystkie egzemplarze tej książki są wypożyczone.")
+        book = get_book(book_id) if BRANCHES else None
+        elsewhere = [f"{branch} ({available} z {copies})" for branch, available, copies in find_book_in_other_branches(book.title, book.author)
+                     if available] if book else []
+        if elsewhere:
+            print(f"Wolne egzemplarze w innych oddziałach: {', '.join(elsewhere)}.")
     else:
-        try:
-            book_id = int(book_id)
-            book = session.query(Book).filter_by(id=book_id).first()
-            if book:
-                if book.user_id is None:
-                    book.user_id = user.id
-                    due_date = (datetime.now() + timedelta(days=5)).replace(microsecond=0)
-                    session.add(Transaction(book_id=book.id, user_id=user.id, due_date=due_date))
-                    session.commit()
-                    print("Wypożyczono książkę.")
-                else:
-                    print("Książka jest już wypożyczona.")
-            else:
-                print("Książka o podanym ID nie istnieje.")
-        except ValueError:
-            print("Podano nieprawidłowe ID książki.")
+        print("Książka o podanym ID nie istnieje.")
+    return False
 
-# Funkcja do oddawania książki
+# Funkcja do oddawania książki. Zwraca True, jeśli zwrot się udał.
 def return_book(user, book_id):
     if user.blocked == True:
         print("Twoje konto jest zablokowane, nie możesz korzystać w pełni z biblioteki.")
+        return False
+    try:
+        book_id = int(book_id)
+    except ValueError:
+        print("Podano nieprawidłowe ID książki.")
+        return False
+    with session_scope() as session:
+        copy_ids = session.execute(
+            update(Copy).where(Copy.book_id == book_id, Copy.user_id == user.id).values(user_id=None).returning(Copy.id),
+            execution_options={"synchronize_session": False}
+        ).scalars().all()
+        released = bool(copy_ids)
+        if released:
+            invalidate_book_after_commit(session, book_id)
+            audit_after_commit(session, "loan.return", "book", book_id, before={"copy_ids": copy_ids, "user_id": user.id})
+            session.execute(
+                update(Transaction).where(
+                    Transaction.copy_id.in_(copy_ids), Transaction.user_id == user.id, Transaction.returned_at.is_(None)
+                ).values(returned_at=datetime.now()),
+                execution_options={"synchronize_session": False}
+            )
+            # Po zwrocie prośba o przedłużenie jest bezprzedmiotowa i znika z kolejki administratora
+            request_ids = session.execute(
+                update(ExtensionRequest).where(
+                    ExtensionRequest.user_id == user.id, ExtensionRequest.status == 'pending',
+                    ExtensionRequest.transaction_id.in_(select(Transaction.id).where(Transaction.copy_id.in_(copy_ids), Transaction.user_id == user.id))
+                ).values(status='cancelled', decided_at=datetime.now()).returning(ExtensionRequest.id),
+                execution_options={"synchronize_session": False}
+            ).scalars().all()
+            for request_id in request_ids:
+                audit_after_commit(session, "extension.cancelled", "extension", request_id, {"status": "pending"}, {"status": "cancelled"})
+            # Zwrócony egzemplarz od razu trafia do następnej osoby z kolejki rezerwacji
+            handed_over = allocate_holds(session, book_id)
+    if released:
+        print("Oddano książkę.")
+        if handed_over:
+            print("Książka została przekazana następnej osobie z kolejki rezerwacji.")
     else:
-        try:
-            book_id = int(book_id)
-            book = session.query(Book).filter_by(id=book_id, user_id=user.id).first()
-            if book:
-                book.user_id = None
-                session.query(Transaction).filter_by(book_id=book_id, user_id=user.id, returned_at=None).update({"returned_at": datetime.now()})
-                session.commit()
-                print("Oddano książkę.")
-            else:
-                print("Nie możesz zwrócić tej książki.")
-        except ValueError:
-            print("Podano nieprawidłowe ID książki.")
+        print("Nie możesz zwrócić tej książki.")
+    return released
+
+# REZERWACJE
+# Następny oczekujący tytułu: pierwszy wpis indeksu ix_holds_queue, z pominięciem zablokowanych, nieaktywnych,
+# przeterminowanych rezerwacji i czytelników, którzy mają już egzemplarz.
+def next_holder(session, book_id, now):
+    return session.execute(
+        select(Hold.id, Hold.user_id)
+        .join(User, User.id == Hold.user_id)
+        .where(
+            Hold.book_id == book_id, Hold.status == 'waiting', Hold.expires_at > now,
+            User.activated == True, User.blocked == False,
+            ~select(Copy.id).where(Copy.book_id == book_id, Copy.user_id == Hold.user_id).exists(),
+        )
+        .order_by(Hold.id)
+        .limit(1)
+    ).first()
+
+# Przekazuje wolne egzemplarze tytułu kolejnym oczekującym (FIFO) w transakcji wywołującego
+# i dopisuje im powiadomienia. Zwraca liczbę przekazanych egzemplarzy.
+def allocate_holds(session, book_id):
+    now = datetime.now()
+    handed_over = 0
+    while session.query(Book.available).filter_by(id=book_id).scalar():
+        holder = next_holder(session, book_id, now)
+        if holder is None:
+            break
+        hold_id, user_id = holder
+        copy_id = claim_copy(session, book_id, user_id)
+        if copy_id is None:
+            break
+        transaction = start_loan(session, book_id, copy_id, user_id)
+        session.flush()
+        session.execute(
+            update(Hold).where(Hold.id == hold_id).values(status='fulfilled', closed_at=now),
+            execution_options={"synchronize_session": False}
+        )
+        audit_after_commit(session, "hold.fulfil", "hold", hold_id, {"status": "waiting"},
+                           {"status": "fulfilled", "user_id": user_id, "copy_id": copy_id, "transaction_id": transaction.id})
+        title = session.query(Book.title).filter_by(id=book_id).scalar()
+        session.add(Notification(
+            user_id=user_id, transaction_id=transaction.id, kind="hold_ready", created_at=now,
+            message=f"Zarezerwowana książka '{title}' została dla Ciebie wypożyczona. Termin zwrotu: {transaction.due_date:%Y-%m-%d}."
+        ))
+        handed_over += 1
+    if handed_over:
+        invalidate_book_after_commit(session, book_id)
+    return handed_over
+
+def place_hold(user, book_id):
+    if user.blocked == True:
+        print("Twoje konto jest zablokowane, nie możesz korzystać w pełni z biblioteki.")
+        return False
+    try:
+        book_id = int(book_id)
+    except ValueError:
+        print("Podano nieprawidłowe ID książki.")
+        return False
+    try:
+        with session_scope() as session:
+            book = session.query(Book).filter_by(id=book_id).first()
+            if book is None:
+                print("Książka o podanym ID nie istnieje.")
+                return False
+            if session.query(Copy.id).filter_by(book_id=book_id, user_id=user.id).first():
+                print("Masz już wypożyczony egzemplarz tej książki.")
+                return False
+            if book.available > 0:
+                print("Książka jest dostępna - możesz ją wypożyczyć.")
+                return False
+            hold = Hold(book_id=book_id, user_id=user.id, expires_at=datetime.now() + timedelta(days=HOLD_DAYS))
+            session.add(hold)
+            session.flush()
+            audit_after_commit(session, "hold.place", "hold", hold.id, after={"book_id": book_id, "user_id": user.id})
+            position = session.query(func.count(Hold.id)).filter(
+                Hold.book_id == book_id, Hold.status == 'waiting', Hold.id <= hold.id
+            ).scalar()
+    except IntegrityError:
+        print("Masz już rezerwację tej książki.")
+        return False
+    print(f"Zarezerwowano książkę '{book.title}'. Miejsce w kolejce: {position}.")
+    return True
+
+# Anuluje oczekujące rezerwacje spełniające warunek (np. przy usuwaniu książki lub użytkownika)
+def cancel_waiting_holds(session, condition):
+    hold_ids = session.execute(
+        update(Hold).where(condition, Hold.status == 'waiting').values(status='cancelled', closed_at=datetime.now()).returning(Hold.id),
+        execution_options={"synchronize_session": False}
+    ).scalars().all()
+    for hold_id in hold_ids:
+        audit_after_commit(session, "hold.cancel", "hold", hold_id, {"status": "waiting"}, {"status": "cancelled"})
+    return len(hold_ids)
+
+def cancel_hold(user, book_id):
+    with session_scope() as session:
+        cancelled = cancel_waiting_holds(session, (Hold.user_id == user.id) & (Hold.book_id == book_id))
+    if cancelled:
+        print("Anulowano rezerwację.")
+    else:
+        print("Nie masz rezerwacji tej książki.")
+    return bool(cancelled)
+
+# Oczekujące rezerwacje użytkownika: (ID książki, tytuł, autor, miejsce w kolejce, data rezerwacji, ważna do)
+def find_user_holds(user_id):
+    earlier = aliased(Hold)
+    position = select(func.count(earlier.id)).where(
+        earlier.book_id == Hold.book_id, earlier.status == 'waiting', earlier.id <= Hold.id
+    ).scalar_subquery()
+    with session_scope() as session:
+        return session.execute(
+            select(Book.id, Book.title, Book.author, position, Hold.created_at, Hold.expires_at)
+            .join(Book, Book.id == Hold.book_id)
+            .where(Hold.user_id == user_id, Hold.status == 'waiting')
+            .order_by(Hold.id)
+        ).all()
+
+def display_user_holds(user_id):
+    holds = find_user_holds(user_id)
+    if holds:
+        rows = [[book_id, title, author, position, created_at.strftime("%Y-%m-%d"), expires_at.strftime("%Y-%m-%d")]
+                for book_id, title, author, position, created_at, expires_at in holds]
+        print(tabulate(rows, headers=["ID", "Tytuł", "Autor", "Miejsce w kolejce", "Data rezerwacji", "Ważna do"], tablefmt="grid"))
+    else:
+        print("Nie masz rezerwacji.")
+
+# Wygasza przeterminowane rezerwacje paczkami po indeksie ix_holds_waiting_expires_at i powiadamia czytelników.
+# Każda paczka to osobna krótka transakcja. Zwraca liczbę wygaszonych rezerwacji.
+def expire_holds(now=None, batch_size=1000):
+    now = now or datetime.now()
+    expired = 0
+    while True:
+        with session_scope() as session:
+            holds = session.execute(
+                select(Hold.id, Hold.user_id, Book.title)
+                .join(Book, Book.id == Hold.book_id)
+                .where(Hold.status == 'waiting', Hold.expires_at <= now)
+                .order_by(Hold.expires_at)
+                .limit(batch_size)
+            ).all()
+            if not holds:
+                break
+            session.execute(
+                update(Hold).where(Hold.id.in_([hold_id for hold_id, _, _ in holds])).values(status='expired', closed_at=now),
+                execution_options={"synchronize_session": False}
+            )
+            for hold_id, _, _ in holds:
+                audit_after_commit(session, "hold.expire", "hold", hold_id, {"status": "waiting"}, {"status": "expired"})
+            session.execute(insert(Notification), [
+                {"user_id": user_id, "kind": "hold_expired", "created_at": now,
+                 "message": f"Rezerwacja książki '{title}' wygasła."}
+                for _, user_id, title in holds
+            ])
+        expired += len(holds)
+    return expired
+
+# ARCHIWUM WYPOŻYCZEŃ
+# Zwrócone wypożyczenia starsze niż older_than_days przechodzą paczkami z transactions do transactions_archive
+# (ta sama baza, więc przeniesienie paczki to jedna transakcja - baza dołączona przez ATTACH nie dawałaby tego w trybie WAL).
+# Paczka to zakres ID: kopia do archiwum i usunięcie z transactions w jednym commicie, więc przerwane archiwizowanie
+# wznawia się samo - przeniesione wiersze już nie pasują do warunku. Trigger stats_transaction_delete pomija wiersze,
+# które są już w archiwum: wypożyczenie tylko zmienia tabelę, liczniki statystyk (liczone z obu tabel) zostają bez zmian.
+# Wiersz o największym ID nigdy nie trafia do archiwum - SQLite nadaje nowe ID od max(id) + 1,
+# więc po jego usunięciu kolejne wypożyczenie dostałoby ID, które już jest w archiwum.
+def archive_transactions(older_than_days=ARCHIVE_AFTER_DAYS, batch_size=5000, now=None):
+    cutoff = ((now or datetime.now()) - timedelta(days=older_than_days)).isoformat(sep=" ")
+    archived = 0
+    last_id = 0
+    while True:
+        with session_scope() as session:
+            # Zakres to tylko granice ID: kopia i usunięcie powtarzają pełny warunek w jednej transakcji zapisu,
+            # więc obejmują dokładnie te same wiersze, nawet jeśli ktoś zapisał coś po wybraniu zakresu
+            first_id, upper_id = session.execute(text("""
+                SELECT min(id), max(id) FROM (SELECT id FROM transactions
+                    WHERE id > :last_id AND returned_at IS NOT NULL AND returned_at < :cutoff
+                      AND id < (SELECT max(id) FROM transactions)
+                    ORDER BY id LIMIT :batch_size)
+            """), {"last_id": last_id, "cutoff": cutoff, "batch_size": batch_size}).one()
+            if upper_id is not None:
+                batch = {"last_id": last_id, "upper_id": upper_id, "cutoff": cutoff}
+                range_filter = "id > :last_id AND id <= :upper_id AND returned_at IS NOT NULL AND returned_at < :cutoff"
+                moved = session.execute(text(f"""
+                    INSERT INTO transactions_archive (id, book_id, copy_id, user_id, borrowed_at, due_date, returned_at)
+                    SELECT id, book_id, copy_id, user_id, borrowed_at, due_date, returned_at FROM transactions WHERE {range_filter}
+                """), batch).rowcount
+                session.execute(text(f"DELETE FROM transactions WHERE {range_filter}"), batch)
+                # Paczka to zakres ID, więc zdarzenie opisuje ją granicami i liczbą przeniesionych wierszy
+                audit_after_commit(session, "loan.archive", "transaction", first_id, after={
+                    "count": moved, "first_id": first_id, "last_id": upper_id, "cutoff": cutoff})
+        if upper_id is None:
+            break
+        archived += moved
+        last_id = upper_id
+    return archived
+
+# Książka po ID (obiekt odłączony od sesji, tylko do odczytu)
+def get_book(book_id):
+    def load():
+        with session_scope() as session:
+            return session.query(Book).filter_by(id=book_id).first()
+    return book_cache.get(book_id, load)
 
 # Funkcja do wyświetlania wszystkich dostępnych książek
-def display_available_books():
+def display_available_books(sort="id", descending=False, page_size=20, pause=False):
     if user.blocked == True:
         print("Twoje konto jest zablokowane, nie możesz korzystać w pełni z biblioteki.")
     else:
-        books = session.query(Book).filter_by(user_id=None).all()
-        if books:
-            book_data = []
-            for book in books:
-                book_data.append([book.id, book.title, book.author, book.year])
-            headers = ["ID", "Tytuł", "Autor", "Rok"]
-            print(tabulate(book_data, headers=headers, tablefmt="grid"))
+        # Strony dostępnych książek są w pamięci podręcznej, unieważnianej przy każdej zmianie książek
+        pager = KeysetPager(
+            [Book.id, Book.title, Book.author, Book.year, Book.available, Book.copies], BOOK_SORT_KEYS, sort,
+            conditions=(Book.available > 0,), page_size=page_size, descending=descending, cache=available_books_cache
+        )
+        browse_pages(pager, ["ID", "Tytuł", "Autor", "Rok", "Dostępne"], "Nie masz dostępnych książek.", format_availability, pause)
+
+def display_all_books(sort="id", descending=False, page_size=20, pause=False):
+    pager = KeysetPager([Book.id, Book.title, Book.author, Book.year, Book.available, Book.copies], BOOK_SORT_KEYS, sort, page_size=page_size, descending=descending)
+    browse_pages(pager, ["ID", "Tytuł", "Autor", "Rok", "Dostępne"], "Nie ma książek w bazie danych.", format_availability, pause)
+
+def add_book(title, author, year, copies=1):
+    with session_scope() as session:
+        book = Book(title=title, author=author, year=year)
+        session.add(book)
+        session.flush()
+        if copies:
+            session.execute(insert(Copy), [{"book_id": book.id} for _ in range(copies)])
+            session.refresh(book)  # Liczniki egzemplarzy ustawiły triggery
+        invalidate_after_commit(session, available_books_cache)
+        audit_after_commit(session, "book.create", "book", book.id, after={"title": title, "author": author, "year": year, "copies": copies})
+    return book
+
+def add_copies(book_id, count):
+    with session_scope() as session:
+        book = session.query(Book).filter_by(id=book_id).first()
+        if book:
+            session.execute(insert(Copy), [{"book_id": book.id} for _ in range(count)])
+            invalidate_book_after_commit(session, book.id)
+            audit_after_commit(session, "book.add_copies", "book", book.id, {"copies": book.copies}, {"copies": book.copies + count})
+            handed_over = allocate_holds(session, book.id)
+            print(f"Dodano {count} egz. książki '{book.title}'.")
+            if handed_over:
+                print(f"Przekazano {handed_over} egz. osobom z kolejki rezerwacji.")
+            return True
         else:
-            print("Nie masz dostępnych książek.")
+            print("Nie ma książki o podanym ID.")
+            return False
 
-def display_all_books():
-    books = session.query(Book).all()
-    if books:
-        book_data = []
-        for book in books:
-            book_data.append([book.id, book.title, book.author, book.year, book.user_id])
-        headers = ["ID", "Tytuł", "Autor", "Rok", "ID Użytkownika"]
-        print(tabulate(book_data, headers=headers, tablefmt="grid"))
+def delete_book(book_id):
+    with session_scope() as session:
+        book = session.query(Book).filter_by(id=book_id).first()
+        if book and book.available < book.copies:
+            print("Nie można usunąć książki, której egzemplarze są wypożyczone.")
+            return False
+        if book:
+            session.query(Copy).filter_by(book_id=book.id).delete(synchronize_session=False)
+            cancel_waiting_holds(session, Hold.book_id == book.id)
+            session.delete(book)
+            invalidate_book_after_commit(session, book.id)
+            audit_after_commit(session, "book.delete", "book", book.id, before={
+                "title": book.title, "author": book.author, "year": book.year, "copies": book.copies,
+            })
+            print("Książka została pomyślnie usunięta.")
+            return True
+        else:
+            print("Nie ma książki o podanym ID.")
+            return False
+
+def edit_book(book_id, title=None, author=None, year=None):
+    with session_scope() as session:
+        book = session.query(Book).filter_by(id=book_id).first()
+        if book:
+            changes = {field: value for field, value in (("title", title), ("author", author), ("year", year)) if value is not None}
+            audit_after_commit(session, "book.edit", "book", book.id, {field: getattr(book, field) for field in changes}, changes)
+            for field, value in changes.items():
+                setattr(book, field, value)
+            invalidate_book_after_commit(session, book.id)
+            print("Dane książki zostały pomyślnie zaktualizowane.")
+            return True
+        else:
+            print("Nie ma książki o podanym ID.")
+            return False
+
+# Przy kilku wypożyczonych egzemplarzach tytułu trzeba wskazać czytelnika
+def extend_borrow_period(book_id, extension_days, user_id=None):
+    with session_scope() as session:
+        book = session.query(Book).filter_by(id=book_id).first()
+        if book:
+            loans = session.query(Transaction).filter_by(book_id=book.id, returned_at=None)
+            if user_id is not None:
+                loans = loans.filter_by(user_id=user_id)
+            loans = loans.limit(2).all()
+            if len(loans) > 1:
+                print("Wypożyczono kilka egzemplarzy tej książki - podaj ID użytkownika.")
+                return False
+            transaction = loans[0] if loans else None
+            if transaction:
+                due_date = transaction.due_date
+                transaction.due_date += timedelta(days=extension_days)
+                audit_after_commit(session, "loan.extend", "transaction", transaction.id, {"due_date": due_date}, {"due_date": transaction.due_date})
+                print(f"Termin zwrotu książki '{book.title}' został przedłużony o {extension_days} dni.")
+                return True
+            else:
+                print("Książka nie jest obecnie wypożyczona.")
+                return False
+        else:
+            print("Książka o podanym ID nie istnieje.")
+            return False
+
+# PROŚBY O PRZEDŁUŻENIE
+EXTENSION_DAYS = 30  # Domyślne przedłużenie
+EXTENSION_BATCH_SIZE = 5000  # Liczba ID w jednym zapytaniu przy decyzjach zbiorczych (limit parametrów SQLite)
+
+# Powody odrzucenia sprawdzane przed zatwierdzeniem: (opis, warunek na prośbę)
+def extension_rejection_rules():
+    return [
+        ("wypożyczenie zostało już zakończone", ~select(Transaction.id).where(
+            Transaction.id == ExtensionRequest.transaction_id, Transaction.returned_at.is_(None)).exists()),
+        ("konto czytelnika jest zablokowane lub nieaktywne", ~select(User.id).where(
+            User.id == ExtensionRequest.user_id, User.activated == True, User.blocked == False).exists()),
+        ("na książkę czekają rezerwacje", select(Hold.id).join(Transaction, Transaction.book_id == Hold.book_id).where(
+            Transaction.id == ExtensionRequest.transaction_id, Hold.status == 'waiting').exists()),
+    ]
+
+def request_extension(user, book_id, days=EXTENSION_DAYS):
+    if user.blocked == True:
+        print("Twoje konto jest zablokowane, nie możesz korzystać w pełni z biblioteki.")
+        return False
+    try:
+        book_id = int(book_id)
+    except ValueError:
+        print("Podano nieprawidłowe ID książki.")
+        return False
+    try:
+        with session_scope() as session:
+            transaction_id = session.query(Transaction.id).filter(
+                Transaction.book_id == book_id, Transaction.user_id == user.id, Transaction.returned_at.is_(None)
+            ).scalar()
+            if transaction_id is None:
+                print("Nie masz wypożyczonej tej książki.")
+                return False
+            if session.query(Hold.id).filter(Hold.book_id == book_id, Hold.status == 'waiting').first():
+                print("Na tę książkę czekają inni czytelnicy - nie można przedłużyć wypożyczenia.")
+                return False
+            request = ExtensionRequest(transaction_id=transaction_id, user_id=user.id, days=days)
+            session.add(request)
+            session.flush()
+            audit_after_commit(session, "extension.request", "extension", request.id, after={"transaction_id": transaction_id, "days": days})
+    except IntegrityError:
+        print("Prośba o przedłużenie tego wypożyczenia już czeka na decyzję.")
+        return False
+    print("Wysłano prośbę o przedłużenie do administratora.")
+    return True
+
+# Zatwierdza (approve=True) lub odrzuca prośby o podanych ID, a dla ids=None wszystkie oczekujące, w jednej transakcji.
+# Przy zatwierdzaniu prośby niespełniające reguł są odrzucane z powodem. Zwraca słownik {wynik: liczba}.
+def decide_extension_requests(ids, approve, admin_id=None, reason=None):
+    now = datetime.now()
+    results = {}
+    batches = [None] if ids is None else [ids[start:start + EXTENSION_BATCH_SIZE] for start in range(0, len(ids), EXTENSION_BATCH_SIZE)]
+    with session_scope() as session:
+        for batch in batches:
+            pending = [ExtensionRequest.status == 'pending']
+            if batch is not None:
+                pending.append(ExtensionRequest.id.in_(batch))
+
+            def close(status, reason, *conditions):
+                request_ids = session.execute(
+                    update(ExtensionRequest).where(*pending, *conditions)
+                    .values(status=status, reason=reason, decided_at=now, decided_by=admin_id).returning(ExtensionRequest.id),
+                    execution_options={"synchronize_session": False}
+                ).scalars().all()
+                for request_id in request_ids:
+                    audit_after_commit(session, f"extension.{status}", "extension", request_id,
+                                       {"status": "pending"}, {"status": status, "reason": reason})
+                return len(request_ids)
+
+            if approve:
+                for rule_reason, condition in extension_rejection_rules():
+                    rejected = close('rejected', rule_reason, condition)
+                    if rejected:
+                        results[f"odrzucono: {rule_reason}"] = results.get(f"odrzucono: {rule_reason}", 0) + rejected
+                # Pozostałe prośby są zgodne z regułami - nowe terminy jednym executemany po kluczu głównym
+                extensions = session.execute(
+                    select(Transaction.id, Transaction.due_date, ExtensionRequest.days)
+                    .join(ExtensionRequest, ExtensionRequest.transaction_id == Transaction.id).where(*pending)
+                ).all()
+                if extensions:
+                    session.execute(update(Transaction), [
+                        {"id": transaction_id, "due_date": due_date + timedelta(days=days)}
+                        for transaction_id, due_date, days in extensions
+                    ])
+                approved = close('approved', None)
+                if approved:
+                    results["zatwierdzono"] = results.get("zatwierdzono", 0) + approved
+            else:
+                rejected = close('rejected', reason or "decyzja administratora")
+                if rejected:
+                    results["odrzucono"] = results.get("odrzucono", 0) + rejected
+    return results
+
+def display_extension_decision(results):
+    if results:
+        print(tabulate(sorted(results.items()), headers=["Wynik", "Prośby"], tablefmt="grid"))
     else:
-        print("Nie ma książek w bazie danych.")
+        print("Brak oczekujących próśb o podanych ID.")
 
-def delete_book(book_id):
-    book = session.query(Book).filter_by(id=book_id).first()
-    if book:
-        session.delete(book)
-        session.commit()
-        print("Książka została pomyślnie usunięta.")
+# Oczekujące prośby w kolejności zgłoszeń, z danymi wypożyczenia - strona po stronie
+def extension_requests_pager(page_size=20):
+    return KeysetPager(
+        [ExtensionRequest.id, User.username, Book.title, Transaction.due_date, ExtensionRequest.days, ExtensionRequest.created_at],
+        EXTENSION_SORT_KEYS, "id", page_size=page_size,
+        conditions=(ExtensionRequest.status == 'pending', User.id == ExtensionRequest.user_id,
+                    Transaction.id == ExtensionRequest.transaction_id, Book.id == Transaction.book_id),
+    )
+
+def display_extension_requests(page_size=20, pause=False):
+    headers = ["ID prośby", "Użytkownik", "Tytuł", "Termin zwrotu", "Dni", "Data prośby"]
+    browse_pages(extension_requests_pager(page_size), headers, "Brak oczekujących próśb o przedłużenie.", pause=pause,
+                 format_row=lambda row: [*row[:3], row[3].strftime("%Y-%m-%d"), row[4], row[5].strftime("%Y-%m-%d %H:%M")])
+
+# Ostatnie prośby czytelnika: (ID prośby, tytuł, dni, status, powód, data prośby).
+# Wypożyczenie prośby może być już w archiwum (archive_transactions), więc książkę bierzemy z tej tabeli, w której jest.
+def find_user_extension_requests(user_id, limit=10):
+    with session_scope() as session:
+        return session.execute(
+            select(ExtensionRequest.id, Book.title, ExtensionRequest.days, ExtensionRequest.status, ExtensionRequest.reason, ExtensionRequest.created_at)
+            .outerjoin(Transaction, Transaction.id == ExtensionRequest.transaction_id)
+            .outerjoin(ArchivedTransaction, ArchivedTransaction.id == ExtensionRequest.transaction_id)
+            .join(Book, Book.id == func.coalesce(Transaction.book_id, ArchivedTransaction.book_id))
+            .where(ExtensionRequest.user_id == user_id).order_by(ExtensionRequest.id.desc()).limit(limit)
+        ).all()
+
+EXTENSION_STATUS_LABELS = {"pending": "oczekuje", "approved": "zatwierdzona", "rejected": "odrzucona", "cancelled": "anulowana"}
+
+def display_user_extension_requests(user_id):
+    requests = find_user_extension_requests(user_id)
+    if requests:
+        print("Twoje prośby o przedłużenie:")
+        print(tabulate([[request_id, title, days, EXTENSION_STATUS_LABELS[status], reason or "", created_at.strftime("%Y-%m-%d")]
+                        for request_id, title, days, status, reason, created_at in requests],
+                       headers=["ID", "Tytuł", "Dni", "Status", "Powód", "Data prośby"], tablefmt="grid"))
+
+# Zamienia "1, 5-9 12" na listę ID
+def parse_id_list(text):
+    ids = []
+    for part in re.split(r"[\s,]+", text.strip()):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        ids.extend(range(int(first), int(last or first) + 1))
+    return ids
+
+# Statusy, po których można filtrować historię transakcji
+TRANSACTION_STATUSES = ("open", "returned", "overdue")
+
+def transaction_status(returned_at, due_date, now):
+    if returned_at:
+        return "Returned"
+    if due_date and due_date < now:
+        return "Overdue"
+    return "Not Returned"
+
+# Zwraca kolejne strony transakcji (jedno zapytanie z JOIN na stronę, stronicowanie po Transaction.id)
+def transaction_history_query(source, status=None, user_id=None, date_from=None, date_to=None):
+    query = select(
+        source.id, User.username, Book.title, source.borrowed_at, source.due_date, source.returned_at
+    ).outerjoin(User, User.id == source.user_id).outerjoin(Book, Book.id == source.book_id)
+    if status == "open":
+        query = query.where(source.returned_at.is_(None))
+    elif status == "returned":
+        query = query.where(source.returned_at.isnot(None))
+    elif status == "overdue":
+        query = query.where(source.returned_at.is_(None), source.due_date < datetime.now())
+    elif status is not None:
+        raise ValueError(f"Nieznany status transakcji: {status}")
+    if user_id is not None:
+        query = query.where(source.user_id == user_id)
+    if date_from is not None:
+        query = query.where(source.borrowed_at >= date_from)
+    if date_to is not None:
+        query = query.where(source.borrowed_at < date_to)
+    return query
+
+def iter_transaction_pages(status=None, user_id=None, date_from=None, date_to=None, page_size=100, after_id=0):
+    sources = [Transaction]
+    # W archiwum są tylko zwrócone wypożyczenia - otwartych i przetrzymanych nie ma po co tam szukać
+    if status in (None, "returned"):
+        sources.append(ArchivedTransaction)
+    queries = [(source, transaction_history_query(source, status, user_id, date_from, date_to)) for source in sources]
+    last_id = after_id
+    while True:
+        # Osobna krótka sesja na każdą stronę - między stronami nie trzymamy połączenia.
+        # Każda tabela oddaje swoją stronę po ID, a scalamy je tutaj: ID się nie powtarzają, więc kursor last_id działa dla obu.
+        with session_scope() as session:
+            rows = []
+            for source, query in queries:
+                rows.extend(session.execute(query.where(source.id > last_id).order_by(source.id).limit(page_size)).all())
+        page = sorted(rows, key=lambda row: row[0])[:page_size]
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        last_id = page[-1][0]
+
+def display_transactions(status=None, user_id=None, date_from=None, date_to=None, page_size=50, pause=False, max_pages=None):
+    headers = ["ID", "Użytkownik", "Tytuł książki", "Data wypożyczenia", "Termin zwrotu", "Status"]
+    now = datetime.now()
+    shown = 0
+    for page_number, page in enumerate(iter_transaction_pages(status, user_id, date_from, date_to, page_size), start=1):
+        transaction_data = []
+        for transaction_id, username, title, borrowed_at, due_date, returned_at in page:
+            transaction_data.append([transaction_id, username or "Unknown User", title or "Unknown Book", borrowed_at, due_date, transaction_status(returned_at, due_date, now)])
+        print(f"Strona {page_number}")
+        print(tabulate(transaction_data, headers=headers, tablefmt="grid"))
+        shown += len(page)
+        if page_number == max_pages:
+            break
+        # Pytamy o kolejną stronę tylko gdy ta była pełna - niepełna jest ostatnią
+        if pause and len(page) == page_size:
+            if input("Enter - następna strona, 'q' - koniec: ").strip().lower() in ("q", "esc"):
+                break
+    if shown == 0:
+        print("Brak transakcji w bazie danych.")
+
+# Zamienia tekst RRRR-MM-DD na datetime, puste pole oznacza brak ograniczenia
+def parse_date(value):
+    value = value.strip()
+    if not value:
+        return None
+    return datetime.strptime(value, "%Y-%m-%d")
+
+# ZALEGŁE WYPOŻYCZENIA I POWIADOMIENIA
+# Skan idzie po indeksie częściowym ix_transactions_open_due_date paczkami po (due_date, id),
+# więc jego koszt zależy od liczby zaległych wypożyczeń, a nie od długości historii transakcji.
+# Zwraca podsumowanie {ID użytkownika: [nazwa, liczba zaległych, najstarszy termin]} i liczbę nowych powiadomień.
+def scan_overdue_loans(now=None, batch_size=1000):
+    now = now or datetime.now()
+    summary = {}
+    created = 0
+    last_due, last_id = datetime.min, 0
+    while True:
+        with session_scope() as session:
+            rows = session.execute(
+                select(Transaction.id, Transaction.user_id, Transaction.due_date, User.username, Book.title)
+                .join(User, User.id == Transaction.user_id)
+                .join(Book, Book.id == Transaction.book_id)
+                .where(
+                    Transaction.returned_at.is_(None),
+                    Transaction.due_date < now,
+                    tuple_(Transaction.due_date, Transaction.id) > tuple_(last_due, last_id),
+                )
+                .order_by(Transaction.due_date, Transaction.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            notifications = []
+            for transaction_id, user_id, due_date, username, title in rows:
+                entry = summary.setdefault(user_id, [username, 0, due_date])
+                entry[1] += 1
+                notifications.append({
+                    "user_id": user_id,
+                    "transaction_id": transaction_id,
+                    "kind": "overdue",
+                    "message": f"Termin zwrotu książki '{title}' minął {due_date:%Y-%m-%d}. Prosimy o zwrot.",
+                    "created_at": now,
+                })
+            created += session.connection().execute(sqlite_insert(Notification).on_conflict_do_nothing(), notifications).rowcount
+        last_due, last_id = rows[-1][2], rows[-1][0]
+    return summary, created
+
+def display_overdue_summary(summary, now=None):
+    now = now or datetime.now()
+    if not summary:
+        print("Brak zaległych wypożyczeń.")
+        return
+    rows = [
+        [user_id, username, count, oldest_due.strftime("%Y-%m-%d"), (now - oldest_due).days]
+        for user_id, (username, count, oldest_due) in sorted(summary.items(), key=lambda item: (-item[1][1], item[1][2]))
+    ]
+    print(tabulate(rows, headers=["ID", "Użytkownik", "Zaległe", "Najstarszy termin", "Dni spóźnienia"], tablefmt="grid"))
+    print(f"Razem: {sum(entry[1] for entry in summary.values())} zaległych wypożyczeń u {len(summary)} użytkowników.")
+
+# Przenosi niewysłane powiadomienia z kolejki do pliku JSON Lines i oznacza je jako wysłane.
+# Plik jest synchronizowany na dysk przed oznaczeniem, więc w razie awarii wpis może się powtórzyć, ale nie zginie.
+def deliver_notifications(path, batch_size=1000):
+    delivered = 0
+    with open(path, "a", encoding="utf-8") as outbox:
+        while True:
+            with session_scope() as session:
+                rows = session.execute(
+                    select(Notification.id, Notification.user_id, Notification.kind, Notification.message, Notification.created_at)
+                    .where(Notification.sent_at.is_(None))
+                    .order_by(Notification.id)
+                    .limit(batch_size)
+                ).all()
+                if not rows:
+                    break
+                for row in rows:
+                    outbox.write(json.dumps(row_to_dict(["id", "user_id", "kind", "message", "created_at"], row), ensure_ascii=False) + "\n")
+                outbox.flush()
+                os.fsync(outbox.fileno())
+                session.execute(
+                    update(Notification)
+                    .where(Notification.id.in_([row[0] for row in rows]))
+                    .values(sent_at=datetime.now())
+                    .execution_options(synchronize_session=False)
+                )
+            delivered += len(rows)
+    return delivered
+
+# PRZESZUKIWANIE I KOMPAKTOWANIE DZIENNIKA ZDARZEŃ
+def audit_partition_month(partition):
+    return datetime.strptime(partition.removeprefix("audit_log_"), "%Y_%m")
+
+# Zdarzenia od najnowszych. Tabele miesięczne są czytane od najnowszej, każda po indeksie pasującym do filtra,
+# aż do zebrania limit wierszy - starszych miesięcy nie trzeba otwierać, gdy wynik jest już pełny.
+# action z '*' na końcu to prefiks, np. "user.*".
+def query_audit_log(actor_id=None, target_type=None, target_id=None, action=None, since=None, until=None, limit=100):
+    audit_log.flush()  # Zdarzenia czekające w buforze też mają być widoczne
+    conditions, parameters = [], []
+    for condition, value in (("a.actor_id = ?", actor_id), ("a.target_type = ?", target_type), ("a.target_id = ?", target_id),
+                             ("a.occurred_at >= ?", since and since.isoformat(sep=" ")), ("a.occurred_at < ?", until and until.isoformat(sep=" "))):
+        if value is not None:
+            conditions.append(condition)
+            parameters.append(value)
+    if action and action.endswith("*"):
+        conditions.append("a.action >= ? AND a.action < ?")
+        parameters += [action[:-1], action[:-1] + "\uffff"]
+    elif action:
+        conditions.append("a.action = ?")
+        parameters.append(action)
+    rows = []
+    with current_engine().connect() as connection:
+        for partition in reversed(audit_partitions(connection)):
+            month = audit_partition_month(partition)
+            if until is not None and month >= until:
+                continue
+            if since is not None and (month + timedelta(days=32)).replace(day=1) <= since:
+                break
+            rows += connection.exec_driver_sql(
+                f'SELECT a.occurred_at, a.actor_id, u.username, a.action, a.target_type, a.target_id, a.before, a.after '
+                f'FROM "{partition}" a LEFT JOIN users u ON u.id = a.actor_id '
+                f'WHERE {" AND ".join(conditions) or "1"} ORDER BY a.occurred_at DESC, a.id DESC LIMIT ?',
+                (*parameters, limit - len(rows))
+            ).all()
+            if len(rows) >= limit:
+                break
+    return rows
+
+def display_audit_log(rows):
+    if not rows:
+        print("Brak zdarzeń spełniających kryteria.")
+        return
+    print(tabulate([
+        [occurred_at[:19], username or (f"#{actor_id}" if actor_id is not None else "system"), action,
+         f"{target_type}:{target_id}" if target_type else "", before or "", after or ""]
+        for occurred_at, actor_id, username, action, target_type, target_id, before, after in rows
+    ], headers=["Czas", "Kto", "Zdarzenie", "Obiekt", "Przed", "Po"], tablefmt="grid", maxcolwidths=[None, None, None, None, 40, 40]))
+
+# Miesiące starsze niż keep_months przenosi do archive_dir/audit_log_RRRR_MM.jsonl.gz i usuwa ich tabele.
+# Tabela znika dopiero po zapisaniu i zsynchronizowaniu pliku, więc przerwane kompaktowanie można powtórzyć.
+# Kompaktuje dziennik bieżącego oddziału; archiwa oddziałów trafiają do osobnych podkatalogów archive_dir.
+def compact_audit_log(keep_months=12, archive_dir="audit-archive", now=None):
+    import gzip
+    audit_log.flush()
+    now = now or datetime.now()
+    month_number = now.year * 12 + now.month - 1 - keep_months
+    oldest_kept = audit_partition_name(datetime(month_number // 12, month_number % 12 + 1, 1))
+    branch = current_branch.get()
+    shard = branch_engine(branch)
+    if active_branch():
+        archive_dir = os.path.join(archive_dir, active_branch())
+    with shard.connect() as connection:
+        partitions = [partition for partition in audit_partitions(connection) if partition < oldest_kept]
+    os.makedirs(archive_dir, exist_ok=True)
+    compacted = []
+    for partition in partitions:
+        path = os.path.join(archive_dir, f"{partition}.jsonl.gz")
+        rows = 0
+        with shard.begin() as connection:
+            with open(path + ".tmp", "wb") as raw:
+                with gzip.GzipFile(fileobj=raw, mode="wb") as output:
+                    for row in connection.exec_driver_sql(f'SELECT id, {", ".join(AUDIT_COLUMNS)} FROM "{partition}" ORDER BY id'):
+                        event = dict(zip(("id", *AUDIT_COLUMNS), row))
+                        event["before"], event["after"] = (json.loads(value) if value else None for value in (event["before"], event["after"]))
+                        output.write((json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8"))
+                        rows += 1
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(path + ".tmp", path)
+            connection.exec_driver_sql(f'DROP TABLE "{partition}"')
+        audit_log.partitions.discard((None if branch == BRANCH else branch, partition))
+        compacted.append([partition, rows, path])
+    return compacted
+
+# KOPIE ZAPASOWE
+# Kopia działającej bazy bez zatrzymywania terminali: API kopii zapasowej SQLite przepisuje po BACKUP_PAGES stron na krok
+# z przerwą BACKUP_PAUSE_MS między krokami. Połączenie źródłowe trzyma przez całą kopię jedną transakcję odczytu,
+# więc kopia to stan bazy z chwili startu: w trybie WAL terminale dalej zapisują, a kopia nie zaczyna się od nowa
+# po każdym ich zapisie. Ceną jest plik -wal, który do końca kopii nie może się skrócić.
+# Kompresja gzip na poziomie 6: bazę ściska prawie tak samo jak 9, a trzy razy szybciej.
+# Migawki przyrostowe to katalog: kawałki pliku bazy (BACKUP_CHUNK_SIZE) w chunks/ nazwane skrótem SHA-256
+# i manifesty snapshot-*.json z listą kawałków - kolejna migawka zapisuje tylko kawałki, które się zmieniły.
+BACKUP_COMPRESS_LEVEL = 6
+
+def copy_database(path, pages=BACKUP_PAGES, pause_ms=BACKUP_PAUSE_MS):
+    source = sqlite3.connect(current_engine().url.database, timeout=5)
+    target = sqlite3.connect(path)
+    try:
+        source.execute("BEGIN")
+        source.execute("SELECT count(*) FROM sqlite_master").fetchone()  # Początek migawki
+
+        def pause(status, remaining, total):
+            if remaining and pause_ms:
+                time.sleep(pause_ms / 1000)
+
+        source.backup(target, pages=pages, progress=pause)
+        # Kopia to jeden plik - bez trybu WAL nie zostawia obok plików -wal i -shm
+        target.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        target.close()
+        source.close()
+
+def write_file_atomically(path, data):
+    with open(path + ".tmp", "wb") as output:
+        output.write(data)
+        output.flush()
+        os.fsync(output.fileno())
+    os.replace(path + ".tmp", path)
+
+def list_snapshots(directory):
+    return sorted(name for name in os.listdir(directory) if name.startswith("snapshot-") and name.endswith(".json"))
+
+# Zapisuje migawkę z pełnej kopii copy_path; zwraca (nazwa manifestu, liczba kawałków, nowe kawałki, zapisane bajty)
+def store_snapshot(copy_path, directory, compress=False):
+    import gzip, hashlib
+    chunks, new_chunks, written = [], 0, 0
+    with open(copy_path, "rb") as source:
+        while chunk := source.read(BACKUP_CHUNK_SIZE):
+            name = hashlib.sha256(chunk).hexdigest() + (".gz" if compress else "")
+            chunks.append(name)
+            path = os.path.join(directory, "chunks", name)
+            if not os.path.exists(path):
+                data = gzip.compress(chunk, BACKUP_COMPRESS_LEVEL) if compress else chunk
+                write_file_atomically(path, data)
+                new_chunks += 1
+                written += len(data)
+    now = datetime.now()
+    name = f"snapshot-{now:%Y%m%d-%H%M%S-%f}.json"
+    manifest = {"created_at": now.isoformat(sep=" ", timespec="seconds"), "size": os.path.getsize(copy_path), "chunks": chunks}
+    # Manifest zapisujemy na końcu - przerwana migawka zostawia najwyżej nieużywane kawałki
+    write_file_atomically(os.path.join(directory, name), json.dumps(manifest).encode("utf-8"))
+    return name, len(chunks), new_chunks, written
+
+# Zostawia keep najnowszych migawek i usuwa kawałki, których nie używa już żaden manifest
+def prune_snapshots(directory, keep):
+    snapshots = list_snapshots(directory)
+    for name in snapshots[:-keep]:
+        os.remove(os.path.join(directory, name))
+    used = set()
+    for name in snapshots[-keep:]:
+        with open(os.path.join(directory, name), encoding="utf-8") as source:
+            used.update(json.load(source)["chunks"])
+    removed = 0
+    for name in os.listdir(os.path.join(directory, "chunks")):
+        if name not in used:
+            os.remove(os.path.join(directory, "chunks", name))
+            removed += 1
+    return max(len(snapshots) - keep, 0), removed
+
+def backup_database(path, compress=False, incremental=False, keep=None, pages=BACKUP_PAGES, pause_ms=BACKUP_PAUSE_MS):
+    import gzip, shutil
+    started = time.perf_counter()
+    if incremental:
+        os.makedirs(os.path.join(path, "chunks"), exist_ok=True)
+        copy_path = os.path.join(path, "copy.tmp")
     else:
-        print("Nie ma książki o podanym ID.")
-
-def edit_book(book_id, title=None, author=None, year=None, user_id=None):
-    book = session.query(Book).filter_by(id=book_id).first()
-    if book:
-        if title is not None:
-            book.title = title
-        if author is not None:
-            book.author = author
-        if year is not None:
-            book.year = year
-        if user_id is not None:
-            book.user_id = user_id
-        session.commit()
-        print("Dane książki zostały pomyślnie zaktualizowane.")
+        copy_path = path + ".tmp"
+    if os.path.exists(copy_path):  # Pozostałość po przerwanej kopii
+        os.remove(copy_path)
+    copy_database(copy_path, pages, pause_ms)
+    result = {"path": path, "size": os.path.getsize(copy_path)}
+    try:
+        if incremental:
+            result["snapshot"], result["chunks"], result["new_chunks"], result["written"] = store_snapshot(copy_path, path, compress)
+            if keep:
+                result["pruned"], result["removed_chunks"] = prune_snapshots(path, keep)
+        elif compress:
+            with open(copy_path, "rb") as source, open(path + ".gz.tmp", "wb") as raw:
+                with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=BACKUP_COMPRESS_LEVEL) as output:
+                    shutil.copyfileobj(source, output, 1024 * 1024)
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(path + ".gz.tmp", path)
+            result["written"] = os.path.getsize(path)
+        else:
+            os.replace(copy_path, path)
+            result["written"] = result["size"]
+    finally:
+        if os.path.exists(copy_path):
+            os.remove(copy_path)
+    result["seconds"] = time.perf_counter() - started
+    return result
+
+# Odtworzenie bazy z pliku kopii, kopii .gz albo katalogu migawek (domyślnie najnowsza migawka).
+# Wynik trafia najpierw do pliku obok celu i musi przejść PRAGMA integrity_check - uszkodzona kopia nie zastąpi bazy.
+# Odtwarzanie nie działa w trakcie pracy: terminale trzeba wcześniej zatrzymać.
+def restore_database(source, target, snapshot=None, force=False):
+    import gzip, zlib, shutil, hashlib
+    if os.path.exists(target) and not force:
+        raise ValueError(f"Plik {target} już istnieje - zatrzymaj terminale i użyj --force, aby go zastąpić.")
+    restored_path = target + ".restore"
+    result = {"source": source, "target": target}
+    try:
+        if os.path.isdir(source):
+            snapshots = list_snapshots(source)
+            if not snapshots:
+                raise ValueError(f"W katalogu {source} nie ma migawek.")
+            result["snapshot"] = snapshot or snapshots[-1]
+            with open(os.path.join(source, result["snapshot"]), encoding="utf-8") as manifest_file:
+                manifest = json.load(manifest_file)
+            with open(restored_path, "wb") as output:
+                for name in manifest["chunks"]:
+                    with open(os.path.join(source, "chunks", name), "rb") as chunk_file:
+                        chunk = chunk_file.read()
+                    try:
+                        if name.endswith(".gz"):
+                            chunk = gzip.decompress(chunk)
+                    except (OSError, EOFError, zlib.error):
+                        chunk = None
+                    if chunk is None or hashlib.sha256(chunk).hexdigest() != name.split(".")[0]:
+                        raise ValueError(f"Uszkodzony kawałek migawki: {name}")
+                    output.write(chunk)
+            if os.path.getsize(restored_path) != manifest["size"]:
+                raise ValueError("Rozmiar odtworzonej bazy nie zgadza się z manifestem migawki.")
+        elif source.endswith(".gz"):
+            with gzip.open(source, "rb") as compressed, open(restored_path, "wb") as output:
+                shutil.copyfileobj(compressed, output, 1024 * 1024)
+        else:
+            shutil.copyfile(source, restored_path)
+        connection = sqlite3.connect(restored_path)
+        try:
+            problems = [row[0] for row in connection.execute("PRAGMA integrity_check")]
+            result["schema_version"] = connection.execute("SELECT max(version) FROM schema_version").fetchone()[0]
+        except sqlite3.DatabaseError as error:
+            problems = [str(error)]
+        finally:
+            connection.close()
+        if problems != ["ok"]:
+            raise ValueError(f"Kopia nie przeszła sprawdzenia integralności: {'; '.join(problems[:5])}")
+        with open(restored_path, "rb+") as restored:
+            os.fsync(restored.fileno())
+    except Exception:
+        if os.path.exists(restored_path):
+            os.remove(restored_path)
+        raise
+    # Plik -wal starej bazy zostałby nałożony na odtworzoną bazę
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(target + suffix):
+            os.remove(target + suffix)
+    os.replace(restored_path, target)
+    result["size"] = os.path.getsize(target)
+    return result
+
+# STATYSTYKI WYPOŻYCZEŃ
+# Odczyt z tabel statystyk: liczniki całej biblioteki i czołówki po indeksach na kolumnach loans
+def get_circulation_stats(limit=10):
+    with session_scope() as session:
+        totals = dict(session.execute(select(CirculationStats.name, CirculationStats.value)).all())
+        top_books = session.execute(
+            select(Book.id, Book.title, Book.author, BookStats.loans, BookStats.borrowed)
+            .join(Book, Book.id == BookStats.book_id)
+            .order_by(BookStats.loans.desc()).limit(limit)
+        ).all()
+        top_users = session.execute(
+            select(User.id, User.username, UserStats.loans, UserStats.borrowed)
+            .join(User, User.id == UserStats.user_id)
+            .order_by(UserStats.loans.desc()).limit(limit)
+        ).all()
+        top_authors = session.execute(
+            select(AuthorStats.author, AuthorStats.loans).order_by(AuthorStats.loans.desc()).limit(limit)
+        ).all()
+    return {"loans": totals.get("loans", 0), "borrowed": totals.get("borrowed", 0),
+            "top_books": top_books, "top_users": top_users, "top_authors": top_authors}
+
+# To samo policzone wprost z transactions (GROUP BY) - punkt odniesienia dla benchmarku
+def get_circulation_stats_adhoc(limit=10):
+    # Historia to bieżące wypożyczenia razem z archiwum
+    history = union_all(
+        select(Transaction.id, Transaction.book_id, Transaction.user_id, Transaction.returned_at),
+        select(ArchivedTransaction.id, ArchivedTransaction.book_id, ArchivedTransaction.user_id, ArchivedTransaction.returned_at),
+    ).subquery()
+    with session_scope() as session:
+        loans = session.execute(select(func.count()).select_from(history)).scalar()
+        borrowed = session.execute(select(func.count(Transaction.id)).where(Transaction.returned_at.is_(None))).scalar()
+        book_loans = func.count(history.c.id).label("loans")
+        top_books = session.execute(
+            select(Book.id, Book.title, Book.author, book_loans, func.coalesce(func.sum(history.c.returned_at.is_(None)), 0))
+            .join(Book, Book.id == history.c.book_id)
+            .group_by(Book.id).order_by(book_loans.desc()).limit(limit)
+        ).all()
+        user_loans = func.count(history.c.id).label("loans")
+        top_users = session.execute(
+            select(User.id, User.username, user_loans, func.coalesce(func.sum(history.c.returned_at.is_(None)), 0))
+            .join(User, User.id == history.c.user_id)
+            .group_by(User.id).order_by(user_loans.desc()).limit(limit)
+        ).all()
+        author_loans = func.count(history.c.id).label("loans")
+        top_authors = session.execute(
+            select(Book.author, author_loans)
+            .join(Book, Book.id == history.c.book_id)
+            .group_by(Book.author).order_by(author_loans.desc()).limit(limit)
+        ).all()
+    return {"loans": loans, "borrowed": borrowed,
+            "top_books": top_books, "top_users": top_users, "top_authors": top_authors}
+
+def display_statistics(limit=10):
+    stats = get_circulation_stats(limit)
+    print(f"Wszystkie wypożyczenia: {stats['loans']}, obecnie wypożyczone: {stats['borrowed']}")
+    print("\nNajczęściej wypożyczane książki:")
+    print(tabulate(stats["top_books"], headers=["ID", "Tytuł", "Autor", "Wypożyczenia", "Wypożyczona"], tablefmt="grid"))
+    print("\nNajaktywniejsi czytelnicy:")
+    print(tabulate(stats["top_users"], headers=["ID", "Użytkownik", "Wypożyczenia", "Obecnie"], tablefmt="grid"))
+    print("\nNajpopularniejsi autorzy:")
+    print(tabulate(stats["top_authors"], headers=["Autor", "Wypożyczenia"], tablefmt="grid"))
+
+# IMPORT KATALOGU
+CATALOGUE_FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl", ".json": "jsonl"}
+
+# Czyta plik rekord po rekordzie (CSV z nagłówkiem title,author,year albo JSON Lines).
+# Zwraca pary (numer rekordu, słownik); dla niepoprawnej linii JSON zamiast słownika jest komunikat błędu.
+def iter_catalogue_records(path, file_format):
+    import csv
+    with open(path, newline="", encoding="utf-8-sig") as catalogue:
+        if file_format == "csv":
+            for number, record in enumerate(csv.DictReader(catalogue), start=1):
+                yield number, record
+        else:
+            number = 0
+            for line in catalogue:
+                if not line.strip():
+                    continue
+                number += 1
+                try:
+                    record = json.loads(line)
+                except ValueError as error:
+                    yield number, f"niepoprawny JSON ({error})"
+                    continue
+                yield number, record if isinstance(record, dict) else "rekord nie jest obiektem JSON"
+
+# Sprawdza pola title/author/year; zwraca (wartości do wstawienia, None) albo (None, opis błędu)
+def validate_book_record(record):
+    if not isinstance(record, dict):
+        return None, record
+    title = str(record.get("title") or "").strip()
+    author = str(record.get("author") or "").strip()
+    if not title:
+        return None, "brak tytułu"
+    if not author:
+        return None, "brak autora"
+    try:
+        year = int(str(record.get("year")).strip())
+    except ValueError:
+        return None, f"nieprawidłowy rok: {record.get('year')!r}"
+    if year > datetime.now().year + 1:
+        return None, f"rok z przyszłości: {year}"
+    try:
+        copies = int(str(record.get("copies") or 1).strip())
+    except ValueError:
+        return None, f"nieprawidłowa liczba egzemplarzy: {record.get('copies')!r}"
+    if copies < 1:
+        return None, f"nieprawidłowa liczba egzemplarzy: {copies}"
+    return {"title": title, "author": author, "year": year, "copies": copies}, None
+
+# Strumieniowy import książek paczkami przez insert() z executemany. Paczka i zapis postępu
+# są w jednej transakcji, więc po przerwaniu import rusza od pierwszej niezatwierdzonej paczki.
+def import_books(path, file_format=None, batch_size=5000, restart=False, max_errors_shown=10):
+    source = os.path.abspath(path)
+    file_format = file_format or CATALOGUE_FORMATS.get(os.path.splitext(path)[1].lower())
+    if file_format not in ("csv", "jsonl"):
+        raise ValueError("Nieznany format pliku - podaj --format csv albo jsonl.")
+    with session_scope() as session:
+        progress = session.get(ImportProgress, source)
+        if progress is None or restart:
+            session.merge(ImportProgress(source=source, records_done=0, imported=0, rejected=0, started_at=datetime.now(), updated_at=datetime.now(), finished_at=None))
+            skip, imported, rejected = 0, 0, 0
+        elif progress.finished_at is not None:
+            print(f"Plik został już zaimportowany ({progress.finished_at:%Y-%m-%d %H:%M}). Użyj --restart, aby wczytać go ponownie.")
+            return {"imported": 0, "rejected": 0, "resumed_from": progress.records_done}
+        else:
+            skip, imported, rejected = progress.records_done, progress.imported, progress.rejected
+            print(f"Wznawiam import od rekordu {skip + 1}.")
+    batch = []
+    records_done = skip
+    started = time.perf_counter()
+    imported_now = 0
+
+    def flush(finished=False):
+        nonlocal batch, imported_now
+        with current_engine().begin() as connection:
+            if batch:
+                copies = [values.pop("copies") for values in batch]
+                book_ids = connection.execute(insert(Book).returning(Book.id, sort_by_parameter_order=True), batch).scalars().all()
+                connection.execute(insert(Copy), [
+                    {"book_id": book_id} for book_id, count in zip(book_ids, copies) for _ in range(count)
+                ])
+            connection.execute(update(ImportProgress).where(ImportProgress.source == source).values(
+                records_done=records_done, imported=imported, rejected=rejected, updated_at=datetime.now(),
+                finished_at=datetime.now() if finished else None
+            ))
+        if batch:
+            available_books_cache.invalidate()
+            # Jedno zdarzenie na paczkę - zakres ID zamiast tysięcy wpisów
+            audit_log.record([audit_event("book.import", "book", book_ids[0], after={
+                "source": source, "count": len(book_ids), "first_id": book_ids[0], "last_id": book_ids[-1]})], current_branch.get())
+        imported_now += len(batch)
+        batch = []
+        elapsed = time.perf_counter() - started
+        print(f"Przetworzono {records_done} rekordów, zaimportowano {imported}, odrzucono {rejected} ({imported_now / elapsed if elapsed else 0:.0f} rekordów/s)")
+
+    for number, record in iter_catalogue_records(path, file_format):
+        if number <= skip:
+            continue
+        values, error = validate_book_record(record)
+        records_done = number
+        if error:
+            rejected += 1
+            if rejected <= max_errors_shown:
+                print(f"Rekord {number} odrzucony: {error}")
+        else:
+            batch.append(values)
+            imported += 1
+        if len(batch) >= batch_size:
+            flush()
+    flush(finished=True)
+    return {"imported": imported, "rejected": rejected, "resumed_from": skip}
+
+# EKSPORT DANYCH
+# Kolumny eksportowane dla każdej tabeli - hasła (password_hash) nigdy nie opuszczają bazy
+EXPORT_COLUMNS = {
+    "books": [Book.id, Book.title, Book.author, Book.year, Book.copies, Book.available],
+    "copies": [Copy.id, Copy.book_id, Copy.user_id],
+    "users": [User.id, User.username, User.name, User.surname, User.is_admin, User.activated, User.blocked],
+    "transactions": [Transaction.id, Transaction.book_id, Transaction.copy_id, Transaction.user_id, Transaction.borrowed_at, Transaction.due_date, Transaction.returned_at],
+    "transactions_archive": [ArchivedTransaction.id, ArchivedTransaction.book_id, ArchivedTransaction.copy_id, ArchivedTransaction.user_id,
+                             ArchivedTransaction.borrowed_at, ArchivedTransaction.due_date, ArchivedTransaction.returned_at],
+}
+
+# Zwraca kolejne paczki wierszy tabeli (kursor strumieniowy yield_per, w pamięci jest tylko jedna paczka).
+# since_id - tylko wiersze o ID większym niż podane; since - tylko transakcje wypożyczone lub zwrócone od tej chwili.
+def iter_export_batches(table, since_id=None, since=None, batch_size=1000):
+    columns = EXPORT_COLUMNS[table]
+    query = select(*columns).order_by(columns[0])
+    if since_id is not None:
+        query = query.where(columns[0] > since_id)
+    if since is not None:
+        source = columns[0].class_  # Transaction albo ArchivedTransaction
+        query = query.where((source.borrowed_at >= since) | (source.returned_at >= since))
+    # Cały eksport czyta jedną migawkę bazy (WAL), terminale mogą w tym czasie normalnie zapisywać
+    with session_scope() as session:
+        result = session.execute(query.execution_options(yield_per=batch_size))
+        for batch in result.partitions():
+            yield batch
+
+def export_value(value):
+    return value.isoformat(sep=" ") if isinstance(value, datetime) else value
+
+def write_csv_export(batches, names, output):
+    import csv
+    writer = csv.writer(output)
+    writer.writerow(names)
+    for batch in batches:
+        writer.writerows([["" if value is None else export_value(value) for value in row] for row in batch])
+        yield len(batch), batch[-1][0]
+
+def write_jsonl_export(batches, names, output):
+    for batch in batches:
+        output.writelines(json.dumps(dict(zip(names, map(export_value, row))), ensure_ascii=False) + "\n" for row in batch)
+        yield len(batch), batch[-1][0]
+
+# Parquet (kolumnowy) wymaga opcjonalnego pakietu pyarrow; każda paczka to osobna grupa wierszy
+def write_parquet_export(batches, columns, path):
+    import pyarrow
+    import pyarrow.parquet
+    types = {Integer: pyarrow.int64(), String: pyarrow.string(), Boolean: pyarrow.bool_(), DateTime: pyarrow.timestamp("us")}
+    schema = pyarrow.schema([(column.name, types[type(column.type)]) for column in columns])
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for batch in batches:
+            writer.write_table(pyarrow.Table.from_pylist([dict(zip(schema.names, row)) for row in batch], schema=schema))
+            yield len(batch), batch[-1][0]
+
+def export_table(table, file_format, path, since_id=None, since=None, batch_size=1000):
+    if since is not None and table not in ("transactions", "transactions_archive"):
+        raise ValueError("Eksport od daty jest dostępny tylko dla transakcji.")
+    columns = EXPORT_COLUMNS[table]
+    names = [column.name for column in columns]
+    batches = iter_export_batches(table, since_id, since, batch_size)
+    rows, last_id = 0, since_id
+    started = time.perf_counter()
+    if file_format == "parquet":
+        if path == "-":
+            raise ValueError("Eksport Parquet wymaga podania pliku wyjściowego.")
+        progress = write_parquet_export(batches, columns, path)
+        output = None
     else:
-        print("Nie ma książki o podanym ID.")
-
-def extend_borrow_period(book_id, extension_days):
-    book = session.query(Book).filter_by(id=book_id).first()
-    if book:
-        transaction = session.query(Transaction).filter_by(book_id=book.id, returned_at=None).first()
-        if transaction:
-            transaction.due_date += timedelta(days=extension_days)
-            session.commit()
-            print(f"Termin zwrotu książki '{book.title}' został przedłużony o {extension_days} dni.")
+        output = sys.stdout if path == "-" else open(path, "w", newline="", encoding="utf-8")
+        writer = write_csv_export if file_format == "csv" else write_jsonl_export
+        progress = writer(batches, names, output)
+    try:
+        for count, last_id in progress:
+            rows += count
+    finally:
+        if output not in (None, sys.stdout):
+            output.close()
+    elapsed = time.perf_counter() - started
+    # Komunikat na stderr, żeby nie mieszał się z danymi przy eksporcie na standardowe wyjście
+    print(f"Wyeksportowano {rows} wierszy z tabeli {table} w {elapsed:.2f} s.", file=sys.stderr)
+    if last_id is not None:
+        print(f"Ostatnie ID: {last_id} (użyj --since-id {last_id} przy następnym eksporcie)", file=sys.stderr)
+    return rows, last_id
+
+# API HTTP
+# Funkcje biblioteki wypisują komunikaty przez print. W serwerze sys.stdout zastępujemy tym obiektem:
+# wątek roboczy API może przechwycić swoje komunikaty i odesłać je klientowi, reszta trafia na konsolę.
+class ThreadOutput(io.TextIOBase):
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        return (buffer if buffer is not None else self.stream).write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+# Wywołuje funkcję biblioteki i zwraca (wynik, wypisany komunikat)
+def call_capturing_output(function, *args, **kwargs):
+    if not isinstance(sys.stdout, ThreadOutput):
+        sys.stdout = ThreadOutput(sys.stdout)
+    sys.stdout.local.buffer = io.StringIO()
+    try:
+        result = function(*args, **kwargs)
+        return result, sys.stdout.local.buffer.getvalue().strip()
+    finally:
+        sys.stdout.local.buffer = None
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+def user_to_dict(user):
+    return {"id": user.id, "username": user.username, "name": user.name, "surname": user.surname,
+            "is_admin": bool(user.is_admin), "activated": bool(user.activated), "blocked": bool(user.blocked)}
+
+def row_to_dict(names, row):
+    return dict(zip(names, map(export_value, row)))
+
+# Serwer asyncio obsługuje połączenia, a zapytania do bazy i bcrypt idą do puli wątków,
+# więc pętla zdarzeń nigdy nie czeka na dysk ani na haszowanie hasła.
+class LibraryApi:
+    TOKEN_LIFETIME = timedelta(hours=8)
+    MAX_BODY_SIZE = 1024 * 1024
+
+    def __init__(self, workers=8):
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="library-api")
+        self.tokens = {}  # token -> (ID użytkownika, oddział macierzysty, ważny do)
+        self.routes = [
+            ("POST", r"/api/login", self.login, None),
+            ("POST", r"/api/logout", self.logout, "user"),
+            ("GET", r"/api/books", self.search_books, "user"),
+            ("GET", r"/api/me/loans", self.my_loans, "user"),
+            ("GET", r"/api/me/holds", self.my_holds, "user"),
+            ("GET", r"/api/me/extensions", self.my_extensions, "user"),
+            ("POST", r"/api/books/(\d+)/borrow", self.borrow, "user"),
+            ("POST", r"/api/books/(\d+)/return", self.return_, "user"),
+            ("POST", r"/api/books/(\d+)/hold", self.place_hold, "user"),
+            ("DELETE", r"/api/books/(\d+)/hold", self.cancel_hold, "user"),
+            ("POST", r"/api/books/(\d+)/extend", self.extend, "admin"),
+            ("POST", r"/api/books/(\d+)/extension", self.request_extension, "user"),
+            ("GET", r"/api/extensions", self.extension_requests, "admin"),
+            ("POST", r"/api/extensions/(approve|reject)", self.decide_extensions, "admin"),
+            ("POST", r"/api/books/(\d+)/copies", self.add_copies, "admin"),
+            ("POST", r"/api/books", self.add_book, "admin"),
+            ("PATCH", r"/api/books/(\d+)", self.edit_book, "admin"),
+            ("DELETE", r"/api/books/(\d+)", self.delete_book, "admin"),
+            ("POST", r"/api/users", self.register_user, "admin"),
+            ("PATCH", r"/api/users/(\d+)", self.edit_user, "admin"),
+            ("DELETE", r"/api/users/(\d+)", self.delete_user, "admin"),
+            ("PUT", r"/api/users/(\d+)/blocked", self.set_blocked, "admin"),
+            ("PUT", r"/api/users/(\d+)/activated", self.set_activated, "admin"),
+            ("PUT", r"/api/users/(\d+)/password", self.set_password, "admin"),
+            ("GET", r"/api/transactions", self.transactions, "admin"),
+            ("GET", r"/api/overdue", self.overdue, "admin"),
+            ("GET", r"/api/stats", self.statistics, "admin"),
+            ("GET", r"/api/cache", self.cache_statistics, "admin"),
+            ("GET", r"/api/audit", self.audit, "admin"),
+            ("GET", r"/api/metrics", self.metrics, "admin"),
+        ]
+        self.routes = [(method, re.compile(pattern + "$"), handler, access) for method, pattern, handler, access in self.routes]
+
+    async def run(self, function, *args, **kwargs):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        # Kontekst żądania (m.in. current_actor) przechodzi do wątku roboczego
+        return await loop.run_in_executor(self.executor, copy_context().run, lambda: call_capturing_output(function, *args, **kwargs))
+
+    # Wynik operacji biblioteki zamieniony na odpowiedź: 200 przy sukcesie, 409 z komunikatem przy odmowie
+    async def run_operation(self, function, *args, **kwargs):
+        succeeded, message = await self.run(function, *args, **kwargs)
+        if not succeeded:
+            raise ApiError(409, message or "Operacja nie powiodła się.")
+        return 200, {"ok": True, "message": message}
+
+    async def authenticate(self, headers, access):
+        current_branch.set(None)  # Połączenie keep-alive obsługuje kolejne żądania w tym samym kontekście
+        if access is None:
+            return None
+        token = headers.get("authorization", "").removeprefix("Bearer ").strip()
+        user_id, branch, valid_until = self.tokens.get(token, (None, None, None))
+        if user_id is None or valid_until < datetime.now():
+            self.tokens.pop(token, None)
+            raise ApiError(401, "Wymagane logowanie.")
+        # Operacje zalogowanego idą do bazy jego oddziału (kontekst przechodzi do wątków roboczych)
+        current_branch.set(branch)
+        user, _ = await self.run(get_user, user_id)
+        if user is None or not user.activated:
+            self.tokens.pop(token, None)
+            raise ApiError(403, "Twoje konto zostało dezaktywowane, skontaktuj się z administratorem.")
+        if access == "admin" and not user.is_admin:
+            raise ApiError(403, "Operacja dostępna tylko dla administratora.")
+        return user
+
+    async def dispatch(self, method, target, headers, body):
+        url = urllib.parse.urlsplit(target)
+        query = {name: values[-1] for name, values in urllib.parse.parse_qs(url.query).items()}
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            raise ApiError(400, "Treść żądania nie jest poprawnym JSON.")
+        path_matched = False
+        for route_method, pattern, handler, access in self.routes:
+            match = pattern.match(url.path)
+            if match is None:
+                continue
+            path_matched = True
+            if route_method == method:
+                user = await self.authenticate(headers, access)
+                current_actor.set(user.id if user else None)
+                if not profiler.enabled:
+                    return await handler(user, payload, query, *match.groups())
+                started = time.perf_counter()
+                try:
+                    return await handler(user, payload, query, *match.groups())
+                finally:
+                    profiler.observe("api", f"{method} {pattern.pattern}", time.perf_counter() - started)
+        raise ApiError(405 if path_matched else 404, "Nieobsługiwana metoda." if path_matched else "Nie ma takiego zasobu.")
+
+    async def handle_connection(self, reader, writer):
+        import asyncio
+        from http import HTTPStatus
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body_read = False  # Bez przeczytanej treści nie wiadomo, gdzie zaczyna się następne żądanie - zamykamy połączenie
+                try:
+                    length = headers.get("content-length", "0")  # Pusty nagłówek to błąd, a nie treść długości 0
+                    if not re.fullmatch(r"[0-9]+", length):
+                        raise ApiError(400, "Nieprawidłowy nagłówek Content-Length.")
+                    length = int(length)
+                    if length > self.MAX_BODY_SIZE:
+                        raise ApiError(413, "Zbyt duże żądanie.")
+                    body = await reader.readexactly(length) if length else b""
+                    body_read = True
+                    body = body.decode("utf-8")
+                    status, response = await self.dispatch(method, target, headers, body)
+                except ApiError as error:
+                    status, response = error.status, {"ok": False, "message": error.message}
+                except (ValueError, TypeError) as error:
+                    status, response = 400, {"ok": False, "message": f"Nieprawidłowe dane: {error}"}
+                except Exception:
+                    # Szczegóły (np. treść zapytania SQL) tylko w dzienniku serwera, klient dostaje ogólny komunikat
+                    import traceback
+                    print(f"Błąd serwera przy {method} {target}:\n{traceback.format_exc()}", file=sys.stderr)
+                    status, response = 500, {"ok": False, "message": "Błąd serwera."}
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close" and body_read
+                data = json.dumps(response, ensure_ascii=False).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                    f"Content-Type: application/json; charset=utf-8\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port, ready=None):
+        import asyncio
+        server = await asyncio.start_server(self.handle_connection, host, port, backlog=1024)
+        if ready is not None:
+            ready(server.sockets[0].getsockname()[1])
+        async with server:
+            await server.serve_forever()
+
+    # Endpointy
+    async def login(self, user, payload, query):
+        import secrets
+        username = str(payload.get("username", ""))
+        branch, _ = await self.run(find_user_branch, username)
+        current_branch.set(branch)
+        user, _ = await self.run(login_user, username, str(payload.get("password", "")))
+        if user is None:
+            raise ApiError(401, "Nieprawidłowe dane logowania.")
+        if not user.activated:
+            raise ApiError(403, "Twoje konto zostało dezaktywowane, skontaktuj się z administratorem.")
+        # Przy okazji logowania usuwamy tokeny, które wygasły - bez tego słownik rośnie o każdą sesję, której nikt nie wylogował
+        now = datetime.now()
+        self.tokens = {token: entry for token, entry in self.tokens.items() if entry[2] >= now}
+        token = secrets.token_urlsafe(32)
+        self.tokens[token] = (user.id, branch, now + self.TOKEN_LIFETIME)
+        return 200, {"ok": True, "token": token, "user": user_to_dict(user), "branch": branch}
+
+    async def logout(self, user, payload, query):
+        # ID kont powtarzają się między oddziałami, więc konto to para (ID, oddział)
+        self.tokens = {token: entry for token, entry in self.tokens.items() if entry[:2] != (user.id, current_branch.get())}
+        return 200, {"ok": True}
+
+    # Z oddziałami przeszukuje wszystkie oddziały, a każda książka ma pole branch;
+    # oddziały, które nie odpowiedziały, są w polu unavailable_branches
+    async def search_books(self, user, payload, query):
+        limit = min(int(query.get("limit", 50)), 500)
+        unavailable = []
+        if BRANCHES:
+            (books, unavailable), _ = await self.run(find_books_in_branches, query.get("q", ""), limit)
         else:
-            print("Książka nie jest obecnie wypożyczona.")
+            books, _ = await self.run(find_books, query.get("q", ""), limit)
+        names = (["branch"] if BRANCHES else []) + ["id", "title", "author", "year", "available", "copies"]
+        if books or not query.get("q", "").strip():
+            response = {"ok": True, "books": [row_to_dict(names, book) for book in books]}
+        else:
+            # Bez dokładnych wyników - podobne tytuły z oceną podobieństwa (fuzzy=true)
+            if BRANCHES:
+                (similar, unavailable), _ = await self.run(find_similar_books_in_branches, query["q"], min(limit, 50))
+            else:
+                similar, _ = await self.run(find_similar_books, query["q"], min(limit, 50))
+            response = {"ok": True, "fuzzy": True, "books": [{**row_to_dict(names, book), "similarity": round(similarity, 3)} for book, similarity in similar]}
+        if unavailable:
+            response["unavailable_branches"] = [branch for branch, _ in unavailable]
+        return 200, response
+
+    async def my_loans(self, user, payload, query):
+        loans, _ = await self.run(find_user_loans, user.id)
+        names = ["id", "title", "author", "year", "borrowed_at", "due_date"]
+        return 200, {"ok": True, "loans": [row_to_dict(names, loan) for loan in loans]}
+
+    async def my_holds(self, user, payload, query):
+        holds, _ = await self.run(find_user_holds, user.id)
+        names = ["book_id", "title", "author", "position", "created_at", "expires_at"]
+        return 200, {"ok": True, "holds": [row_to_dict(names, hold) for hold in holds]}
+
+    async def borrow(self, user, payload, query, book_id):
+        return await self.run_operation(borrow_book, user, int(book_id))
+
+    async def return_(self, user, payload, query, book_id):
+        return await self.run_operation(return_book, user, int(book_id))
+
+    async def place_hold(self, user, payload, query, book_id):
+        return await self.run_operation(place_hold, user, int(book_id))
+
+    async def cancel_hold(self, user, payload, query, book_id):
+        return await self.run_operation(cancel_hold, user, int(book_id))
+
+    async def my_extensions(self, user, payload, query):
+        requests, _ = await self.run(find_user_extension_requests, user.id, min(int(query.get("limit", 10)), 1000))
+        names = ["id", "title", "days", "status", "reason", "created_at"]
+        return 200, {"ok": True, "extensions": [row_to_dict(names, request) for request in requests]}
+
+    async def request_extension(self, user, payload, query, book_id):
+        days = int(payload.get("days", EXTENSION_DAYS))
+        if not 1 <= days <= EXTENSION_DAYS:
+            raise ApiError(400, f"Przedłużenie musi wynosić od 1 do {EXTENSION_DAYS} dni.")
+        return await self.run_operation(request_extension, user, int(book_id), days)
+
+    # Jedna strona oczekujących próśb; kolejną pobiera się z after_id równym ostatniemu ID strony
+    async def extension_requests(self, user, payload, query):
+        pager = extension_requests_pager(min(int(query.get("limit", 100)), 1000))
+        after_id = int(query.get("after_id", 0))
+        page, _ = await self.run(pager.fetch, (after_id, after_id))
+        rows, has_more = page
+        names = ["id", "username", "title", "due_date", "days", "created_at"]
+        return 200, {"ok": True, "extensions": [row_to_dict(names, row[:-1]) for row in rows],
+                     "next_after_id": rows[-1][0] if has_more else None}
+
+    # Body: {"ids": [...]} albo {"all": true}, przy odrzuceniu opcjonalnie {"reason": "..."}
+    async def decide_extensions(self, user, payload, query, decision):
+        if payload.get("all"):
+            ids = None
+        elif isinstance(payload.get("ids"), list) and payload["ids"]:
+            ids = [int(request_id) for request_id in payload["ids"]]
+        else:
+            raise ApiError(400, "Podaj listę ids albo all=true.")
+        results, _ = await self.run(decide_extension_requests, ids, decision == "approve", user.id, payload.get("reason"))
+        return 200, {"ok": True, "results": results}
+
+    # Filtry jak w poleceniu audit: actor_id, target (typ lub typ:ID), action, since, until (ISO), limit
+    async def audit(self, user, payload, query):
+        target_type, _, target_id = query.get("target", "").partition(":")
+        rows, _ = await self.run(
+            query_audit_log, int(query["actor_id"]) if "actor_id" in query else None, target_type or None,
+            int(target_id) if target_id else None, query.get("action"),
+            datetime.fromisoformat(query["since"]) if "since" in query else None,
+            datetime.fromisoformat(query["until"]) if "until" in query else None, min(int(query.get("limit", 100)), 1000)
+        )
+        names = ["occurred_at", "actor_id", "actor", "action", "target_type", "target_id", "before", "after"]
+        events = [row_to_dict(names, row) for row in rows]
+        for event in events:
+            event["before"], event["after"] = (json.loads(value) if value else None for value in (event["before"], event["after"]))
+        return 200, {"ok": True, "events": events}
+
+    async def extend(self, user, payload, query, book_id):
+        user_id = payload.get("user_id")
+        return await self.run_operation(extend_borrow_period, int(book_id), int(payload.get("days", 30)), int(user_id) if user_id is not None else None)
+
+    async def add_copies(self, user, payload, query, book_id):
+        count = int(payload.get("count", 1))
+        if count < 1:
+            raise ApiError(400, "Liczba egzemplarzy musi być dodatnia.")
+        return await self.run_operation(add_copies, int(book_id), count)
+
+    async def add_book(self, user, payload, query):
+        values, error = validate_book_record(payload)
+        if error:
+            raise ApiError(400, error)
+        book, _ = await self.run(add_book, **values)
+        return 201, {"ok": True, "id": book.id}
+
+    async def edit_book(self, user, payload, query, book_id):
+        year = payload.get("year")
+        return await self.run_operation(edit_book, int(book_id), payload.get("title"), payload.get("author"), int(year) if year is not None else None)
+
+    async def delete_book(self, user, payload, query, book_id):
+        return await self.run_operation(delete_book, int(book_id))
+
+    async def register_user(self, user, payload, query):
+        username, password = str(payload.get("username", "")).strip(), str(payload.get("password", ""))
+        if not username or not password:
+            raise ApiError(400, "Podaj nazwę użytkownika i hasło.")
+        return await self.run_operation(register_user, username, password, bool(payload.get("is_admin", False)))
+
+    async def edit_user(self, user, payload, query, user_id):
+        edited, _ = await self.run(get_user, int(user_id))
+        if edited is None:
+            raise ApiError(404, "Nie ma użytkownika o podanym ID.")
+        fields = {field: payload[field] for field in ("name", "surname", "is_admin", "username") if field in payload}
+        edited, message = await self.run(edit_user_data, edited, **fields)
+        if edited is None:
+            raise ApiError(409, message or "Operacja nie powiodła się.")
+        return 200, {"ok": True, "message": message, "user": user_to_dict(edited)}
+
+    async def delete_user(self, user, payload, query, user_id):
+        deleted, _ = await self.run(get_user, int(user_id))
+        if deleted is None:
+            raise ApiError(404, "Nie ma użytkownika o podanym ID.")
+        return await self.run_operation(delete_user, deleted.username)
+
+    async def set_blocked(self, user, payload, query, user_id):
+        return await self.run_operation(change_blocked_status, int(user_id), bool(payload.get("blocked")))
+
+    async def set_activated(self, user, payload, query, user_id):
+        return await self.run_operation(change_activated_status, int(user_id), bool(payload.get("activated")))
+
+    async def set_password(self, user, payload, query, user_id):
+        if not payload.get("password"):
+            raise ApiError(400, "Podaj nowe hasło.")
+        return await self.run_operation(change_password_by_admin, int(user_id), str(payload["password"]))
+
+    # Jedna strona historii; kolejną pobiera się z after_id równym ostatniemu ID strony
+    async def transactions(self, user, payload, query):
+        status = query.get("status")
+        if status is not None and status not in TRANSACTION_STATUSES:
+            raise ApiError(400, f"Status musi być jednym z: {', '.join(TRANSACTION_STATUSES)}.")
+        filter_user = int(query["user_id"]) if "user_id" in query else None
+        page_size = min(int(query.get("limit", 100)), 1000)
+        pages = iter_transaction_pages(status, filter_user, page_size=page_size, after_id=int(query.get("after_id", 0)))
+        page, _ = await self.run(next, pages, [])
+        names = ["id", "username", "title", "borrowed_at", "due_date", "returned_at"]
+        return 200, {"ok": True, "transactions": [row_to_dict(names, row) for row in page],
+                     "next_after_id": page[-1][0] if len(page) == page_size else None}
+
+    async def overdue(self, user, payload, query):
+        (summary, created), _ = await self.run(scan_overdue_loans)
+        users = [{"user_id": user_id, "username": username, "overdue": count, "oldest_due_date": export_value(oldest_due)}
+                 for user_id, (username, count, oldest_due) in summary.items()]
+        return 200, {"ok": True, "users": users, "new_notifications": created}
+
+    async def statistics(self, user, payload, query):
+        stats, _ = await self.run(get_circulation_stats, min(int(query.get("limit", 10)), 100))
+        return 200, {
+            "ok": True, "loans": stats["loans"], "borrowed": stats["borrowed"],
+            "top_books": [row_to_dict(["id", "title", "author", "loans", "borrowed"], row) for row in stats["top_books"]],
+            "top_users": [row_to_dict(["id", "username", "loans", "borrowed"], row) for row in stats["top_users"]],
+            "top_authors": [row_to_dict(["author", "loans"], row) for row in stats["top_authors"]],
+        }
+
+    async def cache_statistics(self, user, payload, query):
+        names = ["name", "entries", "maxsize", "hits", "misses", "hit_ratio", "evictions", "invalidations"]
+        return 200, {"ok": True, "caches": [dict(zip(names, cache.stats())) for cache in (user_cache, book_cache, available_books_cache)]}
+
+    # Profil bieżącego procesu serwera (LIBRARY_PROFILE=1); przy wyłączonym profilowaniu tylko informacja o tym
+    async def metrics(self, user, payload, query):
+        if not profiler.enabled:
+            return 200, {"ok": True, "enabled": False}
+        return 200, {"ok": True, "enabled": True, **profiler.snapshot()}
+
+# Prosty klient API do testów i skryptów: zwraca (status HTTP, odpowiedź JSON)
+def call_api(base_url, method, path, payload=None, token=None):
+    import urllib.request, urllib.error
+    data = json.dumps(payload).encode("utf-8") if payload is not None else None
+    request = urllib.request.Request(base_url + path, data=data, method=method)
+    request.add_header("Content-Type", "application/json")
+    if token:
+        request.add_header("Authorization", f"Bearer {token}")
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read() or b"{}")
+
+# NARZĘDZIA ADMINISTRACYJNE (wiersz poleceń)
+# Najczęstsze zapytania aplikacji z przykładowymi parametrami - do sprawdzania planów zapytań
+def hot_queries():
+    now = datetime.now()
+    return [
+        ("count_user_borrowed_books", select(func.count(Transaction.id)).where(Transaction.user_id == 1, Transaction.returned_at.is_(None))),
+        ("borrow_book (wolny egzemplarz)", select(Copy.id).where(Copy.book_id == 1, Copy.user_id.is_(None)).limit(1)),
+        ("borrow_book (egzemplarz czytelnika)", select(Copy.id).where(Copy.book_id == 1, Copy.user_id == 1)),
+        ("return_book", select(Transaction.id).where(Transaction.copy_id == 1, Transaction.user_id == 1, Transaction.returned_at.is_(None))),
+        ("extend_borrow_period", select(Transaction.id).where(Transaction.book_id == 1, Transaction.returned_at.is_(None))),
+        ("display_user_books", select(Book.id, Transaction.due_date).join(Transaction, Transaction.book_id == Book.id)
+            .join(Copy, Copy.id == Transaction.copy_id).where(Transaction.user_id == 1, Transaction.returned_at.is_(None), Copy.user_id == 1)),
+        ("egzemplarze wypożyczone przez użytkownika", select(Copy.id).where(Copy.user_id == 1)),
+        ("przeterminowane wypożyczenia", select(Transaction.id).where(Transaction.returned_at.is_(None), Transaction.due_date < now)),
+        ("scan_overdue_loans", select(Transaction.id).where(
+            Transaction.returned_at.is_(None), Transaction.due_date < now,
+            tuple_(Transaction.due_date, Transaction.id) > tuple_(now, 0)).order_by(Transaction.due_date, Transaction.id)),
+        ("next_holder", select(Hold.id).where(Hold.book_id == 1, Hold.status == 'waiting', Hold.expires_at > now).order_by(Hold.id).limit(1)),
+        ("expire_holds", select(Hold.id).where(Hold.status == 'waiting', Hold.expires_at <= now).order_by(Hold.expires_at).limit(1000)),
+        ("display_extension_requests", select(ExtensionRequest.id, User.username, Book.title, Transaction.due_date).where(
+            ExtensionRequest.status == 'pending', User.id == ExtensionRequest.user_id, Transaction.id == ExtensionRequest.transaction_id,
+            Book.id == Transaction.book_id, ExtensionRequest.id > 0).order_by(ExtensionRequest.id).limit(21)),
+        ("deliver_notifications", select(Notification.id).where(Notification.sent_at.is_(None)).order_by(Notification.id)),
+        ("display_transactions (użytkownik)", select(Transaction.id).where(Transaction.user_id == 1, Transaction.id > 0).order_by(Transaction.id)),
+        ("search_book (rok)", select(Book.id).where(Book.year == 1984)),
+        ("display_all_books (strona wg tytułu)", select(Book.id, Book.title).where(
+            tuple_(Book.title, Book.id) > tuple_("M", 0)).order_by(Book.title, Book.id).limit(21)),
+        ("display_all_users (strona wg nazwy)", select(User.id, User.username).where(
+            tuple_(User.username, User.id) > tuple_("m", 0)).order_by(User.username, User.id).limit(21)),
+        ("login_user", select(User.id).where(User.username == "admin")),
+    ]
+
+# Zwraca plan zapytania jako listę wierszy "detail" z EXPLAIN QUERY PLAN
+def explain_query(connection, statement):
+    compiled = statement.compile(dialect=engine.dialect)
+    parameters = tuple(compiled.params[name] for name in compiled.positiontup)
+    return [row[-1] for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + str(compiled), parameters)]
+
+def check_query_plans():
+    results = []
+    with engine.connect() as connection:
+        for name, statement in hot_queries():
+            plan = explain_query(connection, statement)
+            # Pełny skan tabeli to "SCAN <tabela>" bez indeksu
+            uses_index = not any(step.startswith("SCAN ") and " INDEX " not in step for step in plan)
+            results.append([name, "\n".join(plan), "OK" if uses_index else "BRAK INDEKSU"])
+    print(tabulate(results, headers=["Zapytanie", "Plan", "Wynik"], tablefmt="grid"))
+    return all(result[2] == "OK" for result in results)
+
+# Dane demonstracyjne. Powtórne wywołanie niczego nie dubluje: istniejących kont nie haszuje od nowa,
+# a książki dodaje tylko wtedy, gdy nie ma jeszcze tytułu tego autora.
+DEMO_USERS = [("admin", "admin123", True), ("user1", "user123", False)]
+DEMO_BOOKS = [
+    {"title": "Harry Potter and the Philosopher's Stone", "author": "J.K. Rowling", "year": 1997},
+    {"title": "To Kill a Mockingbird", "author": "Harper Lee", "year": 1960},
+    {"title": "1984", "author": "George Orwell", "year": 1949},
+]
+
+def seed_demo_data():
+    created = {"users": 0, "books": 0}
+    with session_scope() as session:
+        usernames = set(session.scalars(select(User.username).where(User.username.in_([username for username, _, _ in DEMO_USERS]))))
+        books = set(session.execute(select(Book.title, Book.author).where(Book.title.in_([book["title"] for book in DEMO_BOOKS]))).all())
+    for username, password, is_admin in DEMO_USERS:
+        if username not in usernames and register_user(username, password, is_admin):
+            created["users"] += 1
+    for book in DEMO_BOOKS:
+        if (book["title"], book["author"]) not in books:
+            add_book(**book)
+            created["books"] += 1
+    return created
+
+# Poprzednie wersje dodawały książki demonstracyjne przy każdym starcie. Usuwamy powtórzenia, których nikt
+# nigdy nie wypożyczył - zostaje najstarszy wpis tytułu, a historia wypożyczeń zostaje nietknięta.
+def remove_demo_duplicates():
+    removed = 0
+    for book in DEMO_BOOKS:
+        with engine.connect() as connection:
+            duplicates = connection.execute(
+                select(Book.id).where(Book.title == book["title"], Book.author == book["author"])
+                .where(~select(Transaction.id).where(Transaction.book_id == Book.id).exists())
+                .where(Book.id != select(func.min(Book.id)).where(Book.title == book["title"], Book.author == book["author"]).scalar_subquery())
+            ).scalars().all()
+        for book_id in duplicates:
+            succeeded, _ = call_capturing_output(delete_book, book_id)
+            removed += bool(succeeded)
+    return removed
+
+def command_init(args):
+    with engine.connect() as connection:
+        versions = connection.exec_driver_sql("SELECT version, description, applied_at FROM schema_version ORDER BY version").all()
+    print(f"Schemat bazy w wersji {versions[-1][0]} (ostatnia migracja: {versions[-1][1]}, {versions[-1][2]}).")
+    if args.admin:
+        if get_user_by_username(args.admin):
+            print(f"Konto '{args.admin}' już istnieje - bez zmian.")
+        else:
+            password = getpass(f"Hasło dla '{args.admin}': ")
+            if not password or password != getpass("Powtórz hasło: "):
+                print("Hasła są puste albo różne - konta nie utworzono.")
+                return 1
+            register_user(args.admin, password, True)
+            print(f"Utworzono konto administratora '{args.admin}'.")
+    if args.demo:
+        created = seed_demo_data()
+        removed = remove_demo_duplicates()
+        print(f"Dane demonstracyjne: nowe konta {created['users']}, nowe książki {created['books']}, usunięte powtórzenia książek {removed}.")
+    return 0
+
+def command_migrate(args):
+    with engine.connect() as connection:
+        versions = connection.exec_driver_sql("SELECT version, description, applied_at FROM schema_version ORDER BY version").all()
+    print(tabulate(versions, headers=["Wersja", "Opis", "Zastosowano"], tablefmt="grid"))
+    return 0
+
+# Stan wszystkich oddziałów, sprawdzany równolegle; przy okazji każda baza dostaje brakujące migracje
+def command_branches(args):
+    if not BRANCHES:
+        print("Oddziały nie są skonfigurowane - ustaw LIBRARY_BRANCHES, np. centrum=sqlite:///centrum.db,polnoc=sqlite:///polnoc.db")
+        return 1
+
+    def summary():
+        with session_scope() as session:
+            return (
+                session.execute(select(func.count(User.id))).scalar(),
+                session.execute(select(func.count(Book.id))).scalar(),
+                f"{session.execute(select(func.coalesce(func.sum(Book.available), 0))).scalar()} z {session.execute(select(func.count(Copy.id))).scalar()}",
+                session.execute(select(func.count(Transaction.id)).where(Transaction.returned_at.is_(None))).scalar(),
+            )
+
+    rows = [[branch + (" (ten terminal)" if branch == BRANCH else ""), BRANCHES[branch], *(result or ["-"] * 4), "błąd" if error else "OK"]
+            for branch, result, error in fan_out(summary)]
+    print(tabulate(rows, headers=["Oddział", "Baza", "Czytelnicy", "Tytuły", "Wolne egzemplarze", "Wypożyczone", "Stan"], tablefmt="grid"))
+    return 1 if any(row[-1] != "OK" for row in rows) else 0
+
+def command_check_indexes(args):
+    return 0 if check_query_plans() else 1
+
+# Proces roboczy testu obciążeniowego: losowo wypożycza i oddaje książki na wspólnej bazie
+def stress_worker(url, user_id, book_ids, operations, seed, results):
+    engine.dispose(close=False)  # Połączeń z puli rodzica nie wolno używać po fork
+    configure_database(url)
+    user = get_user(user_id)
+    generator = random.Random(seed)
+    borrowed = set()
+    counts = {"operations": 0, "borrowed": 0, "returned": 0, "lost": 0}
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            for _ in range(operations):
+                book_id = generator.choice(book_ids)
+                if book_id in borrowed:
+                    if return_book(user, book_id):
+                        borrowed.discard(book_id)
+                        counts["returned"] += 1
+                elif borrow_book(user, book_id):
+                    borrowed.add(book_id)
+                    counts["borrowed"] += 1
+                else:
+                    counts["lost"] += 1
+                counts["operations"] += 1
+        finally:
+            sys.stdout = stdout
+            audit_log.flush()  # Procesy multiprocessing kończą się bez atexit
+    results.put(counts)
+
+# Szuka naruszeń spójności wypożyczeń; zwraca listę opisów problemów
+def find_loan_anomalies(connection):
+    anomalies = []
+    for copy_id, open_loans in connection.exec_driver_sql(
+        "SELECT copy_id, count(*) FROM transactions WHERE returned_at IS NULL GROUP BY copy_id HAVING count(*) > 1"
+    ):
+        anomalies.append(f"Egzemplarz {copy_id} ma {open_loans} otwarte wypożyczenia")
+    for copy_id, copy_user_id, loan_user_id in connection.exec_driver_sql(
+        "SELECT c.id, c.user_id, t.user_id FROM copies c "
+        "LEFT JOIN transactions t ON t.copy_id = c.id AND t.returned_at IS NULL "
+        "WHERE c.user_id IS NOT t.user_id"
+    ):
+        anomalies.append(f"Egzemplarz {copy_id}: copies.user_id={copy_user_id}, otwarte wypożyczenie użytkownika {loan_user_id}")
+    for user_id, book_id, copies in connection.exec_driver_sql(
+        "SELECT user_id, book_id, count(*) FROM copies WHERE user_id IS NOT NULL GROUP BY user_id, book_id HAVING count(*) > 1"
+    ):
+        anomalies.append(f"Użytkownik {user_id} ma {copies} egzemplarze książki {book_id}")
+    for book_id, copies, available, counted, counted_available in connection.exec_driver_sql(
+        "SELECT b.id, b.copies, b.available, count(c.id), count(c.id) - count(c.user_id) FROM books b "
+        "LEFT JOIN copies c ON c.book_id = b.id GROUP BY b.id "
+        "HAVING b.copies != count(c.id) OR b.available != count(c.id) - count(c.user_id)"
+    ):
+        anomalies.append(f"Książka {book_id}: liczniki {available} z {copies}, egzemplarze {counted_available} z {counted}")
+    return anomalies
+
+def command_stress(args):
+    import multiprocessing
+    database_path = args.db or os.path.join(tempfile.mkdtemp(prefix="library-stress-"), "library.db")
+    url = f"sqlite:///{database_path}"
+    configure_database(url)
+    # Użytkownicy testowi z gotowym hashem - bcrypt nie jest przedmiotem tego testu
+    import bcrypt
+    password_hash = bcrypt.hashpw(b"stress", bcrypt.gensalt(4))
+    with session_scope() as session:
+        users = [User(username=f"stress-{time.time_ns()}-{number}", password_hash=password_hash, name="Stress", surname=str(number))
+                 for number in range(args.processes)]
+        books = [Book(title=f"Stress {number}", author="Stress", year=2000) for number in range(args.books)]
+        session.add_all(users + books)
+        session.flush()
+        session.execute(insert(Copy), [{"book_id": book.id} for book in books for _ in range(args.copies)])
+    user_ids = [user.id for user in users]
+    book_ids = [book.id for book in books]
+    print(f"Baza: {database_path}, procesy: {args.processes}, operacje na proces: {args.operations}, książki: {args.books} po {args.copies} egz.")
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=stress_worker, args=(url, user_id, book_ids, args.operations, number, results))
+        for number, user_id in enumerate(user_ids)
+    ]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    counts = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    total = {key: sum(count[key] for count in counts) for key in counts[0]}
+    print(f"Operacje: {total['operations']} w {elapsed:.2f} s ({total['operations'] / elapsed:.0f} operacji/s)")
+    print(f"Wypożyczenia: {total['borrowed']}, zwroty: {total['returned']}, przegrane wyścigi: {total['lost']}")
+    with engine.connect() as connection:
+        anomalies = find_loan_anomalies(connection)
+    for anomaly in anomalies:
+        print(anomaly)
+    print("Brak podwójnych wypożyczeń." if not anomalies else f"Znaleziono {len(anomalies)} niespójności!")
+    return 1 if anomalies else 0
+
+def command_import_books(args):
+    try:
+        import_books(args.file, args.format, args.batch_size, args.restart)
+    except (OSError, ValueError) as error:
+        print(error)
+        return 1
+    return 0
+
+def command_export(args):
+    try:
+        since = datetime.fromisoformat(args.since) if args.since else None
+        export_table(args.table, args.format, args.output, args.since_id, since, args.batch_size)
+    except ImportError:
+        print("Eksport do Parquet wymaga pakietu pyarrow (pip install pyarrow).", file=sys.stderr)
+        return 1
+    except (OSError, ValueError) as error:
+        print(error, file=sys.stderr)
+        return 1
+    return 0
+
+# Jednorazowy albo cykliczny (--every) skan zaległości z opcjonalnym przeniesieniem powiadomień do pliku
+def command_scan_overdue(args):
+    while True:
+        started = time.perf_counter()
+        summary, created = scan_overdue_loans(batch_size=args.batch_size)
+        display_overdue_summary(summary)
+        print(f"Nowe powiadomienia: {created}, czas skanu: {time.perf_counter() - started:.3f} s")
+        if args.outbox:
+            print(f"Przeniesiono do {args.outbox}: {deliver_notifications(args.outbox)}")
+        if not args.every:
+            return 0
+        time.sleep(args.every)
+
+def command_archive_transactions(args):
+    while True:
+        started = time.perf_counter()
+        archived = archive_transactions(args.older_than_days, args.batch_size)
+        with session_scope() as session:
+            live = session.execute(select(func.count(Transaction.id))).scalar()
+            in_archive = session.execute(select(func.count(ArchivedTransaction.id))).scalar()
+        print(f"Zarchiwizowane wypożyczenia: {archived}, czas: {time.perf_counter() - started:.3f} s "
+              f"(w tabeli transactions: {live}, w archiwum: {in_archive})")
+        if not args.every:
+            return 0
+        time.sleep(args.every)
+
+def command_expire_holds(args):
+    while True:
+        started = time.perf_counter()
+        expired = expire_holds(batch_size=args.batch_size)
+        print(f"Wygaszone rezerwacje: {expired}, czas: {time.perf_counter() - started:.3f} s")
+        if not args.every:
+            return 0
+        time.sleep(args.every)
+
+# Czas skanu dla różnej liczby zaległych wypożyczeń przy mniejszej i pełnej tabeli transakcji.
+# Historia to zwrócone wypożyczenia, a otwarte mają terminy rozłożone co minutę, więc liczbę zaległych
+# wybiera się chwilą skanu.
+def command_bench_overdue(args):
+    configure_database(f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='library-bench-'), 'library.db')}")
+    now = datetime.now()
+    open_loans = max(args.overdue) * 2
+    with session_scope() as session:
+        session.execute(insert(User), [{"username": f"reader{number}", "password_hash": b"", "activated": True} for number in range(1, 1001)])
+        session.execute(insert(Book), [{"title": f"Książka {number}", "author": "Autor", "year": 2000} for number in range(open_loans)])
+        session.execute(insert(Transaction), [
+            {"book_id": number + 1, "user_id": number % 1000 + 1, "borrowed_at": now - timedelta(days=60),
+             "due_date": now - timedelta(minutes=max(args.overdue) - number)}
+            for number in range(open_loans)
+        ])
+    rows = []
+    table_size = open_loans
+    for target_size in (args.loans // 10, args.loans):
+        while table_size < target_size:
+            chunk = min(50000, target_size - table_size)
+            with session_scope() as session:
+                session.execute(insert(Transaction), [
+                    {"book_id": random.randint(1, open_loans), "user_id": random.randint(1, 1000),
+                     "borrowed_at": now - timedelta(days=400), "due_date": now - timedelta(days=random.randint(100, 370)),
+                     "returned_at": now - timedelta(days=99)}
+                    for _ in range(chunk)
+                ])
+            table_size += chunk
+        for overdue in args.overdue:
+            with session_scope() as session:
+                session.execute(text("DELETE FROM notifications"))
+            started = time.perf_counter()
+            summary, created = scan_overdue_loans(now - timedelta(minutes=max(args.overdue) - overdue))
+            elapsed = time.perf_counter() - started
+            if created != overdue:
+                print(f"Błąd: oczekiwano {overdue} zaległych, znaleziono {created}.")
+                return 1
+            rows.append([table_size, overdue, f"{elapsed:.3f}", f"{elapsed / overdue * 1e6:.1f}"])
+    print(tabulate(rows, headers=["Transakcje", "Zaległe", "Czas skanu [s]", "µs na zaległe"], tablefmt="grid"))
+    return 0
+
+# Sprawdza zgodność statystyk z transakcjami i (bez --check) przelicza je od zera
+def command_rebuild_stats(args):
+    with engine.begin() as connection:
+        differences = check_statistics(connection)
+        print(tabulate(sorted(differences.items()), headers=["Tabela", "Niezgodne wiersze"], tablefmt="grid"))
+        if args.check:
+            return 0 if not any(differences.values()) else 1
+        started = time.perf_counter()
+        rebuild_statistics(connection)
+    print(f"Statystyki przeliczone w {time.perf_counter() - started:.2f} s.")
+    return 0
+
+# Odczyt statystyk z tabel podsumowań kontra GROUP BY po transakcjach dla rosnącej historii
+def command_bench_stats(args):
+    configure_database(f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='library-bench-'), 'library.db')}")
+    now = datetime.now()
+    authors = [f"Autor {number}" for number in range(args.books // 20 or 1)]
+    with session_scope() as session:
+        session.execute(insert(User), [{"username": f"reader{number}", "password_hash": b"", "activated": True} for number in range(args.users)])
+        session.execute(insert(Book), [{"title": f"Książka {number}", "author": random.choice(authors), "year": 2000} for number in range(args.books)])
+    rows = []
+    table_size = 0
+    for target_size in (args.loans // 100, args.loans // 10, args.loans):
+        started = time.perf_counter()
+        while table_size < target_size:
+            chunk = min(50000, target_size - table_size)
+            with session_scope() as session:
+                session.execute(insert(Transaction), [
+                    {"book_id": random.randint(1, args.books), "user_id": random.randint(1, args.users),
+                     "borrowed_at": now - timedelta(days=60), "due_date": now - timedelta(days=30), "returned_at": now - timedelta(days=31)}
+                    for _ in range(chunk)
+                ])
+            table_size += chunk
+        insert_rate = (target_size - (rows[-1][0] if rows else 0)) / (time.perf_counter() - started)
+        timings = []
+        for function in (get_circulation_stats, get_circulation_stats_adhoc):
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                result = function()
+            timings.append(((time.perf_counter() - started) / args.repeat, result))
+        (materialized, stored), (adhoc, computed) = timings
+        if (stored["loans"], stored["borrowed"]) != (computed["loans"], computed["borrowed"]):
+            print("Błąd: statystyki niezgodne z transakcjami.")
+            return 1
+        rows.append([table_size, f"{insert_rate:.0f}", f"{materialized * 1000:.2f}", f"{adhoc * 1000:.2f}", f"{adhoc / materialized:.0f}x"])
+    print(tabulate(rows, headers=["Transakcje", "Zapis [wiersze/s]", "Tabele statystyk [ms]", "GROUP BY [ms]", "Przyspieszenie"], tablefmt="grid"))
+    return 0
+
+# Wyszukiwanie i przeglądanie listy przy katalogu z wieloma egzemplarzami każdego tytułu:
+# "przed" - wiersz books na każdy egzemplarz (dawny model), "po" - tytuł z egzemplarzami w copies
+def command_bench_copies(args):
+    words = ["wojna", "pokój", "zbrodnia", "kara", "lalka", "potop", "ogniem", "mieczem", "pan", "tadeusz"]
+    rows = []
+    for layout, title_rows, copies in (("przed: wiersz na egzemplarz", args.copies, 1), ("po: tytuł + egzemplarze", 1, args.copies)):
+        configure_database(f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='library-bench-'), 'library.db')}")
+        generator = random.Random(1)
+        titles = [(f"{generator.choice(words)} {generator.choice(words)} {number}", f"Autor {number % 997}") for number in range(args.titles)]
+        with engine.begin() as connection:
+            book_ids = connection.execute(insert(Book).returning(Book.id, sort_by_parameter_order=True), [
+                {"title": title, "author": author, "year": 2000} for title, author in titles for _ in range(title_rows)
+            ]).scalars().all()
+            connection.execute(insert(Copy), [{"book_id": book_id} for book_id in book_ids for _ in range(copies)])
+            analyze_tables(connection)
+        started = time.perf_counter()
+        distinct_titles = 0
+        for word in words:
+            found = find_books(word, limit=100)
+            distinct_titles += len({book[1] for book in found})
+        search_time = (time.perf_counter() - started) / len(words)
+        pager = KeysetPager([Book.id, Book.title, Book.available, Book.copies], BOOK_SORT_KEYS, "tytuł",
+                            conditions=(Book.available > 0,), page_size=20)
+        started = time.perf_counter()
+        pages = 1 if pager.first() else 0
+        while pager.has_next:
+            pager.next()
+            pages += 1
+        listing_time = time.perf_counter() - started
+        rows.append([layout, len(book_ids), f"{search_time * 1000:.2f}", distinct_titles / len(words), pages, f"{listing_time:.2f}"])
+    print(f"Tytuły: {args.titles}, egzemplarzy na tytuł: {args.copies}")
+    print(tabulate(rows, headers=["Model", "Wiersze books", "Szukanie [ms]", "Różne tytuły w 100 wynikach",
+                                  "Strony listy dostępnych", "Cała lista [s]"], tablefmt="grid"))
+    return 0
+
+# Czas zwrotu z przekazaniem książki następnej osobie w kolejce dla rosnącej kolejki rezerwacji jednego tytułu.
+# Co dziesiąty czytelnik jest zablokowany, więc przekazanie pomija też nieuprawnionych.
+def command_bench_holds(args):
+    configure_database(f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='library-bench-'), 'library.db')}")
+    readers = max(args.holds) + 1
+    with session_scope() as session:
+        session.execute(insert(User), [
+            {"username": f"reader{number}", "password_hash": b"", "activated": True, "blocked": number % 10 == 9}
+            for number in range(readers)
+        ])
+    rows = []
+    for queue_length in args.holds:
+        with session_scope() as session:
+            book = Book(title=f"Bestseller {queue_length}", author="Autor", year=2000)
+            session.add(book)
+            session.flush()
+            book_id = book.id
+            session.add(Copy(book_id=book_id))
+        expires_at = datetime.now() + timedelta(days=HOLD_DAYS)
+        with session_scope() as session:
+            session.execute(insert(Hold), [
+                {"book_id": book_id, "user_id": user_id, "expires_at": expires_at} for user_id in range(2, queue_length + 2)
+            ])
+        holder = get_user(1)
+        call_capturing_output(borrow_book, holder, book_id)
+        cycles = min(args.cycles, queue_length // 2)
+        started = time.perf_counter()
+        for _ in range(cycles):
+            returned, _ = call_capturing_output(return_book, holder, book_id)
+            with session_scope() as session:
+                next_user_id = session.query(Copy.user_id).filter(Copy.book_id == book_id).scalar()
+            if not returned or next_user_id is None or get_user(next_user_id).blocked:
+                print("Błąd: książka nie trafiła do następnej uprawnionej osoby z kolejki.")
+                return 1
+            holder = get_user(next_user_id)
+        elapsed = time.perf_counter() - started
+        rows.append([queue_length, cycles, f"{elapsed / cycles * 1000:.2f}"])
+    print(tabulate(rows, headers=["Rezerwacje w kolejce", "Zwroty", "Zwrot z przekazaniem [ms]"], tablefmt="grid"))
+    return 0
+
+# Kolejka wielu oczekujących próśb o przedłużenie: czas stron listy administratora i zbiorczej decyzji.
+# Co dziesiąta prośba dotyczy książki z rezerwacją, a co dwudziesta zablokowanego czytelnika - te są odrzucane regułami.
+def command_bench_extensions(args):
+    configure_database(f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='library-bench-'), 'library.db')}")
+    now = datetime.now()
+    readers = max(args.pending // 5, 1)
+    with engine.begin() as connection:
+        connection.execute(insert(User), [{"username": f"reader{number}", "password_hash": b"", "activated": True,
+                                           "blocked": number % 20 == 19} for number in range(readers)])
+        connection.execute(insert(Book), [{"title": f"Książka {number}", "author": "Autor", "year": 2000} for number in range(args.pending)])
+        connection.execute(insert(Copy), [{"book_id": number + 1, "user_id": number % readers + 1} for number in range(args.pending)])
+        connection.execute(insert(Transaction), [
+            {"book_id": number + 1, "copy_id": number + 1, "user_id": number % readers + 1, "borrowed_at": now, "due_date": now + timedelta(days=5)}
+            for number in range(args.pending)
+        ])
+        connection.execute(insert(Hold), [{"book_id": number + 1, "user_id": (number + 1) % readers + 1, "expires_at": now + timedelta(days=30)}
+                                          for number in range(0, args.pending, 10)])
+        connection.execute(insert(ExtensionRequest), [{"transaction_id": number + 1, "user_id": number % readers + 1, "days": 30}
+                                                      for number in range(args.pending)])
+        analyze_tables(connection)
+    pager = extension_requests_pager()
+    started = time.perf_counter()
+    pager.first()
+    first_page = time.perf_counter() - started
+    started = time.perf_counter()
+    for _ in range(args.pages):
+        pager.next()
+    next_page = (time.perf_counter() - started) / args.pages
+    started = time.perf_counter()
+    results = decide_extension_requests(list(range(1, args.pending // 2 + 1)), True)
+    approve_ids = time.perf_counter() - started
+    started = time.perf_counter()
+    results_all = decide_extension_requests(None, False, reason="test")
+    reject_all = time.perf_counter() - started
+    display_extension_decision({key: results.get(key, 0) + results_all.get(key, 0) for key in {*results, *results_all}})
+    rows = [
+        ["pierwsza strona listy", 1, f"{first_page * 1000:.2f}"],
+        ["kolejna strona listy", args.pages, f"{next_page * 1000:.2f}"],
+        ["zatwierdzenie po ID (z regułami)", args.pending // 2, f"{approve_ids * 1000:.0f}"],
+        ["odrzucenie wszystkich oczekujących", args.pending - args.pending // 2, f"{reject_all * 1000:.0f}"],
+    ]
+    print(f"Oczekujące prośby: {args.pending}")
+    print(tabulate(rows, headers=["Operacja", "Prośby / strony", "Czas [ms]"], tablefmt="grid"))
+    return 0
+
+def command_audit(args):
+    actor_id = None
+    if args.actor is not None and args.actor.isdigit():
+        actor_id = int(args.actor)  # Po ID da się szukać także usuniętych użytkowników
+    elif args.actor is not None:
+        actor = get_user_by_username(args.actor)
+        if actor is None:
+            print("Nie ma użytkownika o podanej nazwie.")
+            return 1
+        actor_id = actor.id
+    target_type, _, target_id = (args.target or "").partition(":")
+    rows = query_audit_log(
+        actor_id, target_type or None, int(target_id) if target_id else None, args.action,
+        datetime.fromisoformat(args.since) if args.since else None, datetime.fromisoformat(args.until) if args.until else None, args.limit
+    )
+    display_audit_log(rows)
+    return 0
+
+def command_audit_compact(args):
+    compacted = compact_audit_log(args.keep_months, args.archive_dir)
+    if compacted:
+        print(tabulate(compacted, headers=["Miesiąc", "Zdarzenia", "Archiwum"], tablefmt="grid"))
     else:
-        print("Książka o podanym ID nie istnieje.")
+        print("Brak miesięcy do kompaktowania.")
+    return 0
 
-def display_transactions():
-    transactions = session.query(Transaction).all()
-    if transactions:
-        transaction_data = []
-        for transaction in transactions:
-            user = session.query(User).filter_by(id=transaction.user_id).first()
-            username = user.username if user else "Unknown User"
-            book = session.query(Book).filter_by(id=transaction.book_id).first()
-            transaction_data.append([transaction.id, username, book.title, transaction.borrowed_at, transaction.due_date, "Returned" if transaction.returned_at else "Not Returned"])
-        headers = ["ID", "Użytkownik", "Tytuł książki", "Data wypożyczenia", "Termin zwrotu", "Status"]
-        print(tabulate(transaction_data, headers=headers, tablefmt="grid"))
+# Koszt dziennika na gorącej ścieżce: wypożyczenia i zwroty z kilku wątków (jak w API) bez dziennika,
+# z zapisem każdego zdarzenia osobnym commitem i z buforem zapisywanym paczkami w tle
+def command_bench_audit(args):
+    from concurrent.futures import ThreadPoolExecutor
+    rows = []
+    for mode in ("bez dziennika", "commit na zdarzenie", "bufor + zapis paczkami"):
+        configure_database(f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='library-bench-'), 'library.db')}")
+        audit_log.enabled = False  # Przygotowanie danych nie trafia do dziennika
+        with session_scope() as session:
+            session.execute(insert(User), [{"username": f"reader{number}", "password_hash": b"", "activated": True} for number in range(args.threads)])
+        for number in range(args.books):
+            add_book(f"Książka {number}", "Autor", 2000)
+        audit_log.enabled, audit_log.synchronous = mode != "bez dziennika", mode == "commit na zdarzenie"
+        flushes = audit_log.flushes
+        books_per_thread = max(args.books // args.threads, 1)
+
+        def borrow_and_return(thread_number):
+            user = get_user(thread_number + 1)
+            for number in range(args.operations // 2 // args.threads):
+                book_id = thread_number * books_per_thread + number % books_per_thread + 1  # Każdy wątek ma własne książki
+                call_capturing_output(borrow_book, user, book_id)
+                call_capturing_output(return_book, user, book_id)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as threads:
+            list(threads.map(borrow_and_return, range(args.threads)))
+        elapsed = time.perf_counter() - started
+        audit_log.flush()
+        with engine.connect() as connection:
+            events = sum(connection.exec_driver_sql(f'SELECT count(*) FROM "{partition}"').scalar() for partition in audit_partitions(connection))
+        rows.append([mode, f"{args.operations / elapsed:.0f}", events, audit_log.flushes - flushes])
+    audit_log.enabled, audit_log.synchronous = True, False
+    print(f"Operacje: {args.operations}")
+    print(tabulate(rows, headers=["Dziennik", "Operacje/s", "Zdarzenia", "Zapisy do bazy"], tablefmt="grid"))
+    return 0
+
+# GENERATOR DANYCH I ZESTAW POMIARÓW
+# Rozmiary zbiorów: (użytkownicy, tytuły, transakcje)
+DATASET_SCALES = {"10k": (500, 2000, 10000), "1m": (20000, 100000, 1000000), "10m": (200000, 1000000, 10000000)}
+DATASET_PASSWORD = "haslo123"  # Hasło wszystkich wygenerowanych czytelników (do pomiaru logowania)
+FIRST_NAMES = ["Anna", "Piotr", "Maria", "Krzysztof", "Katarzyna", "Andrzej", "Małgorzata", "Tomasz", "Agnieszka", "Paweł",
+               "Barbara", "Michał", "Ewa", "Marcin", "Joanna", "Jakub", "Zofia", "Łukasz", "Magdalena", "Grzegorz"]
+LAST_NAMES = ["Nowak", "Kowalski", "Wiśniewski", "Wójcik", "Kowalczyk", "Kamiński", "Lewandowski", "Zieliński", "Szymański",
+              "Woźniak", "Dąbrowski", "Kozłowski", "Jankowski", "Mazur", "Kwiatkowski", "Krawczyk", "Piotrowski", "Grabowski"]
+TITLE_WORDS = ["wojna", "pokój", "zbrodnia", "kara", "lalka", "potop", "ogniem", "mieczem", "pan", "tadeusz", "noce", "dnie",
+               "ziemia", "obiecana", "chłopi", "wesele", "dziady", "przedwiośnie", "ferdydurke", "solaris", "cesarz", "rok",
+               "sto", "lat", "samotności", "mistrz", "małgorzata", "proces", "zamek", "dżuma", "wiedźmin", "krew", "elfów"]
+
+# Skumulowane wagi rozkładu Zipfa dla losowej kolejności elementów: kilka procent tytułów (czytelników)
+# odpowiada za większość wypożyczeń, jak w prawdziwej bibliotece
+def zipf_cumulative_weights(count, exponent, generator):
+    ranks = list(range(1, count + 1))
+    generator.shuffle(ranks)
+    cumulative, total = [], 0.0
+    for rank in ranks:
+        total += rank ** -exponent
+        cumulative.append(total)
+    return cumulative
+
+# Wypełnia pustą bazę użytkownikami, tytułami z egzemplarzami i historią wypożyczeń o skośnej popularności.
+# Triggery statystyk wyłączamy na czas ładowania historii i przeliczamy statystyki raz na końcu.
+def generate_dataset(scale, seed=1, chunk_size=100000):
+    users, books, transactions = DATASET_SCALES[scale]
+    generator = random.Random(seed)
+    now = datetime.now().replace(microsecond=0)
+    timestamp = lambda value: value.isoformat(sep=" ", timespec="microseconds")
+    password_hash = hash_password(DATASET_PASSWORD)
+    started = time.perf_counter()
+    with engine.begin() as connection:
+        if connection.exec_driver_sql("SELECT count(*) FROM books").scalar() or connection.exec_driver_sql("SELECT count(*) FROM users").scalar():
+            raise ValueError("Baza nie jest pusta - generator wypełnia tylko nową bazę.")
+        connection.exec_driver_sql("PRAGMA synchronous=OFF")
+        connection.execute(insert(User), [
+            {"username": "admin" if number == 0 else f"czytelnik{number}", "password_hash": password_hash,
+             "name": generator.choice(FIRST_NAMES), "surname": generator.choice(LAST_NAMES),
+             "is_admin": number == 0, "activated": True, "blocked": generator.random() < 0.02 and number != 0}
+            for number in range(users)
+        ])
+        authors = [f"{generator.choice(FIRST_NAMES)} {generator.choice(LAST_NAMES)} {number}" for number in range(max(books // 8, 1))]
+        author_weights = zipf_cumulative_weights(len(authors), 1.0, generator)
+        book_weights = zipf_cumulative_weights(books, 1.0, generator)
+        copies_per_book = []
+        for start in range(0, books, chunk_size):
+            count = min(chunk_size, books - start)
+            chosen_authors = generator.choices(authors, cum_weights=author_weights, k=count)
+            connection.execute(insert(Book), [
+                {"title": " ".join(generator.sample(TITLE_WORDS, generator.randint(1, 3))).capitalize() + f" {start + number + 1}",
+                 "author": author, "year": generator.randint(1850, now.year)}
+                for number, author in enumerate(chosen_authors)
+            ])
+            # Popularne tytuły mają więcej egzemplarzy
+            for number in range(start, start + count):
+                weight = book_weights[number] - (book_weights[number - 1] if number else 0)
+                copies_per_book.append(min(1 + int(weight * books / 20), 5) + generator.randint(0, 1))
+        first_copy_id = [0] * books
+        next_copy_id = 1
+        copy_rows = []
+        for book_index, count in enumerate(copies_per_book):
+            first_copy_id[book_index] = next_copy_id
+            next_copy_id += count
+            copy_rows.extend((book_index + 1,) for _ in range(count))
+            if len(copy_rows) >= chunk_size:
+                connection.exec_driver_sql("INSERT INTO copies (book_id) VALUES (?)", copy_rows)
+                copy_rows = []
+        if copy_rows:
+            connection.exec_driver_sql("INSERT INTO copies (book_id) VALUES (?)", copy_rows)
+        print(f"Użytkownicy: {users}, tytuły: {books}, egzemplarze: {next_copy_id - 1} ({time.perf_counter() - started:.1f} s)")
+
+        connection.exec_driver_sql("DROP TRIGGER IF EXISTS stats_transaction_insert")
+        user_weights = zipf_cumulative_weights(users, 0.8, generator)
+        user_ids, book_ids = range(1, users + 1), range(1, books + 1)
+        history_start = now - timedelta(days=730)
+        step = 730 * 86400 / transactions
+        open_loans, taken_copies, open_pairs = [], set(), set()
+        for start in range(0, transactions, chunk_size):
+            count = min(chunk_size, transactions - start)
+            rows = []
+            for number, book_id, user_id in zip(range(start, start + count),
+                                                generator.choices(book_ids, cum_weights=book_weights, k=count),
+                                                generator.choices(user_ids, cum_weights=user_weights, k=count)):
+                copy_id = first_copy_id[book_id - 1] + generator.randrange(copies_per_book[book_id - 1])
+                borrowed_at = history_start + timedelta(seconds=number * step + generator.random() * step)
+                returned_at = borrowed_at + timedelta(days=generator.randint(1, 40), seconds=generator.randint(0, 86399))
+                # Część wypożyczeń z ostatnich tygodni jest jeszcze otwarta: egzemplarz u jednej osoby,
+                # czytelnik z jednym egzemplarzem danego tytułu
+                if returned_at > now and copy_id not in taken_copies and (user_id, book_id) not in open_pairs:
+                    taken_copies.add(copy_id)
+                    open_pairs.add((user_id, book_id))
+                    open_loans.append((user_id, copy_id))
+                    returned_at = None
+                elif returned_at > now:
+                    returned_at = now - timedelta(seconds=generator.randint(1, 86400))
+                rows.append((book_id, copy_id, user_id, timestamp(borrowed_at), timestamp(borrowed_at + timedelta(days=LOAN_DAYS)),
+                             timestamp(returned_at) if returned_at else None))
+            connection.exec_driver_sql(
+                "INSERT INTO transactions (book_id, copy_id, user_id, borrowed_at, due_date, returned_at) VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+            if start + count < transactions and (start + count) % (chunk_size * 10) == 0:
+                print(f"Transakcje: {start + count} ({time.perf_counter() - started:.1f} s)")
+        connection.exec_driver_sql("UPDATE copies SET user_id = ? WHERE id = ?", open_loans)
+        print(f"Transakcje: {transactions}, w tym otwarte: {len(open_loans)} ({time.perf_counter() - started:.1f} s)")
+        create_statistics(connection)
+        analyze_tables(connection)
+    print(f"Gotowe w {time.perf_counter() - started:.1f} s.")
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
+
+# Operacje zestawu pomiarów: nazwa -> funkcja losująca argumenty z danych w bazie i zwracająca kroki (nazwa, funkcja, argumenty).
+# Wypożyczenie i zwrot są parą, żeby pomiar nie zmieniał stanu bazy poza dopisaną historią.
+def benchmark_operations(generator):
+    with engine.connect() as connection:
+        titles = connection.exec_driver_sql("SELECT title FROM books ORDER BY random() LIMIT 200").scalars().all()
+        readers = connection.exec_driver_sql(
+            "SELECT id, username, surname FROM users WHERE activated AND NOT blocked AND NOT is_admin ORDER BY random() LIMIT 200").all()
+        heavy_readers = connection.exec_driver_sql("SELECT user_id FROM user_stats ORDER BY loans DESC LIMIT 20").scalars().all()
+        # Popularne tytuły z wolnym egzemplarzem - mierzymy udane wypożyczenie, a nie odmowę
+        popular_books = connection.exec_driver_sql(
+            "SELECT s.book_id FROM book_stats s JOIN books b ON b.id = s.book_id WHERE b.available > 0 ORDER BY s.loans DESC LIMIT 50").scalars().all()
+    if not titles or not readers:
+        raise ValueError("Baza nie ma danych do pomiarów - uruchom najpierw generate-data.")
+    words = [word for title in titles for word in title.lower().split() if not word.isdigit()]
+
+    def borrow_and_return():
+        user, book_id = get_user(generator.choice(readers)[0]), generator.choice(popular_books)
+        return [("borrow_book", borrow_book, (user, book_id)), ("return_book", return_book, (user, book_id))]
+
+    return {
+        "search_book": lambda: [("search_book", search_book, (" ".join(generator.sample(words, generator.randint(1, 2))),))],
+        # Szukanie po nazwie użytkownika albo po nazwisku (wtedy wyników jest wiele)
+        "search_user": lambda: [("search_user", search_user, (generator.choice(generator.choice(readers)[1:]),))],
+        "display_transactions (użytkownik)": lambda: [
+            ("display_transactions (użytkownik)", display_transactions, (None, generator.choice(heavy_readers), None, None, 50, False, 1))],
+        "display_transactions (otwarte)": lambda: [
+            ("display_transactions (otwarte)", display_transactions, ("open", None, None, None, 50, False, 1))],
+        "display_user_books": lambda: [("display_user_books", display_user_books, (generator.choice(heavy_readers),))],
+        "borrow_book/return_book": borrow_and_return,
+        "login_user": lambda: [("login_user", login_user, (generator.choice(readers)[1], DATASET_PASSWORD))],
+    }
+
+# Czasy (percentyle) i szczyt pamięci każdej operacji. Pamięć mierzy tracemalloc w osobnej, krótszej serii,
+# bo śledzenie alokacji spowalnia wywołania i zafałszowałoby czasy.
+def run_benchmarks(repeat=200, login_repeat=10, memory_repeat=10, warmup=5, seed=1):
+    import tracemalloc
+    operations = benchmark_operations(random.Random(seed))
+    timings, memory = {}, {}
+    for name, prepare in operations.items():
+        count = login_repeat if name == "login_user" else repeat
+        # Rozgrzewka: pamięć podręczna stron SQLite, przygotowane zapytania, pula połączeń
+        for _ in range(min(warmup, count)):
+            for _, function, arguments in prepare():
+                call_capturing_output(function, *arguments)
+        for _ in range(count):
+            for step_name, function, arguments in prepare():
+                started = time.perf_counter()
+                call_capturing_output(function, *arguments)
+                timings.setdefault(step_name, []).append(time.perf_counter() - started)
+        tracemalloc.start()
+        try:
+            for _ in range(min(memory_repeat, count)):
+                for step_name, function, arguments in prepare():
+                    tracemalloc.reset_peak()
+                    baseline = tracemalloc.get_traced_memory()[0]
+                    call_capturing_output(function, *arguments)
+                    memory[step_name] = max(memory.get(step_name, 0), tracemalloc.get_traced_memory()[1] - baseline)
+        finally:
+            tracemalloc.stop()
+    results = {}
+    for name, values in timings.items():
+        values.sort()
+        results[name] = {
+            "n": len(values), "mean_ms": sum(values) / len(values) * 1000, "p50_ms": percentile(values, 0.5) * 1000,
+            "p90_ms": percentile(values, 0.9) * 1000, "p99_ms": percentile(values, 0.99) * 1000, "max_ms": values[-1] * 1000,
+            "peak_kib": memory.get(name, 0) / 1024,
+        }
+    return results
+
+# Porównanie z zapisanym przebiegiem: regresja, gdy zarówno p50, jak i p90 wzrosły o więcej niż threshold procent
+# i o więcej niż noise_ms. Prawdziwe spowolnienie przesuwa cały rozkład, pojedynczy percentyl skacze też od obciążenia maszyny.
+def compare_benchmarks(previous, current, threshold=20, noise_ms=0.5):
+    rows, regressions = [], 0
+    for name, result in current.items():
+        before = previous.get(name)
+        if before is None:
+            rows.append([name, "-", f"{result['p50_ms']:.2f}", "-", "-", "nowa"])
+            continue
+        changes = []
+        for key in ("p50_ms", "p90_ms"):
+            change = (result[key] - before[key]) / before[key] * 100 if before[key] else 0
+            changes.append((change, result[key] - before[key]))
+        regressed = all(change > threshold and difference > noise_ms for change, difference in changes)
+        regressions += regressed
+        rows.append([name, f"{before['p50_ms']:.2f}", f"{result['p50_ms']:.2f}", f"{changes[0][0]:+.0f}%", f"{changes[1][0]:+.0f}%",
+                     "REGRESJA" if regressed else "OK"])
+    print(tabulate(rows, headers=["Operacja", "Poprzednio p50 [ms]", "Teraz p50 [ms]", "Zmiana p50", "Zmiana p90", "Wynik"], tablefmt="grid"))
+    return regressions
+
+def command_generate_data(args):
+    path = args.db or f"library-{args.scale}.db"
+    configure_database(f"sqlite:///{path}")
+    print(f"Generuję zbiór {args.scale} w {path}")
+    try:
+        generate_dataset(args.scale, args.seed)
+    except ValueError as error:
+        print(error)
+        return 1
+    return 0
+
+# Zestaw pomiarów na wskazanej bazie. Wynik można zapisać (--save) i porównać z wcześniejszym (--compare);
+# przy regresji polecenie kończy się kodem 1, więc nadaje się do automatycznego sprawdzania.
+def command_bench_suite(args):
+    configure_database(f"sqlite:///{args.db}")
+    with engine.connect() as connection:
+        counts = {table: connection.exec_driver_sql(f"SELECT count(*) FROM {table}").scalar() for table in ("users", "books", "copies", "transactions")}
+    print(", ".join(f"{table}: {count}" for table, count in counts.items()))
+    try:
+        results = run_benchmarks(args.repeat, args.login_repeat, seed=args.seed)
+    except ValueError as error:
+        print(error)
+        return 1
+    print(tabulate([[name, result["n"], *(f"{result[key]:.2f}" for key in ("mean_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms")), f"{result['peak_kib']:.0f}"]
+                    for name, result in results.items()],
+                   headers=["Operacja", "Wywołania", "Średnio [ms]", "p50", "p90", "p99", "max", "Pamięć szczytowa [KiB]"], tablefmt="grid"))
+    try:
+        import resource  # Tylko Unix
+    except ImportError:
+        max_rss_kib = None
+        print("Szczytowa pamięć procesu (RSS): n/a")
     else:
-        print("Brak transakcji w bazie danych.")
+        max_rss_kib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # Linux podaje KiB
+        print(f"Szczytowa pamięć procesu (RSS): {max_rss_kib / 1024:.0f} MiB")
+    run = {
+        "created_at": datetime.now().isoformat(sep=" ", timespec="seconds"), "database": os.path.abspath(args.db), "counts": counts,
+        "environment": {"python": platform.python_version(), "sqlalchemy": sqlalchemy.__version__, "sqlite": sqlite3.sqlite_version,
+                        "machine": platform.machine(), "cpus": os.cpu_count()},
+        "max_rss_kib": max_rss_kib, "results": results,
+    }
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as output:
+            json.dump(run, output, ensure_ascii=False, indent=2)
+        print(f"Zapisano wyniki w {args.save}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as source:
+            previous = json.load(source)
+        # Historia wypożyczeń rośnie z każdym pomiarem, więc porównujemy tylko pozostałe tabele
+        if any(previous["counts"].get(table) != counts[table] for table in ("users", "books", "copies")):
+            print("Uwaga: porównywany przebieg dotyczył innej bazy.")
+        regressions = compare_benchmarks(previous["results"], results, args.threshold)
+        if regressions:
+            print(f"Regresje: {regressions}")
+            return 1
+    return 0
+
+# Jedna losowa literówka w słowie: usunięcie, zamiana sąsiednich liter, podmiana albo wstawienie litery
+def make_typo(word, generator):
+    position = generator.randrange(1, len(word) - 1)
+    letter = generator.choice("abcdefghijklmnoprstuwyz")
+    return generator.choice([
+        word[:position] + word[position + 1:],
+        word[:position] + word[position + 1] + word[position] + word[position + 2:],
+        word[:position] + letter + word[position + 1:],
+        word[:position] + letter + word[position:],
+    ])
+
+# Wyszukiwanie z literówkami na bazie z generate-data: czas, skuteczność (czy szukane słowo jest w 5 pierwszych wynikach)
+# i dla porównania dotychczasowe wyszukiwanie podciągu w użytkownikach (LIKE) wobec indeksu trigramów
+def command_bench_search(args):
+    configure_database(f"sqlite:///{os.path.abspath(args.db)}")
+    generator = random.Random(args.seed)
+    with engine.connect() as connection:
+        surnames = connection.exec_driver_sql("SELECT surname FROM users WHERE length(surname) >= 5 ORDER BY random() LIMIT ?", (args.queries,)).scalars().all()
+        titles = connection.exec_driver_sql("SELECT title, author FROM books ORDER BY random() LIMIT ?", (args.queries,)).all()
+    # Słowa z liter - numery w wygenerowanych tytułach nie są czymś, co ktoś wpisuje z literówką
+    words = [word for title, author in titles for word in [generator.choice(re.findall(r"[^\W\d]{5,}", f"{title} {author}") or [None])] if word]
+    cases = [
+        ("find_similar_users", find_similar_users, [(make_typo(surname, generator), surname) for surname in surnames],
+         lambda user: f"{user.username} {user.name} {user.surname}"),
+        ("find_similar_books", find_similar_books, [(make_typo(word, generator), word) for word in words],
+         lambda book: f"{book[1]} {book[2]}"),
+    ]
+    rows = []
+    for name, function, queries, describe in cases:
+        timings, hits = [], 0
+        for query, original in queries:
+            started = time.perf_counter()
+            results = function(query, 5)
+            timings.append(time.perf_counter() - started)
+            hits += any(fold_text(original) in fold_text(describe(row)) for row, _ in results)
+        timings.sort()
+        rows.append([name, len(queries), f"{percentile(timings, 0.5) * 1000:.2f}", f"{percentile(timings, 0.9) * 1000:.2f}",
+                     f"{timings[-1] * 1000:.2f}", f"{hits / max(len(queries), 1):.0%}"])
+
+    def like_search(term):
+        search = f"%{term}%"
+        with session_scope() as session:
+            return session.query(User).filter(User.username.like(search) | User.name.like(search) | User.surname.like(search)).limit(100).all()
+
+    for name, function in (("podciąg w users: LIKE", like_search), ("podciąg w users: trigramy", find_users)):
+        timings = []
+        for surname in surnames:
+            started = time.perf_counter()
+            function(surname[:5])
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        rows.append([name, len(surnames), f"{percentile(timings, 0.5) * 1000:.2f}", f"{percentile(timings, 0.9) * 1000:.2f}", f"{timings[-1] * 1000:.2f}", ""])
+    with engine.connect() as connection:
+        counts = [connection.exec_driver_sql(f"SELECT count(*) FROM {table}").scalar() for table in ("users", "books")]
+    print(f"Użytkownicy: {counts[0]}, tytuły: {counts[1]}")
+    print(tabulate(rows, headers=["Wyszukiwanie", "Zapytania", "p50 [ms]", "p90 [ms]", "Maks. [ms]", "Trafienie w 5 pierwszych"], tablefmt="grid"))
+    return 0
+
+def command_serve(args):
+    import asyncio
+    get_password_pool()  # Procesy haszujące startują przed wątkami serwera
+    api = LibraryApi(args.workers)
+    print(f"API biblioteki nasłuchuje na http://{args.host}:{args.port} (wątki robocze: {args.workers})")
+    try:
+        asyncio.run(api.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+# Uruchamia serwer na tymczasowej bazie i przechodzi przez podstawowe operacje lokalnym klientem
+def command_api_check(args):
+    import asyncio
+    configure_database(f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='library-api-'), 'library.db')}")
+    call_capturing_output(register_user, "admin", "admin123", True)
+    call_capturing_output(register_user, "reader", "reader123")
+    call_capturing_output(register_user, "reader2", "reader234")
+    api = LibraryApi(args.workers)
+    started = threading.Event()
+    port = []
+    threading.Thread(target=lambda: asyncio.run(api.serve("127.0.0.1", 0, lambda number: (port.append(number), started.set()))), daemon=True).start()
+    started.wait(10)
+    base_url = f"http://127.0.0.1:{port[0]}"
+    steps = []
+
+    def step(name, expected_status, method, path, payload=None, token=None):
+        status, response = call_api(base_url, method, path, payload, token)
+        steps.append([name, status, "OK" if status == expected_status else f"oczekiwano {expected_status}", response.get("message", "")])
+        return response
+
+    admin_token = step("logowanie admina", 200, "POST", "/api/login", {"username": "admin", "password": "admin123"})["token"]
+    step("błędne hasło", 401, "POST", "/api/login", {"username": "reader", "password": "zle"})
+    reader_token = step("logowanie czytelnika", 200, "POST", "/api/login", {"username": "reader", "password": "reader123"})["token"]
+    reader2_token = step("logowanie drugiego czytelnika", 200, "POST", "/api/login", {"username": "reader2", "password": "reader234"})["token"]
+    book_id = step("dodanie książki", 201, "POST", "/api/books", {"title": "Solaris", "author": "Stanisław Lem", "year": 1961}, admin_token)["id"]
+    step("dodanie książki bez uprawnień", 403, "POST", "/api/books", {"title": "X", "author": "Y", "year": 2000}, reader_token)
+    step("wyszukiwanie", 200, "GET", "/api/books?q=stanislaw", token=reader_token)
+    similar = step("wyszukiwanie z literówką", 200, "GET", "/api/books?q=Solatis", token=reader_token)
+    if not similar.get("fuzzy") or [book["id"] for book in similar.get("books", [])][:1] != [book_id]:
+        steps[-1][2] = "brak podobnego tytułu"
+    step("wypożyczenie", 200, "POST", f"/api/books/{book_id}/borrow", token=reader_token)
+    step("ponowne wypożyczenie", 409, "POST", f"/api/books/{book_id}/borrow", token=reader_token)
+    step("moje wypożyczenia", 200, "GET", "/api/me/loans", token=reader_token)
+    step("przedłużenie", 200, "POST", f"/api/books/{book_id}/extend", {"days": 30}, admin_token)
+    step("prośba o przedłużenie", 200, "POST", f"/api/books/{book_id}/extension", token=reader_token)
+    step("ponowna prośba o przedłużenie", 409, "POST", f"/api/books/{book_id}/extension", token=reader_token)
+    pending = step("oczekujące prośby", 200, "GET", "/api/extensions", token=admin_token)["extensions"]
+    approved = step("zatwierdzenie próśb", 200, "POST", "/api/extensions/approve", {"ids": [request["id"] for request in pending]}, admin_token)
+    if approved.get("results") != {"zatwierdzono": 1}:
+        steps[-1][2] = f"nieoczekiwany wynik {approved.get('results')}"
+    step("moje prośby", 200, "GET", "/api/me/extensions", token=reader_token)
+    step("rezerwacja", 200, "POST", f"/api/books/{book_id}/hold", token=reader2_token)
+    step("prośba przy rezerwacjach", 409, "POST", f"/api/books/{book_id}/extension", token=reader_token)
+    step("ponowna rezerwacja", 409, "POST", f"/api/books/{book_id}/hold", token=reader2_token)
+    step("moje rezerwacje", 200, "GET", "/api/me/holds", token=reader2_token)
+    step("zwrot z przekazaniem rezerwującemu", 200, "POST", f"/api/books/{book_id}/return", token=reader_token)
+    handed_over = step("wypożyczenia rezerwującego", 200, "GET", "/api/me/loans", token=reader2_token)["loans"]
+    if [loan["id"] for loan in handed_over] != [book_id]:
+        steps[-1][2] = "brak przekazanej książki"
+    step("zwrot przez rezerwującego", 200, "POST", f"/api/books/{book_id}/return", token=reader2_token)
+    step("rezerwacja dostępnej książki", 409, "POST", f"/api/books/{book_id}/hold", token=reader2_token)
+    step("edycja książki", 200, "PATCH", f"/api/books/{book_id}", {"title": "Solaris (wyd. II)"}, admin_token)
+    step("blokada czytelnika", 200, "PUT", "/api/users/2/blocked", {"blocked": True}, admin_token)
+    step("wypożyczenie przez zablokowanego", 409, "POST", f"/api/books/{book_id}/borrow", token=reader_token)
+    step("pamięć podręczna", 200, "GET", "/api/cache", token=admin_token)
+    step("metryki", 200, "GET", "/api/metrics", token=admin_token)
+    blocked = step("dziennik zdarzeń", 200, "GET", "/api/audit?target=user:2&action=user.blocked", token=admin_token).get("events", [])
+    if [(event["actor"], event["after"]) for event in blocked] != [("admin", {"blocked": True})]:
+        steps[-1][2] = "brak zdarzenia blokady"
+    step("historia transakcji", 200, "GET", "/api/transactions?status=returned", token=admin_token)
+    step("bez logowania", 401, "GET", "/api/books?q=lem")
+    print(tabulate(steps, headers=["Krok", "HTTP", "Wynik", "Komunikat"], tablefmt="grid"))
+    return 0 if all(row[2] == "OK" for row in steps) else 1
+
+# Logowania na sekundę dla rosnącej liczby procesów haszujących (1, 2, 4, ... aż do liczby rdzeni)
+def command_bench_login(args):
+    import bcrypt
+    from concurrent.futures import ThreadPoolExecutor
+    configure_database(f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='library-bench-'), 'library.db')}")
+    configure_password_hashing(rounds=args.rounds)
+    call_capturing_output(register_user, "bench", "bench-password")
+    cores = os.cpu_count()
+    worker_counts = sorted({min(2 ** power, cores) for power in range(cores.bit_length() + 1)})
+    rows, base_rate = [], None
+    for workers in worker_counts:
+        configure_password_hashing(workers=workers)
+        check_password("", bcrypt.hashpw(b"", bcrypt.gensalt(4)))  # Rozgrzanie procesów
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers * 2) as callers:
+            results = list(callers.map(lambda _: login_user("bench", "bench-password"), range(args.logins)))
+        elapsed = time.perf_counter() - started
+        if not all(results):
+            print("Błąd: część logowań nie powiodła się.")
+            return 1
+        rate = args.logins / elapsed
+        base_rate = base_rate or rate
+        rows.append([workers, f"{elapsed:.2f}", f"{rate:.1f}", f"{rate / base_rate:.2f}x"])
+    print(f"Koszt bcrypt: {args.rounds}, logowań na pomiar: {args.logins}, rdzeni: {cores}")
+    print(tabulate(rows, headers=["Procesy", "Czas [s]", "Logowania/s", "Przyspieszenie"], tablefmt="grid"))
+    return 0
+
+def command_profile_report(args):
+    try:
+        with open(args.file, encoding="utf-8") as source:
+            snapshot = json.load(source)
+    except (OSError, ValueError) as error:
+        print(f"Nie można odczytać profilu: {error}")
+        return 1
+    display_profile(snapshot, args.limit)
+    return 0
+
+# Koszt włączonego profilowania: te same operacje bez profilera i z nim, naprzemiennie w kilku rundach
+def command_bench_profile(args):
+    configure_database(f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='library-bench-'), 'library.db')}")
+    configure_password_hashing(rounds=4)
+    audit_log.enabled = False
+    profiler.slow_query_log = None
+    call_capturing_output(register_user, "bench", "bench-password")
+    user = get_user_by_username("bench")
+    with session_scope() as session:
+        session.add_all(Book(title=f"Książka {number}", author=f"Autor {number % 50}", year=1900 + number % 120) for number in range(args.books))
+    with engine.begin() as connection:
+        connection.exec_driver_sql("INSERT INTO copies (book_id) SELECT id FROM books")
+    # Funkcje wywołujemy przez nazwy globalne, żeby po włączeniu profilera trafiały na opakowania
+    operations = {
+        "search_book": lambda: search_book("autor 7"),
+        "find_books": lambda: find_books("książka"),
+        "get_book (pamięć podręczna)": lambda: get_book(1),
+        "borrow_book/return_book": lambda: (borrow_book(user, 2), return_book(user, 2)),
+    }
+    timings = {(name, state): [] for name in operations for state in (False, True)}
+    for _ in range(args.rounds):
+        for state in (False, True):
+            if state:
+                profiler.enable()
+            else:
+                profiler.disable()
+            for name, operation in operations.items():
+                started = time.perf_counter()
+                for _ in range(args.repeat):
+                    call_capturing_output(operation)
+                timings[name, state].append((time.perf_counter() - started) / args.repeat)
+    profiler.disable()
+    rows = []
+    for name in operations:
+        off, on = min(timings[name, False]), min(timings[name, True])  # Minimum z rund - najmniej zakłóceń od innych procesów
+        rows.append([name, f"{off * 1e6:.0f}", f"{on * 1e6:.0f}", f"{(on - off) * 1e6:+.0f}", f"{(on / off - 1) * 100:+.1f}%"])
+    print(f"Rund: {args.rounds}, wywołań na rundę: {args.repeat}, książek: {args.books}")
+    print(tabulate(rows, headers=["Operacja", "Wyłączone [µs]", "Włączone [µs]", "Różnica [µs]", "Narzut"], tablefmt="grid"))
+    return 0
+
+def command_backup(args):
+    if args.keep and not args.incremental:
+        print("--keep dotyczy tylko migawek przyrostowych (--incremental).")
+        return 1
+    try:
+        result = backup_database(args.target, args.compress, args.incremental, args.keep, args.pages, args.pause_ms)
+    except (OSError, sqlite3.Error) as error:
+        print(f"Nie udało się wykonać kopii: {error}")
+        return 1
+    print(f"Kopia bazy {current_engine().url.database} ({result['size'] / 2**20:.1f} MiB) w {result['path']}: "
+          f"zapisano {result['written'] / 2**20:.1f} MiB w {result['seconds']:.1f} s")
+    if args.incremental:
+        print(f"Migawka {result['snapshot']}: nowe kawałki {result['new_chunks']} z {result['chunks']}")
+        if args.keep:
+            print(f"Usunięte stare migawki: {result['pruned']}, nieużywane kawałki: {result['removed_chunks']}")
+    return 0
+
+def command_restore(args):
+    try:
+        result = restore_database(args.source, args.target or engine.url.database, args.snapshot, args.force)
+    except (ValueError, OSError, EOFError) as error:
+        print(f"Nie udało się odtworzyć bazy: {error}")
+        return 1
+    print(f"Odtworzono {result['target']} ({result['size'] / 2**20:.1f} MiB) z {result['source']}"
+          + (f", migawka {result['snapshot']}" if "snapshot" in result else "")
+          + f". Integralność: ok, wersja schematu: {result['schema_version']}")
+    return 0
+
+# Wpływ kopii zapasowej na czas wypożyczenia: borrow_book/return_book w pętli najpierw bez kopii, potem w trakcie kopii
+# robionej przez osobny proces (polecenie backup) w kolejnych trybach. Bazę przygotowuje generate-data (--scale 10m to kilka GB).
+def command_bench_backup(args):
+    import shutil, subprocess
+    path = os.path.abspath(args.db)
+    configure_database(f"sqlite:///{path}")
+    try:
+        operations = benchmark_operations(random.Random(args.seed))["borrow_book/return_book"]
+    except ValueError as error:
+        print(error)
+        return 1
+    directory = tempfile.mkdtemp(prefix="library-backup-")
+    application = [sys.executable, "-W", "ignore", os.path.abspath(__file__), "backup"]
+    environment = {**os.environ, "LIBRARY_DATABASE_URL": f"sqlite:///{path}"}
+    snapshots = os.path.join(directory, "snapshots")
+    modes = [
+        ("bez kopii", None, None),
+        ("kopia jednym krokiem", os.path.join(directory, "full.db"), ["--pages", "-1"]),
+        (f"kopia po {args.pages} stron", os.path.join(directory, "paged.db"), ["--pages", str(args.pages), "--pause-ms", str(args.pause_ms)]),
+        ("kopia po stronach + gzip", os.path.join(directory, "paged.db.gz"), ["--compress", "--pages", str(args.pages), "--pause-ms", str(args.pause_ms)]),
+        ("migawka przyrostowa (pierwsza)", snapshots, ["--incremental", "--pages", str(args.pages), "--pause-ms", str(args.pause_ms)]),
+        ("migawka przyrostowa (kolejna)", snapshots, ["--incremental", "--pages", str(args.pages), "--pause-ms", str(args.pause_ms)]),
+    ]
+
+    def disk_usage(target):
+        if os.path.isdir(target):
+            return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(target) for name in names)
+        return os.path.getsize(target) if os.path.exists(target) else 0
+
+    for _ in range(5):  # Rozgrzewka
+        for _, function, arguments in operations():
+            call_capturing_output(function, *arguments)
+    rows = []
+    try:
+        for name, target, options in modes:
+            timings = []
+            process = None
+            if target is not None:
+                used = disk_usage(target)
+                process = subprocess.Popen(application + [target, *options], env=environment, stdout=subprocess.DEVNULL)
+            started = time.perf_counter()
+            # Bez kopii - stała liczba wypożyczeń; z kopią - wypożyczamy, dopóki kopia trwa
+            while process.poll() is None if process else len(timings) < args.repeat:
+                for step_name, function, arguments in operations():
+                    step_started = time.perf_counter()
+                    call_capturing_output(function, *arguments)
+                    if step_name == "borrow_book":
+                        timings.append(time.perf_counter() - step_started)
+            elapsed = time.perf_counter() - started
+            if process and process.returncode:
+                print(f"{name}: kopia zakończyła się błędem (kod {process.returncode})")
+                return 1
+            timings.sort()
+            rows.append([name, f"{elapsed:.1f}" if process else "-", f"{(disk_usage(target) - used) / 2**20:.1f}" if process else "-",
+                         len(timings), *(f"{value * 1000:.2f}" for value in (percentile(timings, 0.5), percentile(timings, 0.9),
+                                                                             percentile(timings, 0.99), timings[-1]))])
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    print(f"Baza: {path} ({os.path.getsize(path) / 2**20:.0f} MiB)")
+    print(tabulate(rows, headers=["Tryb", "Czas kopii [s]", "Zapisano [MiB]", "Wypożyczenia", "borrow_book p50 [ms]", "p90", "p99", "max"],
+                   tablefmt="grid"))
+    return 0
+
+# Czas od uruchomienia procesu do wyjścia z menu głównego (wybór "3") na osobnej bazie.
+# Punkt odniesienia to sam interpreter z importem SQLAlchemy - poniżej tego start aplikacji nie zejdzie.
+def command_bench_startup(args):
+    import subprocess
+    directory = tempfile.mkdtemp(prefix="library-startup-")
+    environment = {name: value for name, value in os.environ.items() if name not in ("LIBRARY_PROFILE", "LIBRARY_SEED_DEMO")}
+    environment["LIBRARY_DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'library.db')}"
+
+    def launch(command, extra_environment=None, stdin="3\n"):
+        started = time.perf_counter()
+        subprocess.run(command, input=stdin, env={**environment, **(extra_environment or {})}, capture_output=True, text=True, check=True)
+        return time.perf_counter() - started
+
+    application = [sys.executable, "-W", "ignore", os.path.abspath(__file__)]
+    measurements = [("Pierwszy start (nowa baza, tworzenie schematu)", [launch(application, stdin="\n3\n")])]
+    subprocess.run(application + ["init", "--demo"], env=environment, capture_output=True, check=True)
+    measurements += [
+        ("Kolejny start", [launch(application) for _ in range(args.runs)]),
+        ("Kolejny start z LIBRARY_SEED_DEMO=1", [launch(application, {"LIBRARY_SEED_DEMO": "1"}) for _ in range(args.runs)]),
+        ("Sam Python + import SQLAlchemy ORM", [launch([sys.executable, "-W", "ignore", "-c", "import sqlalchemy.orm"], stdin="") for _ in range(args.runs)]),
+    ]
+    rows = []
+    for name, values in measurements:
+        values.sort()
+        rows.append([name, len(values), f"{values[0] * 1000:.0f}", f"{percentile(values, 0.5) * 1000:.0f}"])
+    print(tabulate(rows, headers=["Start", "Uruchomienia", "Min [ms]", "Mediana [ms]"], tablefmt="grid"))
+    return 0
+
+def build_parser():
+    import argparse  # Tylko dla poleceń - menu go nie potrzebuje
+    parser = argparse.ArgumentParser(description="Biblioteka - polecenia administracyjne. Bez argumentów uruchamia menu aplikacji.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("init", help="przygotuj bazę: schemat, opcjonalnie konto administratora i dane demonstracyjne")
+    command.add_argument("--admin", metavar="NAZWA", help="utwórz konto administratora (hasło podaje się interaktywnie)")
+    command.add_argument("--demo", action="store_true", help="dodaj konta admin/user1 i trzy książki, jeśli ich nie ma")
+    command.set_defaults(handler=command_init)
+    commands.add_parser("migrate", help="zastosuj brakujące migracje i pokaż wersję schematu").set_defaults(handler=command_migrate)
+    commands.add_parser("branches", help="pokaż oddziały i stan ich baz (LIBRARY_BRANCHES)").set_defaults(handler=command_branches)
+    commands.add_parser("check-indexes", help="sprawdź, czy najczęstsze zapytania korzystają z indeksów").set_defaults(handler=command_check_indexes)
+    command = commands.add_parser("stress", help="wieloprocesowy test wypożyczeń i zwrotów na jednej bazie")
+    command.add_argument("--db", help="plik bazy (domyślnie nowa baza w katalogu tymczasowym)")
+    command.add_argument("--processes", type=int, default=4, help="liczba procesów (terminali)")
+    command.add_argument("--operations", type=int, default=500, help="liczba operacji na proces")
+    command.add_argument("--books", type=int, default=5, help="liczba książek, o które konkurują procesy")
+    command.add_argument("--copies", type=int, default=2, help="liczba egzemplarzy każdej książki")
+    command.set_defaults(handler=command_stress)
+    command = commands.add_parser("import-books", help="import katalogu książek z pliku CSV lub JSON Lines")
+    command.add_argument("file", help="plik z polami title, author, year")
+    command.add_argument("--format", choices=["csv", "jsonl"], help="format pliku (domyślnie według rozszerzenia)")
+    command.add_argument("--batch-size", type=int, default=5000, help="liczba rekordów w jednej transakcji")
+    command.add_argument("--restart", action="store_true", help="importuj od początku, ignorując zapisany postęp")
+    command.set_defaults(handler=command_import_books)
+    command = commands.add_parser("export", help="strumieniowy eksport książek, użytkowników lub transakcji")
+    command.add_argument("table", choices=sorted(EXPORT_COLUMNS))
+    command.add_argument("--format", choices=["csv", "jsonl", "parquet"], default="csv", help="format pliku (parquet wymaga pyarrow)")
+    command.add_argument("--output", default="-", help="plik wyjściowy ('-' - standardowe wyjście)")
+    command.add_argument("--since-id", type=int, help="tylko wiersze o ID większym niż podane (eksport przyrostowy)")
+    command.add_argument("--since", help="tylko transakcje wypożyczone lub zwrócone od tej chwili (RRRR-MM-DD[ GG:MM])")
+    command.add_argument("--batch-size", type=int, default=1000, help="liczba wierszy pobieranych z bazy naraz")
+    command.set_defaults(handler=command_export)
+    command = commands.add_parser("scan-overdue", help="znajdź zaległe wypożyczenia i dopisz powiadomienia do kolejki")
+    command.add_argument("--every", type=int, default=0, metavar="SEKUNDY", help="powtarzaj skan co podaną liczbę sekund")
+    command.add_argument("--batch-size", type=int, default=1000)
+    command.add_argument("--outbox", metavar="PLIK", help="przenieś niewysłane powiadomienia do pliku JSON Lines")
+    command.set_defaults(handler=command_scan_overdue)
+    command = commands.add_parser("expire-holds", help="wygaś przeterminowane rezerwacje i powiadom czytelników")
+    command.add_argument("--every", type=int, default=0, metavar="SEKUNDY", help="powtarzaj co podaną liczbę sekund")
+    command.add_argument("--batch-size", type=int, default=1000)
+    command.set_defaults(handler=command_expire_holds)
+    command = commands.add_parser("backup", help="kopia zapasowa działającej bazy bez zatrzymywania terminali")
+    command.add_argument("target", help="plik kopii albo katalog migawek (--incremental)")
+    command.add_argument("--compress", action="store_true", help="kompresja gzip (pliku kopii albo kawałków migawki)")
+    command.add_argument("--incremental", action="store_true", help="migawka w katalogu - zapisuje tylko zmienione kawałki bazy")
+    command.add_argument("--keep", type=int, metavar="N", help="zostaw tylko N najnowszych migawek")
+    command.add_argument("--pages", type=int, default=BACKUP_PAGES, help="stron bazy kopiowanych w jednym kroku (-1 - wszystkie naraz)")
+    command.add_argument("--pause-ms", type=float, default=BACKUP_PAUSE_MS, help="przerwa między krokami kopii")
+    command.set_defaults(handler=command_backup)
+    command = commands.add_parser("restore", help="odtwórz bazę z kopii po sprawdzeniu jej integralności (terminale muszą być zatrzymane)")
+    command.add_argument("source", help="plik kopii (.db lub .gz) albo katalog migawek")
+    command.add_argument("--target", help="plik odtwarzanej bazy (domyślnie baza aplikacji)")
+    command.add_argument("--snapshot", metavar="MANIFEST", help="nazwa migawki (domyślnie najnowsza)")
+    command.add_argument("--force", action="store_true", help="zastąp istniejący plik bazy")
+    command.set_defaults(handler=command_restore)
+    command = commands.add_parser("archive-transactions", help="przenieś dawno zwrócone wypożyczenia do archiwum")
+    command.add_argument("--older-than-days", type=int, default=ARCHIVE_AFTER_DAYS, metavar="DNI",
+                         help="archiwizuj wypożyczenia zwrócone więcej niż podaną liczbę dni temu")
+    command.add_argument("--every", type=int, default=0, metavar="SEKUNDY", help="powtarzaj co podaną liczbę sekund")
+    command.add_argument("--batch-size", type=int, default=5000)
+    command.set_defaults(handler=command_archive_transactions)
+    command = commands.add_parser("bench-overdue", help="zmierz czas skanu zaległości względem rozmiaru tabeli")
+    command.add_argument("--loans", type=int, default=1000000, help="liczba transakcji w pełnej tabeli")
+    command.add_argument("--overdue", type=int, nargs="+", default=[1000, 10000], help="liczby zaległych wypożyczeń do zmierzenia")
+    command.set_defaults(handler=command_bench_overdue)
+    command = commands.add_parser("rebuild-stats", help="sprawdź i przelicz od zera statystyki wypożyczeń")
+    command.add_argument("--check", action="store_true", help="tylko sprawdź zgodność, bez przeliczania")
+    command.set_defaults(handler=command_rebuild_stats)
+    command = commands.add_parser("bench-stats", help="porównaj odczyt statystyk z agregacją GROUP BY")
+    command.add_argument("--loans", type=int, default=1000000)
+    command.add_argument("--books", type=int, default=20000)
+    command.add_argument("--users", type=int, default=2000)
+    command.add_argument("--repeat", type=int, default=5)
+    command.set_defaults(handler=command_bench_stats)
+    command = commands.add_parser("bench-copies", help="porównaj wyszukiwanie i listy przy modelu z egzemplarzami i bez")
+    command.add_argument("--titles", type=int, default=20000)
+    command.add_argument("--copies", type=int, default=5, help="egzemplarzy każdego tytułu")
+    command.set_defaults(handler=command_bench_copies)
+    command = commands.add_parser("bench-holds", help="zmierz przekazywanie zwróconej książki kolejce rezerwacji")
+    command.add_argument("--holds", type=int, nargs="+", default=[100, 1000, 10000, 50000], help="długości kolejek do zmierzenia")
+    command.add_argument("--cycles", type=int, default=200, help="liczba zwrotów na pomiar")
+    command.set_defaults(handler=command_bench_holds)
+    command = commands.add_parser("bench-extensions", help="zmierz listę i zbiorcze decyzje dla dużej kolejki próśb o przedłużenie")
+    command.add_argument("--pending", type=int, default=50000, help="liczba oczekujących próśb")
+    command.add_argument("--pages", type=int, default=100, help="liczba kolejnych stron do zmierzenia")
+    command.set_defaults(handler=command_bench_extensions)
+    command = commands.add_parser("audit", help="przeszukaj dziennik zdarzeń (od najnowszych)")
+    command.add_argument("--actor", help="ID lub nazwa użytkownika, który wykonał operację")
+    command.add_argument("--target", help="obiekt: typ albo typ:ID, np. user:5, book:12")
+    command.add_argument("--action", help="rodzaj zdarzenia, np. user.delete; '*' na końcu to prefiks, np. 'user.*'")
+    command.add_argument("--since", help="od chwili (RRRR-MM-DD[ GG:MM])")
+    command.add_argument("--until", help="do chwili, bez niej (RRRR-MM-DD[ GG:MM])")
+    command.add_argument("--limit", type=int, default=50)
+    command.set_defaults(handler=command_audit)
+    command = commands.add_parser("audit-compact", help="przenieś stare miesiące dziennika zdarzeń do plików .jsonl.gz")
+    command.add_argument("--keep-months", type=int, default=12, help="liczba ostatnich miesięcy zostawianych w bazie (poza bieżącym)")
+    command.add_argument("--archive-dir", default="audit-archive")
+    command.set_defaults(handler=command_audit_compact)
+    command = commands.add_parser("bench-audit", help="zmierz koszt dziennika zdarzeń przy wypożyczeniach")
+    command.add_argument("--operations", type=int, default=2000)
+    command.add_argument("--books", type=int, default=50)
+    command.add_argument("--threads", type=int, default=4)
+    command.set_defaults(handler=command_bench_audit)
+    command = commands.add_parser("generate-data", help="wygeneruj bazę z użytkownikami, książkami i historią wypożyczeń")
+    command.add_argument("--scale", choices=list(DATASET_SCALES), default="10k", help="liczba transakcji (10k, 1m lub 10m)")
+    command.add_argument("--db", help="plik nowej bazy (domyślnie library-<scale>.db)")
+    command.add_argument("--seed", type=int, default=1)
+    command.set_defaults(handler=command_generate_data)
+    command = commands.add_parser("bench-suite", help="zmierz najczęstsze operacje (percentyle, pamięć) i porównaj z poprzednim przebiegiem")
+    command.add_argument("--db", required=True, help="baza z danymi z generate-data (pomiar dopisuje wypożyczenia do historii)")
+    command.add_argument("--repeat", type=int, default=200, help="wywołania każdej operacji")
+    command.add_argument("--login-repeat", type=int, default=10, help="wywołania logowania (bcrypt jest kosztowny)")
+    command.add_argument("--seed", type=int, default=1)
+    command.add_argument("--save", metavar="PLIK", help="zapisz wyniki do pliku JSON")
+    command.add_argument("--compare", metavar="PLIK", help="porównaj z wynikami zapisanymi wcześniej")
+    command.add_argument("--threshold", type=float, default=20, help="dopuszczalny wzrost p50/p90 w procentach")
+    command.set_defaults(handler=command_bench_suite)
+    command = commands.add_parser("bench-search", help="zmierz wyszukiwanie z literówkami (indeks trigramów) na bazie z generate-data")
+    command.add_argument("--db", required=True)
+    command.add_argument("--queries", type=int, default=200, help="zapytań każdego rodzaju")
+    command.add_argument("--seed", type=int, default=1)
+    command.set_defaults(handler=command_bench_search)
+    command = commands.add_parser("serve", help="uruchom lokalne API HTTP/JSON")
+    command.add_argument("--host", default="127.0.0.1")
+    command.add_argument("--port", type=int, default=8080)
+    command.add_argument("--workers", type=int, default=8, help="wątki obsługujące bazę danych i bcrypt")
+    command.set_defaults(handler=command_serve)
+    command = commands.add_parser("bench-login", help="zmierz liczbę logowań na sekundę w zależności od liczby rdzeni")
+    command.add_argument("--rounds", type=int, default=BCRYPT_ROUNDS, help="koszt bcrypt (4-31)")
+    command.add_argument("--logins", type=int, default=40)
+    command.set_defaults(handler=command_bench_login)
+    command = commands.add_parser("profile-report", help="pokaż profil zapisany przy wyjściu (LIBRARY_PROFILE=1, LIBRARY_PROFILE_FILE)")
+    command.add_argument("file", metavar="PLIK")
+    command.add_argument("--limit", type=int, default=20, help="pozycji w każdej sekcji")
+    command.set_defaults(handler=command_profile_report)
+    command = commands.add_parser("bench-profile", help="zmierz narzut włączonego profilowania")
+    command.add_argument("--books", type=int, default=1000)
+    command.add_argument("--repeat", type=int, default=200, help="wywołań każdej operacji w rundzie")
+    command.add_argument("--rounds", type=int, default=5)
+    command.set_defaults(handler=command_bench_profile)
+    command = commands.add_parser("bench-backup", help="zmierz wpływ kopii zapasowej na czas wypożyczenia")
+    command.add_argument("--db", required=True, help="baza z danymi z generate-data (pomiar dopisuje wypożyczenia do historii)")
+    command.add_argument("--repeat", type=int, default=200, help="wypożyczenia w pomiarze bez kopii")
+    command.add_argument("--pages", type=int, default=BACKUP_PAGES, help="stron bazy na krok kopii")
+    command.add_argument("--pause-ms", type=float, default=BACKUP_PAUSE_MS, help="przerwa między krokami kopii")
+    command.add_argument("--seed", type=int, default=1)
+    command.set_defaults(handler=command_bench_backup)
+    command = commands.add_parser("bench-startup", help="zmierz czas startu aplikacji do menu głównego")
+    command.add_argument("--runs", type=int, default=10)
+    command.set_defaults(handler=command_bench_startup)
+    command = commands.add_parser("api-check", help="sprawdź API lokalnym klientem na tymczasowej bazie")
+    command.add_argument("--workers", type=int, default=4)
+    command.set_defaults(handler=command_api_check)
+    return parser
+
+# Funkcje mierzone przez profiler: operacje biblioteki, strony list, haszowanie haseł (z czekaniem na proces bcrypt),
+# rysowanie tabel i czyszczenie terminala (os.system uruchamia osobny proces). Bez list przeglądanych interaktywnie -
+# ich czas obejmowałby czekanie na użytkownika.
+PROFILED_FUNCTIONS = (
+    "register_user", "login_user", "get_user", "get_user_by_username", "delete_user", "change_password_by_admin",
+    "change_activated_status", "change_blocked_status", "edit_user_data", "find_users", "search_user", "find_books", "search_book",
+    "find_similar_users", "find_similar_books", "find_user_branch", "find_books_in_branches", "find_similar_books_in_branches",
+    "find_book_in_other_branches",
+    "find_user_loans", "display_user_books", "change_password", "count_user_borrowed_books", "borrow_book", "return_book",
+    "allocate_holds", "place_hold", "cancel_hold", "find_user_holds", "display_user_holds", "expire_holds", "get_book",
+    "add_book", "add_copies", "delete_book", "edit_book", "extend_borrow_period", "request_extension",
+    "decide_extension_requests", "find_user_extension_requests", "display_user_extension_requests", "iter_transaction_pages",
+    "scan_overdue_loans", "archive_transactions", "deliver_notifications", "query_audit_log", "get_circulation_stats",
+    "display_statistics",
+    "import_books", "export_table", "KeysetPager.fetch", "AuditLog.flush", "hash_password", "check_password",
+    "tabulate", "clear_terminal",
+)
+
+if PROFILE:
+    profiler.enable()
 
 # Przykładowe użycie
 if __name__ == "__main__":
-    admin_username = "admin"
-    admin_password = "admin123"
-    register_user(admin_username, admin_password,True)
-    user_name="user1"
-    user_password="user123"
-    register_user(user_name,user_password,False)
-
-    # Dodaj kilka książek
-    books_data = [
-        {"title": "Harry Potter and the Philosopher's Stone", "author": "J.K. Rowling", "year": 1997},
-        {"title": "To Kill a Mockingbird", "author": "Harper Lee", "year": 1960},
-        {"title": "1984", "author": "George Orwell", "year": 1949}
-    ]
-    for book_info in books_data:
-        book = Book(**book_info)
-        session.add(book)
-    session.commit()
+    if len(sys.argv) > 1:
+        args = build_parser().parse_args()
+        sys.exit(args.handler(args))
+
+    # Dane demonstracyjne tylko na życzenie: LIBRARY_SEED_DEMO=1 albo jednorazowo polecenie init --demo
+    if os.environ.get("LIBRARY_SEED_DEMO", "") not in ("", "0"):
+        seed_demo_data()
+    with engine.connect() as connection:
+        if connection.exec_driver_sql("SELECT 1 FROM users LIMIT 1").first() is None:
+            print("Baza nie ma jeszcze kont. Utwórz administratora: python library-app.py init --admin NAZWA (albo init --demo).")
+            input("Naciśnij Enter, aby kontynuować...")
 
     # Główna pętla aplikacji
     while True:
+        current_branch.set(None)  # Po wylogowaniu terminal wraca do swojego oddziału
         # Logowanie lub rejestracja
         while True:
             clear_terminal()
-            choice = input("Witaj w bibliotece!\n1. Zaloguj się\n2. Zarejestruj się\n3. Zamknij aplikację\nWybierz opcję: ")
+            choice = input(f"Witaj w bibliotece{f' (oddział {BRANCH})' if BRANCH else ''}!\n1. Zaloguj się\n2. Zarejestruj się\n3. Zamknij aplikację\nWybierz opcję: ")
             if choice == "1":
                 clear_terminal()
                 print("--- ZALOGUJ SIĘ --- 'esc' - exit ")
@@ -383,8 +4671,12 @@ if __name__ == "__main__":
                     print("Anulowano.")
                 else:
                     password = getpass("Podaj hasło: ")
-                    user = login_user(username, password)
+                    # Konto z innego oddziału obsługujemy w bazie jego oddziału
+                    branch = find_user_branch(username)
+                    user = run_in_branch(branch, login_user, username, password)
                     if user:
+                        current_branch.set(branch)
+                        current_actor.set(user.id)  # Autor kolejnych zdarzeń w dzienniku
                         print("Zalogowano.")
                         break
                     else:
@@ -410,6 +4702,10 @@ if __name__ == "__main__":
 
         # Menu admina po zalogowaniu
         while True:
+            # Odświeżamy dane zalogowanego użytkownika - status mógł zmienić administrator z innego terminala
+            user = get_user(user.id)
+            if user is None:
+                break
             if (user.activated == False):
                 clear_terminal()
                 input("Twoje konto zostało dezaktywowane, skontaktuj się z administratorem.")
@@ -419,7 +4715,7 @@ if __name__ == "__main__":
                 clear_terminal()
                 print(f"Witaj {user.name}!")
                 action = input(
-                    "\nCo chcesz zrobić?\n1. Zarządzanie użytkownikami\n2. Zarządzanie książkami\n3. Zmień hasło\n4. Przeglądaj Transakcje\n5. Wyloguj\nWybierz opcję: ")
+                    "\nCo chcesz zrobić?\n1. Zarządzanie użytkownikami\n2. Zarządzanie książkami\n3. Zmień hasło\n4. Przeglądaj Transakcje\n5. Zaległe wypożyczenia\n6. Statystyki\n7. Prośby o przedłużenie\n8. Wyloguj\nWybierz opcję: ")
                 if action == "1":
                     while True:
                         clear_terminal()
@@ -429,7 +4725,7 @@ if __name__ == "__main__":
                         if user_action == "1":
                             clear_terminal()
                             print("--- WYŚWIETL WSZYSTKICH UŻYTKOWNIKÓW ---")
-                            display_all_users()
+                            display_all_users(pause=True)
                             input("Naciśnij Enter, aby kontynuować...")
                         elif user_action == "2":
                             clear_terminal()
@@ -460,7 +4756,7 @@ if __name__ == "__main__":
 
                                 try:
                                     user_id = int(user_id)
-                                    user_to_edit = session.query(User).filter_by(id=user_id).first()
+                                    user_to_edit = get_user(user_id)
 
 
                                     # Dane użytkownika w formie listy
@@ -494,11 +4790,7 @@ if __name__ == "__main__":
                                             edit_user_data(user_to_edit, username=new_username)
                                         elif option == "2":
                                             new_password = getpass("Nowe hasło: ")
-                                            password_hash = bcrypt.hashpw(new_password.encode('utf-8'),
-                                                                         bcrypt.gensalt())
-                                            user_to_edit.password_hash = password_hash
-                                            session.commit()
-                                            print("Hasło zostało pomyślnie zmienione.")
+                                            change_password(user_to_edit.id, new_password)
                                         elif option == "3":
                                             new_name = input("Nowe imię: ")
                                             edit_user_data(user_to_edit, name=new_name)
@@ -546,10 +4838,11 @@ if __name__ == "__main__":
                             else:
                                 try:
                                     changed_user_id = int(changed_user_id)
-                                    changed_user = session.query(User).filter_by(id=changed_user_id).first()
+                                    changed_user = get_user(changed_user_id)
                                     if changed_user:
                                         activated = True if changed_user.activated == False else False
                                         change_activated_status(changed_user_id, activated)
+                                        changed_user = get_user(changed_user_id)
                                         print(
                                             f"Aktywowano użytkownika o ID {changed_user_id}." if activated else f"Dezaktywowano użytkownika o ID {changed_user_id}.")
 
@@ -584,10 +4877,11 @@ if __name__ == "__main__":
                             else:
                                 try:
                                     changed_user_id = int(changed_user_id)
-                                    changed_user = session.query(User).filter_by(id=changed_user_id).first()
+                                    changed_user = get_user(changed_user_id)
                                     if changed_user:
                                         blocked = True if changed_user.blocked == False else False
                                         change_blocked_status(changed_user_id, blocked)
+                                        changed_user = get_user(changed_user_id)
                                         print(
                                             f"Zablokowano użytkownika o ID {changed_user_id}." if blocked else f"Odblokowano użytkownika o ID {changed_user_id}.")
 
@@ -624,11 +4918,11 @@ if __name__ == "__main__":
                         clear_terminal()
                         print("--- ZARZĄDZANIE KSIĄŻKAMI --- 'esc' - exit ")
                         book_action = input(
-                            "\nCo chcesz zrobić?\n1. Wyświetl listę książek\n2. Dodaj książkę\n3. Edytuj książkę\n4. Szukaj książki\n5. Wydłuż czas wypożyczenia\n6. Powrót\nWybierz opcję: ")
+                            "\nCo chcesz zrobić?\n1. Wyświetl listę książek\n2. Dodaj książkę\n3. Edytuj książkę\n4. Szukaj książki\n5. Wydłuż czas wypożyczenia\n6. Dodaj egzemplarze\n7. Powrót\nWybierz opcję: ")
                         if book_action == "1":
                             clear_terminal()
                             print("--- WYŚWIETL LISTĘ KSIĄŻEK ---")
-                            display_all_books()
+                            display_all_books(pause=True)
                             input("Naciśnij Enter, aby kontynuować...")
                         elif book_action == "2":
                             clear_terminal()
@@ -646,9 +4940,12 @@ if __name__ == "__main__":
                                         break  # Jeśli udało się przekonwertować na int, wychodzimy z pętli
                                     except ValueError:
                                         print("Podany rok jest nieprawidłowy. Wprowadź liczbę.")
-                                book = Book(title=title, author=author, year=year)
-                                session.add(book)
-                                session.commit()
+                                while True:
+                                    copies_input = input("Podaj liczbę egzemplarzy (Enter - 1): ").strip()
+                                    if copies_input.isdigit() and int(copies_input) > 0 or copies_input == "":
+                                        break
+                                    print("Liczba egzemplarzy musi być dodatnią liczbą.")
+                                add_book(title, author, year, int(copies_input or 1))
                                 print("Dodano książkę.")
                             input("Naciśnij Enter, aby kontynuować...")
                         elif book_action == "3":
@@ -664,7 +4961,6 @@ if __name__ == "__main__":
                                 print("1. Tytuł")
                                 print("2. Autor")
                                 print("3. Rok")
-                                print("4. ID wypożyczającego")
                                 edit_option = input("Wybierz opcję: ")
                                 if edit_option == "1":
                                     new_title = input("Podaj nowy tytuł: ")
@@ -675,22 +4971,6 @@ if __name__ == "__main__":
                                 elif edit_option == "3":
                                     new_year = input("Podaj nowy rok: ")
                                     edit_book(book_id, None, None, new_year)
-                                elif edit_option == "4":
-                                    while True:
-                                        new_user_id_input = input(
-                                            "Podaj nowe ID użytkownika (0 - brak przypisanego użytkownika): ")
-                                        if new_user_id_input.lower() == "esc":
-                                            print("Anulowano.")
-                                            break
-                                        try:
-                                            new_user_id = int(new_user_id_input)
-                                            if new_user_id < 0:
-                                                print("Podane ID użytkownika jest nieprawidłowe.")
-                                            else:
-                                                edit_book(book_id, None, None, None, new_user_id)
-                                                break
-                                        except ValueError:
-                                            print("Podane ID użytkownika jest nieprawidłowe.")
                                 else:
                                     print("Nieprawidłowy wybór.")
                                 input("Naciśnij Enter, aby kontynuować...")
@@ -705,13 +4985,28 @@ if __name__ == "__main__":
                             print("--- PRZEDŁUŻENIE WYPOŻYCZENIA ---")
                             try:
                                 bookid = input("Wprowadź ID książki: ")
-                                days=30
-                                extend_borrow_period(bookid,days)
+                                loan_user_id = input("ID użytkownika (puste, jeśli wypożyczono jeden egzemplarz): ").strip()
+                                days = input(f"Liczba dni (puste - {EXTENSION_DAYS}): ").strip()
+                                days = int(days) if days else EXTENSION_DAYS
+                                extend_borrow_period(bookid,days, int(loan_user_id) if loan_user_id else None)
                             except ValueError:
                                 print("Podano nieprawidłową wartość!")
                             input("Naciśnij Enter, aby kontynuować...")
-
                         elif book_action == "6":
+                            clear_terminal()
+                            print("--- DODAJ EGZEMPLARZE ---")
+                            try:
+                                book_id = int(input("Wprowadź ID książki: "))
+                                count = int(input("Liczba nowych egzemplarzy: "))
+                                if count > 0:
+                                    add_copies(book_id, count)
+                                else:
+                                    print("Liczba egzemplarzy musi być dodatnia.")
+                            except ValueError:
+                                print("Podano nieprawidłową wartość!")
+                            input("Naciśnij Enter, aby kontynuować...")
+
+                        elif book_action == "7":
                             break
                         elif book_action == "esc":
                             break
@@ -731,9 +5026,51 @@ if __name__ == "__main__":
                 elif action == "4":
                     clear_terminal()
                     print("--- TRANSAKCJE ---")
-                    display_transactions()
+                    status_choice = input("Status (1 - wszystkie, 2 - niezwrócone, 3 - zwrócone, 4 - przeterminowane): ").strip()
+                    status = {"2": "open", "3": "returned", "4": "overdue"}.get(status_choice)
+                    try:
+                        filter_user_id = input("ID użytkownika (puste - wszyscy): ").strip()
+                        filter_user_id = int(filter_user_id) if filter_user_id else None
+                        date_from = parse_date(input("Data wypożyczenia od (RRRR-MM-DD, puste - bez ograniczenia): "))
+                        date_to = parse_date(input("Data wypożyczenia do (RRRR-MM-DD, puste - bez ograniczenia): "))
+                        if date_to is not None:
+                            date_to += timedelta(days=1)  # Włącznie z podanym dniem
+                        clear_terminal()
+                        print("--- TRANSAKCJE ---")
+                        display_transactions(status, filter_user_id, date_from, date_to, pause=True)
+                    except ValueError:
+                        print("Podano nieprawidłową wartość!")
                     input("Naciśnij Enter, aby kontynuować...")
                 elif action == "5":
+                    clear_terminal()
+                    print("--- ZALEGŁE WYPOŻYCZENIA ---")
+                    summary, created = scan_overdue_loans()
+                    display_overdue_summary(summary)
+                    print(f"Dodano {created} nowych powiadomień do kolejki.")
+                    input("Naciśnij Enter, aby kontynuować...")
+                elif action == "6":
+                    clear_terminal()
+                    print("--- STATYSTYKI ---")
+                    display_statistics()
+                    print("\nPamięć podręczna tego procesu:")
+                    display_cache_stats()
+                    input("Naciśnij Enter, aby kontynuować...")
+                elif action == "7":
+                    clear_terminal()
+                    print("--- PROŚBY O PRZEDŁUŻENIE --- 'esc' - exit ")
+                    display_extension_requests(pause=True)
+                    decision = input("z <ID> - zatwierdź, o <ID> - odrzuć (np. 'z 1,4-9', 'o wszystkie'), Enter - powrót: ").strip().lower()
+                    if decision[:1] in ("z", "o"):
+                        try:
+                            ids = None if decision[1:].strip() == "wszystkie" else parse_id_list(decision[1:])
+                            reason = input("Powód odrzucenia (opcjonalnie): ").strip() if decision[0] == "o" else None
+                            display_extension_decision(decide_extension_requests(ids, decision[0] == "z", user.id, reason))
+                        except ValueError:
+                            print("Podano nieprawidłowe ID!")
+                    elif decision not in ("", "esc"):
+                        print("Nieprawidłowy wybór.")
+                    input("Naciśnij Enter, aby kontynuować...")
+                elif action == "8":
                     break
                 else:
                     print("Nieprawidłowy wybór.")
@@ -751,7 +5088,7 @@ if __name__ == "__main__":
                     print("Aby kontynuować, podaj swoje imię i nazwisko:")
                     name = input("Imię: ")
                     surname = input("Nazwisko: ")
-                    edit_user_data(user, name=name, surname=surname)
+                    user = edit_user_data(user, name=name, surname=surname) or user
                 clear_terminal()
 
                 print(f"Witaj {user.name}!")
@@ -761,18 +5098,22 @@ if __name__ == "__main__":
                     print("Twoje konto zostało zablokowane! Skontaktuj się z administratorem")
 
                 borrowed_books_count = count_user_borrowed_books(user.id)  # Liczba wypożyczonych książek
+                holds_count = len(find_user_holds(user.id))  # Liczba oczekujących rezerwacji
 
                 action = input(
-                    f"\nCo chcesz zrobić?\n1. Wypożycz książkę\n2. Oddaj książkę\n3. Pokaż dostępne książki\n4. Pokaż moje wypożyczone książki ({borrowed_books_count})\n5. Edytuj swoje dane\n6. Zmień hasło\n7. Deaktywuj moje konto\n8. Wyloguj\nWybierz opcję: ")
+                    f"\nCo chcesz zrobić?\n1. Wypożycz książkę\n2. Oddaj książkę\n3. Pokaż dostępne książki\n4. Pokaż moje wypożyczone książki ({borrowed_books_count})\n5. Moje rezerwacje ({holds_count})\n6. Edytuj swoje dane\n7. Zmień hasło\n8. Deaktywuj moje konto\n9. Wyloguj\nWybierz opcję: ")
                 if action == "1":
                     clear_terminal()
                     print("--- WYPOŻYCZ KSIĄŻKĘ --- 'esc' - exit ")
-                    display_available_books()
+                    display_available_books(pause=True)
                     book_id = input("Podaj ID książki, którą chcesz wypożyczyć: ")
                     if book_id.lower() == "esc":
                         print("Anulowano.")
-                    else:
-                        borrow_book(user, book_id)
+                    elif not borrow_book(user, book_id) and book_id.isdigit():
+                        # Wszystkie egzemplarze wypożyczone - można ustawić się w kolejce
+                        book = get_book(int(book_id))
+                        if book and book.available == 0 and input("Czy chcesz zarezerwować tę książkę? (TAK/NIE): ").upper() == "TAK":
+                            place_hold(user, book_id)
                     input("Naciśnij Enter, aby kontynuować...")
                     clear_terminal()
                 elif action == "2":
@@ -789,16 +5130,33 @@ if __name__ == "__main__":
                 elif action == "3":
                     clear_terminal()
                     print("--- DOSTĘPNE KSIĄŻKI ---")
-                    display_available_books()
+                    display_available_books(pause=True)
                     input("Naciśnij Enter, aby kontynuować...")
                     clear_terminal()
                 elif action == "4":
                     clear_terminal()
                     print("--- MOJE WYPOŻYCZONE KSIĄŻKI ---")
                     display_user_books(user.id)
+                    display_user_extension_requests(user.id)
+                    if borrowed_books_count:
+                        book_id = input("Podaj ID książki, aby poprosić o przedłużenie (Enter - pomiń): ").strip()
+                        if book_id and book_id.lower() != "esc":
+                            request_extension(user, book_id)
                     input("Naciśnij Enter, aby kontynuować...")
                     clear_terminal()
                 elif action == "5":
+                    clear_terminal()
+                    print("--- MOJE REZERWACJE --- 'esc' - exit ")
+                    display_user_holds(user.id)
+                    if holds_count:
+                        book_id = input("Podaj ID książki, której rezerwację chcesz anulować (Enter - pomiń): ")
+                        if book_id.isdigit():
+                            cancel_hold(user, int(book_id))
+                        elif book_id and book_id.lower() != "esc":
+                            print("Podano nieprawidłowe ID książki.")
+                    input("Naciśnij Enter, aby kontynuować...")
+                    clear_terminal()
+                elif action == "6":
                     clear_terminal()
                     print("--- EDYTUJ SWOJE DANE --- 'esc' - exit ")
                     new_name = input("Nowe imię (jeśli bez zmian, zostaw puste): ")
@@ -807,16 +5165,16 @@ if __name__ == "__main__":
                         input("Anulowano.")
                         clear_terminal()
                     elif new_name.lower() == "" and new_surname.lower() != "":
-                        edit_user_data(user, surname=new_surname)
+                        user = edit_user_data(user, surname=new_surname) or user
                         input("Zmieniono nazwisko.")
                     elif new_surname.lower() == "" and new_name.lower() != "":
-                        edit_user_data(user, name=new_name)
+                        user = edit_user_data(user, name=new_name) or user
                         input("Zmieniono imie.")
                     elif new_name.lower() != "" and new_surname.lower() != "":
-                        edit_user_data(user, name=new_name, surname=new_surname)
+                        user = edit_user_data(user, name=new_name, surname=new_surname) or user
                     input("Naciśnij Enter, aby kontynuować...")
                     clear_terminal()
-                elif action == "6":
+                elif action == "7":
                     clear_terminal()
                     print("--- ZMIEŃ HASŁO ---")
                     new_password = getpass("Nowe hasło: ")
@@ -827,7 +5185,7 @@ if __name__ == "__main__":
                         print("Podane hasła nie zgadzają się.")
                     input("Naciśnij Enter, aby kontynuować...")
                     clear_terminal()
-                elif action == "7":
+                elif action == "8":
                     clear_terminal()
                     print("--- DEAKTYWUJ MOJE KONTO ---")
                     confirmation = input("Czy na pewno chcesz deaktywować swoje konto? (TAK/NIE): ")
@@ -840,7 +5198,7 @@ if __name__ == "__main__":
                     else:
                         print("Nieprawidłowa odpowiedź.")
                     input("Naciśnij Enter, aby kontynuować...")
-                elif action == "8":
+                elif action == "9":
                     break
                 elif action.lower() == "esc":
                     break
@@ -0,0 +1,44 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "library-app.py")
+
+
+# library-app.py ma myślnik w nazwie, więc ładujemy go z pliku jako moduł library_app.
+# Przy imporcie moduł łączy się z LIBRARY_DATABASE_URL - kierujemy go do katalogu tymczasowego, a nie do library.db.
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv("LIBRARY_DATABASE_URL", f"sqlite:///{tmp_path_factory.mktemp('import') / 'library.db'}")
+        for name in ("LIBRARY_BRANCHES", "LIBRARY_BRANCH", "LIBRARY_PROFILE"):
+            patch.delenv(name, raising=False)
+        spec = importlib.util.spec_from_file_location("library_app", APP_PATH)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["library_app"] = module
+        spec.loader.exec_module(module)
+    module.configure_password_hashing(rounds=4)  # Najniższy koszt bcrypt - testy nie sprawdzają siły haseł
+    return module
+
+
+# Każdy test dostaje własną, pustą bazę; pamięć podręczna nie może przenieść obiektów z poprzedniej bazy
+@pytest.fixture(autouse=True)
+def database(app, tmp_path):
+    path = tmp_path / "library.db"
+    engine = app.configure_database(f"sqlite:///{path}")
+    for cache in (app.user_cache, app.book_cache, app.available_books_cache):
+        cache.invalidate()
+    yield path
+    app.audit_log.flush()
+    engine.dispose()
+
+
+# Zakłada czytelnika i zwraca go tak, jak widzi go reszta aplikacji (obiekt z get_user_by_username)
+@pytest.fixture
+def make_user(app):
+    def make(username, password="haslo123", is_admin=False):
+        assert app.register_user(username, password, is_admin)
+        return app.get_user_by_username(username)
+    return make
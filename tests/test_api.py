@@ -0,0 +1,88 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+
+# Serwer API w tym samym procesie na wolnym porcie; każde żądanie to surowe bajty, więc nagłówki mogą być dowolnie zepsute.
+# Zwraca [(status, nagłówki, treść)] odpowiedzi przeczytanych z jednego połączenia.
+def exchange(api, *requests):
+    async def main():
+        server = await asyncio.start_server(api.handle_connection, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        responses = []
+        for request in requests:
+            writer.write(request)
+            await writer.drain()
+            status_line = await reader.readline()
+            if not status_line:
+                break
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = json.loads(await reader.readexactly(int(headers["content-length"])))
+            responses.append((int(status_line.split()[1]), headers, body))
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return responses
+    return asyncio.run(main())
+
+
+def login_request(username, password, length=None):
+    body = json.dumps({"username": username, "password": password}).encode("utf-8")
+    length = len(body) if length is None else length
+    return (f"POST /api/login HTTP/1.1\r\nHost: test\r\nContent-Length: {length}\r\n\r\n").encode("latin-1") + body
+
+
+@pytest.fixture
+def api(app):
+    api = app.LibraryApi(workers=2)
+    yield api
+    api.executor.shutdown()
+
+
+@pytest.mark.parametrize("length", ["abc", "-1", "1e3", " "])
+def test_invalid_content_length_is_rejected_and_closes_the_connection(app, api, make_user, length):
+    make_user("czytelnik")
+
+    # Drugie żądanie nie ma szans: serwer nie wie, gdzie kończy się treść pierwszego, więc zamyka połączenie
+    responses = exchange(api, login_request("czytelnik", "haslo123", length), login_request("czytelnik", "haslo123"))
+
+    assert len(responses) == 1
+    status, headers, body = responses[0]
+    assert status == 400
+    assert headers["connection"] == "close"
+    assert body["ok"] is False
+
+
+def test_valid_content_length_keeps_the_connection_alive(app, api, make_user):
+    make_user("czytelnik")
+
+    responses = exchange(api, login_request("czytelnik", "haslo123"), login_request("czytelnik", "złe"))
+
+    assert [status for status, _, _ in responses] == [200, 401]
+    assert responses[0][1]["connection"] == "keep-alive"
+    assert responses[0][2]["token"] in api.tokens
+
+
+def test_too_large_body_is_rejected(app, api):
+    responses = exchange(api, login_request("czytelnik", "haslo123", api.MAX_BODY_SIZE + 1))
+
+    assert responses[0][0] == 413
+    assert responses[0][1]["connection"] == "close"
+
+
+def test_login_purges_expired_tokens(app, api, make_user):
+    reader = make_user("czytelnik")
+    api.tokens["wygasly"] = (reader.id, None, datetime.now() - timedelta(seconds=1))
+    api.tokens["wazny"] = (reader.id, None, datetime.now() + timedelta(hours=1))
+
+    responses = exchange(api, login_request("czytelnik", "haslo123"))
+
+    assert responses[0][0] == 200
+    assert "wygasly" not in api.tokens
+    assert "wazny" in api.tokens
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select, update
+
+LOANS = 7
+
+
+# LOANS zwróconych wypożyczeń sprzed dwóch lat i jedno otwarte; zwraca ID wszystkich wypożyczeń
+@pytest.fixture
+def old_loans(app, make_user):
+    book = app.add_book("Kordian", "Juliusz Słowacki", 1834)
+    reader = make_user("czytelnik")
+    for _ in range(LOANS):
+        assert app.borrow_book(reader, book.id)
+        assert app.return_book(reader, book.id)
+    with app.session_scope() as session:
+        session.execute(update(app.Transaction).values(returned_at=datetime.now() - timedelta(days=730)))
+    assert app.borrow_book(reader, book.id)
+    with app.session_scope() as session:
+        return book.id, session.scalars(select(app.Transaction.id)).all()
+
+
+def table_ids(app, table):
+    with app.session_scope() as session:
+        return session.scalars(select(table.id).order_by(table.id)).all()
+
+
+def book_loans(app, book_id):
+    with app.session_scope() as session:
+        return session.get(app.BookStats, book_id).loans
+
+
+def test_archive_moves_old_returned_loans(app, old_loans):
+    book_id, ids = old_loans
+
+    assert app.archive_transactions(older_than_days=365, batch_size=3) == LOANS
+
+    assert table_ids(app, app.ArchivedTransaction) == ids[:LOANS]
+    assert table_ids(app, app.Transaction) == ids[LOANS:]
+    assert book_loans(app, book_id) == LOANS + 1
+
+
+# Przerwana paczka wycofuje się w całości, a ponowne uruchomienie zaczyna od wierszy, których jeszcze nie przeniesiono
+def test_interrupted_archive_resumes_without_duplicates(app, old_loans, monkeypatch):
+    book_id, ids = old_loans
+    record_event = app.audit_after_commit
+    batches = []
+
+    def fail_on_second_batch(session, action, *args, **kwargs):
+        batches.append(action)
+        if len(batches) == 2:
+            raise RuntimeError("przerwane archiwizowanie")
+        return record_event(session, action, *args, **kwargs)
+
+    monkeypatch.setattr(app, "audit_after_commit", fail_on_second_batch)
+    with pytest.raises(RuntimeError):
+        app.archive_transactions(older_than_days=365, batch_size=3)
+    monkeypatch.setattr(app, "audit_after_commit", record_event)
+
+    assert table_ids(app, app.ArchivedTransaction) == ids[:3]
+    assert table_ids(app, app.Transaction) == ids[3:]
+
+    assert app.archive_transactions(older_than_days=365, batch_size=3) == LOANS - 3
+
+    assert table_ids(app, app.ArchivedTransaction) == ids[:LOANS]
+    assert table_ids(app, app.Transaction) == ids[LOANS:]
+    assert book_loans(app, book_id) == LOANS + 1
+    assert app.archive_transactions(older_than_days=365, batch_size=3) == 0
+
+
+def test_archive_keeps_recent_loans_and_the_highest_id(app, old_loans):
+    _, ids = old_loans
+    with app.session_scope() as session:
+        session.execute(update(app.Transaction).where(app.Transaction.id == ids[0]).values(returned_at=datetime.now()))
+        session.execute(update(app.Transaction).where(app.Transaction.id == ids[-1]).values(returned_at=datetime.now() - timedelta(days=730)))
+
+    assert app.archive_transactions(older_than_days=365) == LOANS - 1
+
+    assert table_ids(app, app.Transaction) == [ids[0], ids[-1]]
+
+
+def test_extension_requests_of_archived_loans_stay_visible(app, make_user):
+    book, other = app.add_book("Dziady", "Adam Mickiewicz", 1823), app.add_book("Balladyna", "Juliusz Słowacki", 1839)
+    reader = make_user("czytelnik")
+    assert app.borrow_book(reader, book.id)
+    assert app.request_extension(reader, book.id)
+    assert app.return_book(reader, book.id)
+    assert app.borrow_book(reader, other.id)  # Najnowsze wypożyczenie zostaje w transactions
+    with app.session_scope() as session:
+        session.execute(update(app.Transaction).where(app.Transaction.book_id == book.id).values(returned_at=datetime.now() - timedelta(days=730)))
+
+    assert app.archive_transactions(older_than_days=365) == 1
+
+    assert [(title, status) for _, title, _, status, _, _ in app.find_user_extension_requests(reader.id)] == [("Dziady", "cancelled")]
@@ -0,0 +1,84 @@
+import os
+import sqlite3
+
+import pytest
+
+TABLES = ("users", "books", "copies", "transactions", "schema_version")
+
+
+def read_tables(path):
+    connection = sqlite3.connect(path)
+    try:
+        return {table: connection.execute(f"SELECT * FROM {table} ORDER BY rowid").fetchall() for table in TABLES}
+    finally:
+        connection.close()
+
+
+@pytest.fixture
+def library_data(app, make_user):
+    reader = make_user("czytelnik")
+    books = [app.add_book(f"Tytuł {number}", "Autor", 1900 + number, copies=2) for number in range(50)]
+    for book in books[:10]:
+        assert app.borrow_book(reader, book.id)
+    return reader
+
+
+@pytest.mark.parametrize("name, compress, incremental", [
+    ("library-backup.db", False, False),
+    ("library-backup.db.gz", True, False),
+    ("snapshots", False, True),
+    ("snapshots-gz", True, True),
+])
+def test_backup_restores_to_the_same_data(app, database, library_data, tmp_path, name, compress, incremental):
+    source = str(tmp_path / name)
+    target = str(tmp_path / "restored.db")
+
+    app.backup_database(source, compress=compress, incremental=incremental)
+    result = app.restore_database(source, target)
+
+    assert result["schema_version"] == app.MIGRATIONS[-1][0]
+    assert read_tables(target) == read_tables(database)
+
+
+# Migawki są w czasie: odtworzenie starszej migawki daje stan bazy z chwili jej wykonania
+def test_restore_of_an_older_snapshot(app, database, library_data, tmp_path):
+    directory, target = str(tmp_path / "snapshots"), str(tmp_path / "restored.db")
+    app.backup_database(directory, incremental=True)
+    before = read_tables(database)
+    app.add_book("Nowa książka", "Autor", 2024)
+    app.backup_database(directory, incremental=True)
+    first, second = app.list_snapshots(directory)
+
+    app.restore_database(directory, target, snapshot=first)
+    assert read_tables(target) == before
+
+    app.restore_database(directory, target, force=True)
+    assert read_tables(target) == read_tables(database)
+    assert len(read_tables(target)["books"]) == len(before["books"]) + 1
+
+
+def test_restore_rejects_a_damaged_chunk_and_keeps_the_target(app, library_data, tmp_path):
+    directory, target = str(tmp_path / "snapshots"), str(tmp_path / "restored.db")
+    app.backup_database(directory, incremental=True)
+    app.restore_database(directory, target)
+    restored = read_tables(target)
+    chunk = os.path.join(directory, "chunks", sorted(os.listdir(os.path.join(directory, "chunks")))[0])
+    with open(chunk, "r+b") as damaged:
+        damaged.write(b"\0" * 16)
+
+    with pytest.raises(ValueError):
+        app.restore_database(directory, target, force=True)
+
+    assert read_tables(target) == restored
+    assert not os.path.exists(target + ".restore")
+
+
+def test_restore_does_not_overwrite_without_force(app, library_data, tmp_path):
+    source, target = str(tmp_path / "library-backup.db"), tmp_path / "restored.db"
+    app.backup_database(source)
+    target.write_bytes(b"istniejacy plik")
+
+    with pytest.raises(ValueError):
+        app.restore_database(source, str(target))
+
+    assert target.read_bytes() == b"istniejacy plik"
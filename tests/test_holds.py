@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update
+
+
+def holds_by_user(app, book_id):
+    with app.session_scope() as session:
+        return dict(session.execute(select(app.Hold.user_id, app.Hold.status).where(app.Hold.book_id == book_id)).all())
+
+
+def copy_holders(app, book_id):
+    with app.session_scope() as session:
+        return set(session.scalars(select(app.Copy.user_id).where(app.Copy.book_id == book_id, app.Copy.user_id.is_not(None))))
+
+
+def test_return_hands_the_copy_to_the_first_in_queue(app, make_user):
+    book = app.add_book("Chłopi", "Władysław Reymont", 1904)
+    borrower, first, second = make_user("wypozyczajacy"), make_user("pierwszy"), make_user("drugi")
+    assert app.borrow_book(borrower, book.id)
+    assert app.place_hold(first, book.id)
+    assert app.place_hold(second, book.id)
+
+    assert app.return_book(borrower, book.id)
+
+    assert copy_holders(app, book.id) == {first.id}
+    assert holds_by_user(app, book.id) == {first.id: "fulfilled", second.id: "waiting"}
+    assert app.find_user_holds(second.id)[0][3] == 1  # Drugi jest teraz pierwszy w kolejce
+    with app.session_scope() as session:
+        loan = session.execute(select(app.Transaction).where(app.Transaction.user_id == first.id)).scalar_one()
+        notification = session.execute(select(app.Notification).where(app.Notification.user_id == first.id)).scalar_one()
+    assert loan.returned_at is None
+    assert (notification.kind, notification.transaction_id) == ("hold_ready", loan.id)
+    assert app.get_book(book.id).available == 0
+
+
+def test_allocation_skips_blocked_and_expired_holds(app, make_user):
+    book = app.add_book("Nad Niemnem", "Eliza Orzeszkowa", 1888)
+    borrower, blocked, expired, waiting = (make_user(name) for name in ("wypozyczajacy", "zablokowany", "wygasly", "czekajacy"))
+    assert app.borrow_book(borrower, book.id)
+    for reader in (blocked, expired, waiting):
+        assert app.place_hold(reader, book.id)
+    app.change_blocked_status(blocked.id, True)
+    with app.session_scope() as session:
+        session.execute(update(app.Hold).where(app.Hold.user_id == expired.id).values(expires_at=datetime.now() - timedelta(days=1)))
+
+    assert app.return_book(borrower, book.id)
+
+    assert copy_holders(app, book.id) == {waiting.id}
+    assert holds_by_user(app, book.id)[blocked.id] == "waiting"
+
+
+def test_return_without_queue_puts_the_copy_back_on_the_shelf(app, make_user):
+    book = app.add_book("Wesele", "Stanisław Wyspiański", 1901, copies=2)
+    borrower, other = make_user("wypozyczajacy"), make_user("inny")
+    assert app.borrow_book(borrower, book.id)
+    assert not app.place_hold(other, book.id)  # Jest wolny egzemplarz - rezerwacja niepotrzebna
+
+    assert app.return_book(borrower, book.id)
+
+    assert copy_holders(app, book.id) == set()
+    assert app.get_book(book.id).available == 2
+
+
+# Jeden zwrot przydziela tylko zwrócony egzemplarz - reszta kolejki czeka na kolejne zwroty
+def test_each_return_serves_one_waiting_reader(app, make_user):
+    book = app.add_book("Pan Tadeusz", "Adam Mickiewicz", 1834, copies=2)
+    borrowers = [make_user(f"wypozyczajacy{number}") for number in range(2)]
+    queue = [make_user(f"czekajacy{number}") for number in range(3)]
+    for reader in borrowers:
+        assert app.borrow_book(reader, book.id)
+    for reader in queue:
+        assert app.place_hold(reader, book.id)
+
+    assert app.return_book(borrowers[0], book.id)
+    assert copy_holders(app, book.id) == {borrowers[1].id, queue[0].id}
+
+    assert app.return_book(borrowers[1], book.id)
+    assert copy_holders(app, book.id) == {queue[0].id, queue[1].id}
+    assert holds_by_user(app, book.id)[queue[2].id] == "waiting"
@@ -0,0 +1,77 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import func, select
+
+
+# Wszystkie wątki startują naraz (Barrier), żeby wypożyczenia naprawdę się na siebie nałożyły
+def run_together(function, arguments):
+    barrier = threading.Barrier(len(arguments))
+
+    def call(argument):
+        barrier.wait()
+        return function(argument)
+
+    with ThreadPoolExecutor(max_workers=len(arguments)) as executor:
+        return list(executor.map(call, arguments))
+
+
+def open_loans(app, book_id):
+    with app.session_scope() as session:
+        return session.execute(
+            select(app.Transaction.user_id, app.Transaction.copy_id)
+            .where(app.Transaction.book_id == book_id, app.Transaction.returned_at.is_(None))
+        ).all()
+
+
+def test_concurrent_borrows_never_share_a_copy(app, make_user):
+    book = app.add_book("Lalka", "Bolesław Prus", 1890, copies=3)
+    readers = [make_user(f"czytelnik{number}") for number in range(8)]
+
+    results = run_together(lambda reader: app.borrow_book(reader, book.id), readers)
+
+    assert results.count(True) == 3
+    loans = open_loans(app, book.id)
+    assert len(loans) == 3
+    assert len({copy_id for _, copy_id in loans}) == 3
+    assert {user_id for user_id, _ in loans} == {reader.id for reader, borrowed in zip(readers, results) if borrowed}
+    assert app.get_book(book.id).available == 0
+
+
+# Ten sam czytelnik z kilku terminali naraz: claim_copy nie da mu drugiego egzemplarza tego samego tytułu
+def test_concurrent_borrows_by_one_reader_claim_one_copy(app, make_user):
+    book = app.add_book("Potop", "Henryk Sienkiewicz", 1886, copies=5)
+    reader = make_user("czytelnik")
+
+    results = run_together(lambda _: app.borrow_book(reader, book.id), range(6))
+
+    assert results.count(True) == 1
+    assert len(open_loans(app, book.id)) == 1
+    with app.session_scope() as session:
+        assert session.scalar(select(func.count(app.Copy.id)).where(app.Copy.user_id == reader.id)) == 1
+
+
+def test_claim_copy_takes_each_free_copy_once(app, make_user):
+    book = app.add_book("Ferdydurke", "Witold Gombrowicz", 1937, copies=2)
+    readers = [make_user(f"czytelnik{number}") for number in range(3)]
+
+    def claim(reader):
+        with app.session_scope() as session:
+            return app.claim_copy(session, book.id, reader.id)
+
+    claimed = [claim(reader) for reader in readers]
+
+    assert claimed[2] is None
+    assert None not in claimed[:2] and claimed[0] != claimed[1]
+
+
+def test_return_frees_the_copy_and_closes_the_loan(app, make_user):
+    book = app.add_book("Quo vadis", "Henryk Sienkiewicz", 1896)
+    reader = make_user("czytelnik")
+    assert app.borrow_book(reader, book.id)
+
+    assert app.return_book(reader, book.id)
+
+    assert open_loans(app, book.id) == []
+    assert app.get_book(book.id).available == 1
+    assert not app.return_book(reader, book.id)
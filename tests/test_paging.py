@@ -0,0 +1,67 @@
+import pytest
+
+# Autorzy z powtórzeniami i kilkoma NULL (także w środku kolejności ID), żeby strony wypadały na styku NULL i wartości
+AUTHORS = ["Prus", None, "Mickiewicz", "Prus", None, "Orzeszkowa", "Mickiewicz", None, "Prus", "Reymont", None, "Orzeszkowa", "Prus"]
+
+
+@pytest.fixture
+def books(app):
+    return [(app.add_book(f"Tytuł {number}", author, 1900 + number).id, author) for number, author in enumerate(AUTHORS)]
+
+
+# Kolejność listy: NULL przed każdą wartością, remisy po ID
+def expected_ids(books, descending):
+    ordered = sorted(books, key=lambda book: (book[1] is not None, book[1] or "", book[0]))
+    ids = [book_id for book_id, _ in ordered]
+    return ids[::-1] if descending else ids
+
+
+def make_pager(app, sort, descending, page_size):
+    return app.KeysetPager([app.Book.id, app.Book.title, app.Book.author], app.BOOK_SORT_KEYS, sort, page_size=page_size, descending=descending)
+
+
+@pytest.mark.parametrize("descending", [False, True])
+@pytest.mark.parametrize("page_size", [1, 2, 3, 5, 20])
+def test_pages_cover_the_list_once_in_order(app, books, descending, page_size):
+    pager = make_pager(app, "autor", descending, page_size)
+
+    pages = [pager.first()]
+    while pager.has_next:
+        pages.append(pager.next())
+
+    assert [row[0] for page in pages for row in page] == expected_ids(books, descending)
+    assert all(len(page) == page_size for page in pages[:-1])
+    assert pager.next() is None
+
+
+@pytest.mark.parametrize("descending", [False, True])
+@pytest.mark.parametrize("page_size", [1, 2, 3, 5])
+def test_previous_pages_match_the_pages_seen_going_forward(app, books, descending, page_size):
+    pager = make_pager(app, "autor", descending, page_size)
+    forward = [pager.first()]
+    while pager.has_next:
+        forward.append(pager.next())
+
+    backward = [forward[-1]]
+    while pager.has_previous:
+        backward.append(pager.previous())
+
+    assert backward[::-1] == forward
+    assert pager.page_number == 1
+
+
+def test_only_null_keys(app):
+    ids = [app.add_book(f"Tytuł {number}", None, None).id for number in range(5)]
+    pager = make_pager(app, "rok", False, 2)
+
+    pages = [pager.first()]
+    while pager.has_next:
+        pages.append(pager.next())
+
+    assert [row[0] for page in pages for row in page] == ids
+    assert pager.previous() == pages[-2]
+
+
+def test_unknown_sort_key_is_rejected(app):
+    with pytest.raises(ValueError):
+        make_pager(app, "wydawca", False, 10)